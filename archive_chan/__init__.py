@@ -25,14 +25,8 @@ def create_app(config=None, envvar='ARCHIVE_CHAN_SETTINGS'):
     """
     app = Flask(__name__)
 
-    # Load config.
-    app.config.from_object('archive_chan.settings')
-    if envvar is not None:
-        app.config.from_envvar(envvar)
-    if config is not None:
-        app.config.update(config)
-
-    validate_config(app)
+    app.config_sources = (config, envvar)
+    load_config(app, config, envvar)
     load_debug(app)
     init_app(app)
 
@@ -60,6 +54,24 @@ def init_app(app):
     cache.init_app(app)
 
 
+def load_config(app, config=None, envvar=None):
+    """Loads and validates the config, see create_app."""
+    app.config.from_object('archive_chan.settings')
+    if envvar is not None:
+        app.config.from_envvar(envvar)
+    if config is not None:
+        app.config.update(config)
+    validate_config(app)
+
+
+def reload_config(app):
+    """Loads the config again from the sources used when the app was created.
+    Used by the long running processes to apply the changes in the config
+    files without restarting.
+    """
+    load_config(app, *app.config_sources)
+
+
 def validate_config(app):
     """Validates app config."""
     # Working in deployment mode (debug and testing disabled).
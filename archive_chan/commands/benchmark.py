@@ -0,0 +1,240 @@
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from flask import current_app
+from flask.ext import script
+from sqlalchemy import event
+from .. import create_app
+from ..database import db, init_db
+from ..models import Board, Update
+from ..lib.capture import Capture, ReplayConnectionPool
+from ..lib.fake_server import FakeServer
+from ..lib.scraper import create_parser_pool
+from .fake_server import server_options, get_server_kwargs
+from .update import get_board_scraper_class, update_boards
+
+
+class QueryTimer(object):
+    """Measures the total time spent executing the database queries by all
+    threads.
+    """
+
+    def __init__(self, engine):
+        self.total = 0
+        self.lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        with self.lock:
+            self.total += seconds
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of this process [MB]."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Benchmark(object):
+    """Updates the fake boards served by the FakeServer or replayed from
+    a capture a number of times and measures the performance of each update.
+
+    server: started FakeServer or None.
+    boards: names of the boards.
+    engine: scraping engine or None to use the SCRAPER_ENGINE setting.
+    connection_pool: ReplayConnectionPool used instead of the server.
+    """
+
+    def __init__(self, server, boards, engine=None, connection_pool=None):
+        self.server = server
+        self.connection_pool = connection_pool
+        self.engine = engine or current_app.config['SCRAPER_ENGINE']
+        self.boards = []
+        for name in boards:
+            board = Board.query.get(name)
+            if board is None:
+                board = Board(name=name)
+                db.session.add(board)
+            self.boards.append(board)
+        db.session.commit()
+        self.timer = QueryTimer(db.engine)
+        self.last_update_id = db.session.query(db.func.max(Update.id)) \
+                                        .scalar() or 0
+
+    def get_update_stats(self):
+        """Returns the numbers of the posts and the files added by the
+        updates recorded since the last call.
+        """
+        updates = Update.query.filter(Update.id > self.last_update_id).all()
+        if updates:
+            self.last_update_id = max(update.id for update in updates)
+        posts = sum(update.added_posts for update in updates)
+        files = sum(update.downloaded_images + update.downloaded_thumbnails
+                    for update in updates)
+        return posts, files
+
+    def get_requests(self):
+        """Returns the total number of the performed requests."""
+        if self.server is None:
+            return self.connection_pool.requests
+        return self.server.get_stats()['total']
+
+    def run_update(self, parser_pool):
+        """Update all boards once. Returns a dict with the measurements."""
+        kwargs = {}
+        if self.connection_pool is not None:
+            kwargs['connection_pool'] = self.connection_pool
+        requests = self.get_requests()
+        db_time = self.timer.total
+        start = time.perf_counter()
+        update_boards(get_board_scraper_class(self.engine), self.boards,
+                      parser_pool=parser_pool, **kwargs)
+        seconds = time.perf_counter() - start
+        posts, files = self.get_update_stats()
+        return {
+            'seconds': seconds,
+            'posts': posts,
+            'files': files,
+            'requests': self.get_requests() - requests,
+            'db_time': self.timer.total - db_time,
+            'peak_rss': get_peak_rss(),
+        }
+
+    def run(self, updates, churn):
+        """Perform the updates, the fake boards change between them. Returns
+        the list of the measurements.
+        """
+        results = []
+        parser_pool = create_parser_pool()
+        try:
+            for i in range(updates):
+                if i > 0 and self.server is not None:
+                    self.server.advance(churn)
+                results.append(self.run_update(parser_pool))
+        finally:
+            if parser_pool is not None:
+                parser_pool.shutdown()
+        return results
+
+
+def format_result(name, result):
+    seconds = max(result['seconds'], 1e-6)
+    return ('%s: %.2f seconds, %s posts (%.1f/s), %s files (%.1f/s), '
+            '%s requests (%.1f/s), DB time %.2f seconds, peak RSS %.1f MB' % (
+        name,
+        result['seconds'],
+        result['posts'], result['posts'] / seconds,
+        result['files'], result['files'] / seconds,
+        result['requests'], result['requests'] / seconds,
+        result['db_time'],
+        result['peak_rss'],
+    ))
+
+
+class Command(script.Command):
+    """Benchmarks the scraper using fake boards served locally.
+    The first update downloads the entire boards, each following one the
+    posts added in the meantime (see --churn). Results are stored in a
+    temporary database unless --database is specified. With --replay the
+    boards are replayed from a capture recorded by `update --record`.
+    """
+
+    option_list = server_options + (
+        script.Option(
+            '--updates',
+            dest='updates',
+            type=int,
+            default=3,
+            help='Number of updates of each board.',
+        ),
+        script.Option(
+            '--engine',
+            dest='engine',
+            choices=('threads', 'asyncio'),
+            default=None,
+            help='Scraping engine. Defaults to SCRAPER_ENGINE setting.',
+        ),
+        script.Option(
+            '--database',
+            dest='database',
+            default=None,
+            help='Database URI. Defaults to a temporary SQLite database.',
+        ),
+        script.Option(
+            '--replay',
+            dest='replay',
+            default=None,
+            help='Replay the boards from the capture file instead of '
+                 'starting the fake server.',
+        ),
+    )
+
+    def run(self, updates, engine, database, churn, replay, **kwargs):
+        server_kwargs = get_server_kwargs(**kwargs)
+        server = None
+        capture = None
+        boards = server_kwargs['boards']
+        if replay is None:
+            server = FakeServer(**server_kwargs)
+        else:
+            capture = Capture(replay)
+            boards = capture.get_boards()
+        media_root = tempfile.mkdtemp()
+        db_path = None
+        if database is None:
+            db_fd, db_path = tempfile.mkstemp()
+            os.close(db_fd)
+            # Writers wait for each other instead of failing.
+            database = 'sqlite:///%s?timeout=60' % db_path
+
+        try:
+            for directory in ('post_images', 'post_thumbnails'):
+                os.mkdir(os.path.join(media_root, directory))
+            config = dict(current_app.config)
+            if server is not None:
+                server.start()
+                config.update(server.get_settings())
+            config.update({
+                'SQLALCHEMY_DATABASE_URI': database,
+                'MEDIA_ROOT': media_root,
+                'API_WAIT': 0,
+                'FILE_WAIT': 0,
+            })
+            app = create_app(config=config, envvar=None)
+            with app.app_context():
+                init_db()
+                connection_pool = None
+                if capture is not None:
+                    connection_pool = ReplayConnectionPool(capture)
+                benchmark = Benchmark(server, boards, engine=engine,
+                                      connection_pool=connection_pool)
+                try:
+                    results = benchmark.run(updates, churn)
+                finally:
+                    if connection_pool is not None:
+                        connection_pool.close()
+
+            for i, result in enumerate(results):
+                print(format_result('Update %s' % (i + 1), result))
+            total = {key: sum(result[key] for result in results)
+                     for key in results[0]}
+            total['peak_rss'] = get_peak_rss()
+            print(format_result('Total', total))
+
+        finally:
+            if server is not None:
+                server.stop()
+            if capture is not None:
+                capture.close()
+            shutil.rmtree(media_root)
+            if db_path is not None:
+                os.unlink(db_path)
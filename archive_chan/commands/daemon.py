@@ -0,0 +1,301 @@
+import signal
+import sys
+import threading
+import time
+from flask import current_app
+from flask.ext import script
+from tendo import singleton
+from .. import reload_config
+from ..database import db
+from ..models import Board, Update
+from ..lib.connection import ConnectionPool
+from ..lib.scraper import Triggers, Validators, ThreadIndex, WorkerPool, \
+    create_parser_pool
+from .update import get_board_scraper_class, fail_unfinished_updates, \
+    update_board
+
+
+class BoardSchedule(object):
+    """State of a board kept by the daemon between the updates. The
+    validators and the thread index are loaded by the first update and kept
+    up to date by the following ones.
+
+    board: Board object.
+    interval: time between the starts of two updates of the board [seconds].
+    next_update: time of the next update, as returned by the daemon clock.
+    adaptive: if True the interval is adjusted to the rate at which the posts
+              are added to the board.
+    """
+
+    # Weight of the last measurement in the estimated post rate.
+    smoothing = 0.5
+
+    def __init__(self, board, interval, next_update, adaptive=False):
+        self.board = board
+        self.interval = interval
+        self.next_update = next_update
+        self.adaptive = adaptive
+        self.validators = Validators(board)
+        self.thread_index = ThreadIndex(board)
+
+        # Estimated number of posts added to the board per second and the
+        # time at which the last update started.
+        self.post_rate = None
+        self.last_update = None
+
+    def adapt_interval(self):
+        """Set the interval so that each update downloads about
+        SCRAPER_DAEMON_TARGET_POSTS posts.
+        """
+        if not self.adaptive or self.post_rate is None:
+            return
+        if self.post_rate > 0:
+            interval = current_app.config['SCRAPER_DAEMON_TARGET_POSTS'] \
+                       / self.post_rate
+        else:
+            interval = current_app.config['SCRAPER_DAEMON_MAX_INTERVAL']
+        interval = max(interval,
+                       current_app.config['SCRAPER_DAEMON_MIN_INTERVAL'])
+        self.interval = min(interval,
+                            current_app.config['SCRAPER_DAEMON_MAX_INTERVAL'])
+
+    def on_update(self, start, added_posts):
+        """Called after the board was updated.
+
+        start: time at which the update started, as returned by the daemon
+               clock.
+        added_posts: number of posts added during the update.
+        """
+        if self.last_update is not None and start > self.last_update:
+            rate = added_posts / (start - self.last_update)
+            if self.post_rate is None:
+                self.post_rate = rate
+            else:
+                self.post_rate = self.smoothing * rate \
+                                 + (1 - self.smoothing) * self.post_rate
+        self.last_update = start
+        self.adapt_interval()
+
+
+class Daemon(object):
+    """Updates the active boards continuously. Each board is polled in its
+    own interval. The HTTP connections, the workers, the rate limiter, the
+    triggers and the state of the boards are kept between the updates instead
+    of being created by each update.
+
+    engine: scraping engine or None to use the SCRAPER_ENGINE setting.
+    progress: bool value, indicates if the progress should be displayed.
+    clock: function returning the current monotonic time in seconds.
+    """
+
+    # Number of the recent updates used to estimate the post rate of a board.
+    history_length = 10
+
+    def __init__(self, engine=None, progress=False, clock=time.monotonic):
+        self.engine = engine
+        self.progress = progress
+        self.clock = clock
+
+        self.schedules = {}
+        self.connection_pool = None
+        self.parser_pool = None
+        self.worker_pool = None
+        self.reload_requested = False
+        self.stop_requested = False
+        self.wake_up = threading.Event()
+        self.load()
+
+    def get_interval(self, board):
+        """Returns the initial update interval of the board."""
+        intervals = current_app.config['SCRAPER_DAEMON_BOARD_INTERVALS']
+        return intervals.get(board.name,
+                             current_app.config['SCRAPER_DAEMON_INTERVAL'])
+
+    def is_adaptive(self, board):
+        """True if the interval of the board should follow its post rate."""
+        intervals = current_app.config['SCRAPER_DAEMON_BOARD_INTERVALS']
+        return board.name not in intervals \
+               and current_app.config['SCRAPER_DAEMON_TARGET_POSTS'] > 0
+
+    def get_post_rate(self, board):
+        """Estimate the number of posts added to the board per second using
+        the recent updates. Returns None if there is not enough data.
+        """
+        updates = Update.query.filter(Update.board==board,
+                                      Update.status==Update.COMPLETED) \
+                              .order_by(Update.start.desc()) \
+                              .limit(self.history_length) \
+                              .all()
+        if len(updates) < 2:
+            return None
+        # Each update adds the posts created since the previous one started.
+        seconds = (updates[0].start - updates[-1].start).total_seconds()
+        if seconds <= 0:
+            return None
+        return sum(update.added_posts for update in updates[:-1]) / seconds
+
+    def load(self):
+        """Create the objects shared by the updates and load the active
+        boards. Boards which were already scheduled keep their update time.
+        """
+        engine = self.engine or current_app.config['SCRAPER_ENGINE']
+        self.board_scraper_class = get_board_scraper_class(engine)
+        self.queuer = self.board_scraper_class.queuer_class()
+        self.triggers = Triggers()
+
+        self.close_pools()
+        self.connection_pool = ConnectionPool()
+        self.parser_pool = create_parser_pool()
+        # Workers of the threaded engine are started by the first update.
+        self.worker_pool = WorkerPool(current_app._get_current_object())
+
+        now = self.clock()
+        schedules = {}
+        for board in Board.query.filter(Board.active==True):
+            interval = self.get_interval(board)
+            schedule = BoardSchedule(board, interval, now,
+                                     adaptive=self.is_adaptive(board))
+            if board.name in self.schedules:
+                # Keep the measurements and apply the new interval to the
+                # already scheduled update.
+                previous = self.schedules[board.name]
+                schedule.post_rate = previous.post_rate
+                schedule.last_update = previous.last_update
+                schedule.adapt_interval()
+                schedule.next_update = previous.next_update \
+                                       - previous.interval + schedule.interval
+            else:
+                schedule.post_rate = self.get_post_rate(board)
+                schedule.adapt_interval()
+            schedules[board.name] = schedule
+        self.schedules = schedules
+
+    def close_pools(self):
+        """Stop the workers and close the connection pool and the parser
+        pool.
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.stop()
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+        if self.parser_pool is not None:
+            self.parser_pool.shutdown()
+
+    def reload(self):
+        """Reload the config, the triggers and the list of the boards."""
+        self.reload_requested = False
+        try:
+            reload_config(current_app._get_current_object())
+            self.load()
+        except Exception as e:
+            sys.stderr.write('Reload failed: %s\n' % e)
+            db.session.rollback()
+
+    def request_reload(self):
+        """Reload before the next update. Can be called by a signal
+        handler.
+        """
+        self.reload_requested = True
+        self.wake_up.set()
+
+    def request_stop(self):
+        """Stop after the current update. Can be called by a signal
+        handler.
+        """
+        self.stop_requested = True
+        self.wake_up.set()
+
+    def update(self, schedule):
+        """Update a single board and adjust its interval."""
+        start = self.clock()
+        try:
+            scraper = update_board(self.board_scraper_class, schedule.board,
+                                   progress=self.progress,
+                                   queuer=self.queuer,
+                                   triggers=self.triggers,
+                                   connection_pool=self.connection_pool,
+                                   parser_pool=self.parser_pool,
+                                   worker_pool=self.worker_pool,
+                                   validators=schedule.validators,
+                                   thread_index=schedule.thread_index)
+            schedule.on_update(start, scraper.stats.get('added_posts'))
+        except Exception as e:
+            sys.stderr.write('%s\n' % e)
+            db.session.rollback()
+
+    def run_pending(self):
+        """Update the boards which are due for an update. Returns the number
+        of seconds until the next update or None if there are no boards.
+        """
+        for schedule in sorted(self.schedules.values(),
+                               key=lambda schedule: schedule.next_update):
+            if self.stop_requested or self.reload_requested:
+                break
+            start = self.clock()
+            if schedule.next_update > start:
+                break
+            self.update(schedule)
+            schedule.next_update = start + schedule.interval
+
+        if not self.schedules:
+            return None
+        next_update = min(schedule.next_update
+                          for schedule in self.schedules.values())
+        return max(next_update - self.clock(), 0)
+
+    def sleep(self, seconds):
+        """Sleep until the time passes or a signal is received."""
+        self.wake_up.wait(seconds)
+        self.wake_up.clear()
+
+    def run(self):
+        while not self.stop_requested:
+            if self.reload_requested:
+                self.reload()
+            delay = self.run_pending()
+            if delay is None:
+                # Wait for the boards to be added.
+                delay = current_app.config['SCRAPER_DAEMON_INTERVAL']
+            if delay > 0 and not self.stop_requested:
+                self.sleep(delay)
+        self.close_pools()
+
+
+class Command(script.Command):
+    """Scraps threads from all active boards continuously.
+    Unlike the update command this one keeps running and updates each board in
+    its own interval. Send SIGHUP to reload the config, the triggers and the
+    list of the boards, SIGTERM or SIGINT to stop after the current update.
+    """
+
+    option_list = (
+        script.Option(
+            '--progress',
+            action='store_true',
+            dest='progress',
+            help='Display progress.',
+        ),
+        script.Option(
+            '--engine',
+            dest='engine',
+            choices=('threads', 'asyncio'),
+            default=None,
+            help='Scraping engine. Defaults to SCRAPER_ENGINE setting.',
+        ),
+    )
+
+    def run(self, progress, engine):
+        # Prevent multiple instances, this also blocks the update command.
+        me = singleton.SingleInstance()
+        fail_unfinished_updates()
+
+        daemon = Daemon(engine=engine, progress=progress)
+        handlers = {
+            signal.SIGHUP: daemon.request_reload,
+            signal.SIGTERM: daemon.request_stop,
+            signal.SIGINT: daemon.request_stop,
+        }
+        for signum, handler in handlers.items():
+            signal.signal(signum, lambda signum, frame, handler=handler:
+                                  handler())
+        daemon.run()
@@ -0,0 +1,138 @@
+import threading
+from flask.ext import script
+from ..lib.fake_server import FakeChan, create_server
+
+
+# Options describing the fake boards, shared with the benchmark command.
+server_options = (
+    script.Option(
+        '--boards',
+        dest='boards',
+        default='g',
+        help='Comma separated names of the fake boards.',
+    ),
+    script.Option(
+        '--seed',
+        dest='seed',
+        type=int,
+        default=0,
+        help='Seed of the generated data.',
+    ),
+    script.Option(
+        '--threads',
+        dest='threads',
+        type=int,
+        default=150,
+        help='Number of active threads on each board.',
+    ),
+    script.Option(
+        '--replies',
+        dest='replies',
+        type=int,
+        default=50,
+        help='Average number of replies in the initial threads.',
+    ),
+    script.Option(
+        '--file-ratio',
+        dest='file_ratio',
+        type=float,
+        default=0.5,
+        help='Fraction of the posts with an attached file.',
+    ),
+    script.Option(
+        '--file-size',
+        dest='file_size',
+        type=int,
+        default=16 * 1024,
+        help='Size of the images in bytes.',
+    ),
+    script.Option(
+        '--latency',
+        dest='latency',
+        type=float,
+        default=0,
+        help='Delay of each response in seconds.',
+    ),
+    script.Option(
+        '--error-rate',
+        dest='error_rate',
+        type=float,
+        default=0,
+        help='Fraction of the requests answered with 500.',
+    ),
+    script.Option(
+        '--churn',
+        dest='churn',
+        type=int,
+        default=500,
+        help='Number of posts added to each board between the updates.',
+    ),
+)
+
+
+def get_server_kwargs(boards, seed, threads, replies, file_ratio, file_size,
+                      latency, error_rate):
+    """Converts the values of server_options to FakeChan arguments."""
+    return {
+        'boards': boards.split(','),
+        'seed': seed,
+        'threads': threads,
+        'replies': replies,
+        'file_ratio': file_ratio,
+        'file_size': file_size,
+        'latency': latency,
+        'error_rate': error_rate,
+    }
+
+
+class Command(script.Command):
+    """Serves fake 4chan boards locally.
+    Point the scraper at the printed urls to test it without accessing the
+    real API. Boards change every --interval seconds.
+    """
+
+    option_list = server_options + (
+        script.Option(
+            '--host',
+            dest='host',
+            default='127.0.0.1',
+        ),
+        script.Option(
+            '--port',
+            dest='port',
+            type=int,
+            default=8000,
+        ),
+        script.Option(
+            '--interval',
+            dest='interval',
+            type=float,
+            default=60,
+            help='Time between the changes of the boards in seconds.',
+        ),
+    )
+
+    def run(self, host, port, interval, churn, **kwargs):
+        chan = FakeChan(**get_server_kwargs(**kwargs))
+        server = create_server(chan, host, port)
+        url = 'http://%s:%s' % server.server_address
+        print("API_URL = '%s/a'" % url)
+        print("IMAGES_URL = '%s/i'" % url)
+        print("THUMBNAILS_URL = '%s/t'" % url, flush=True)
+
+        stopped = threading.Event()
+
+        def advance():
+            while not stopped.wait(interval):
+                chan.advance(churn)
+
+        thread = threading.Thread(target=advance)
+        thread.daemon = True
+        thread.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stopped.set()
+            server.server_close()
@@ -2,15 +2,20 @@ import datetime
 from os import path, listdir, remove
 from flask import current_app
 from flask.ext import script
-from ..models import Image
+from ..models import Image, File
 
 class Command(script.Command):
     """Removes the files without a corresponding database entry. In theory those
-    files should be deleted automatically but who knows what can happen.
+    files should be deleted automatically but who knows what can happen. Files
+    shared by many images are kept as long as they are referenced and partial
+    downloads are never removed.
     WARNING: this is a dumb function which will simply iterate over all files
     and query the database once for each file so it can strain your server.
     """
 
+    # Suffix of the files which are being downloaded, see FileWriter.
+    partial_suffix = '.part'
+
     option_list = (
         script.Option(
             '--progress',
@@ -59,6 +64,8 @@ class Command(script.Command):
                 if show_progress:
                     print('%s - %s' % (index, filename))
                 full_path = path.join(dir_path, filename)
+                if filename.endswith(self.partial_suffix):
+                    continue
                 if path.isfile(full_path):
                     if not check_in_db_function(path.join(directory, filename)):
                         try:
@@ -69,7 +76,9 @@ class Command(script.Command):
         return files_deleted
 
     def image_exists_in_db(self, path):
-        return Image.query.filter(Image.image==path).first() is not None
+        return Image.query.filter(Image.image==path).first() is not None \
+               or File.query.filter(File.image==path).first() is not None
 
     def thumbnail_exists_in_db(self, path):
-        return Image.query.filter(Image.thumbnail==path).first() is not None
+        return Image.query.filter(Image.thumbnail==path).first() is not None \
+               or File.query.filter(File.thumbnail==path).first() is not None
@@ -1,17 +1,22 @@
 import datetime
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from flask import current_app
 from flask.ext import script
 from tendo import singleton
 from ..database import db
 from ..models import Board, Update
+from ..lib.capture import Capture, RecordingConnectionPool, \
+                          ReplayConnectionPool
+from ..lib.connection import ConnectionPool
 from ..lib.helpers import utc_now
-from ..lib.scraper import BoardScraper
+from ..lib.scraper import BoardScraper, create_parser_pool
 
 
 class UpdateInfo(object):
-    def __init__(self, board):
+    def __init__(self, board, used_threads):
         self.board = board
+        self.used_threads = used_threads
         self.start()
 
     def start(self):
@@ -19,7 +24,7 @@ class UpdateInfo(object):
         self.update = Update(
             board=self.board,
             start=self.processing_start,
-            used_threads=current_app.config['SCRAPER_THREADS_NUMBER']
+            used_threads=self.used_threads
         )
         db.session.add(self.update)
         db.session.commit()
@@ -38,7 +43,8 @@ class UpdateInfo(object):
 
             self.update = board_scraper.stats.add_to_record(
                 self.update,
-                self.processing_time
+                self.processing_time,
+                used_threads=self.used_threads
             )
 
         except Exception as e:
@@ -51,10 +57,106 @@ class UpdateInfo(object):
         print('%s Board: %s %s' % (
             datetime.datetime.now(),
             self.board,
-            board_scraper.stats.get_text(self.processing_time),
+            board_scraper.stats.get_text(self.processing_time,
+                                         used_threads=self.used_threads),
         ))
 
 
+def get_board_scraper_class(engine):
+    """Returns the board scraper class implementing the engine."""
+    if engine == 'asyncio':
+        from ..lib.async_scraper import AsyncBoardScraper
+        return AsyncBoardScraper
+    return BoardScraper
+
+
+def fail_unfinished_updates():
+    """Mark previous updates which weren't completed as failed."""
+    db.session.query(Update).filter(Update.status==Update.CURRENT) \
+                            .update({'status': Update.FAILED})
+    db.session.commit()
+
+
+def update_board(board_scraper_class, board, **kwargs):
+    """Updates a single board and records the update in the database.
+    **kwargs are passed to the board scraper.
+    """
+    scraper = board_scraper_class(board, **kwargs)
+    update_info = UpdateInfo(board, scraper.workers_number)
+    try:
+        scraper.update()
+    except Exception as e:
+        update_info.encoutered_error(e)
+        sys.stderr.write('%s\n' % e)
+    finally:
+        update_info.end(scraper)
+    return scraper
+
+
+def update_boards(board_scraper_class, boards, **kwargs):
+    """Updates the boards concurrently, at most SCRAPER_CONCURRENT_BOARDS at
+    once. Each board is updated in a separate thread with its own app
+    context, Update record and stats. All boards share the API and file rate
+    limits. Slots in the token buckets are granted in the order of requests so
+    each board gets a share of the requests proportional to the number of its
+    workers. Boards also share the connection pool, so the connections and the
+    circuit breakers are kept per host. **kwargs are passed to the board
+    scrapers.
+    """
+    max_boards = current_app.config['SCRAPER_CONCURRENT_BOARDS']
+    buckets = board_scraper_class.queuer_class().buckets
+    owns_connection_pool = kwargs.get('connection_pool') is None
+    if owns_connection_pool:
+        kwargs['connection_pool'] = ConnectionPool()
+
+    try:
+        if max_boards <= 1 or len(boards) <= 1:
+            for board in boards:
+                update_board(board_scraper_class, board,
+                             queuer=board_scraper_class.queuer_class(buckets),
+                             **kwargs)
+            return
+
+        app = current_app._get_current_object()
+
+        def update_in_thread(board_name):
+            try:
+                with app.app_context():
+                    board = Board.query.get(board_name)
+                    update_board(
+                        board_scraper_class, board,
+                        queuer=board_scraper_class.queuer_class(buckets),
+                        **kwargs
+                    )
+            except Exception as e:
+                sys.stderr.write('%s\n' % e)
+
+        board_names = [board.name for board in boards]
+        with ThreadPoolExecutor(max_workers=max_boards) as executor:
+            list(executor.map(update_in_thread, board_names))
+
+    finally:
+        if owns_connection_pool:
+            kwargs['connection_pool'].close()
+
+
+def create_capture_pool(record=None, replay=None):
+    """Returns the connection pool recording the responses to the capture
+    file or replaying them from it, None if neither path is specified.
+    Replayed responses are not rate limited. Close the capture stored in
+    the capture attribute of the returned pool after the update.
+    """
+    if record is not None and replay is not None:
+        raise ValueError('Responses cannot be recorded and replayed at once.')
+    if record is not None:
+        return RecordingConnectionPool(Capture(record))
+    if replay is not None:
+        current_app.config['API_WAIT'] = 0
+        current_app.config['FILE_WAIT'] = 0
+        return ReplayConnectionPool(Capture(replay))
+    return None
+
+
 class Command(script.Command):
     """Scraps threads from all active boards.
     This command should be run periodically to download new threads, posts
@@ -68,23 +170,50 @@ class Command(script.Command):
             dest='progress',
             help='Display progress.',
         ),
+        script.Option(
+            '--engine',
+            dest='engine',
+            choices=('threads', 'asyncio'),
+            default=None,
+            help='Scraping engine. Defaults to SCRAPER_ENGINE setting.',
+        ),
+        script.Option(
+            '--record',
+            dest='record',
+            default=None,
+            help='Record all responses to the specified capture file.',
+        ),
+        script.Option(
+            '--replay',
+            dest='replay',
+            default=None,
+            help='Replay the responses from the specified capture file '
+                 'instead of accessing the network.',
+        ),
     )
 
-    def run(self, progress):
+    def run(self, progress, engine, record, replay):
         # Prevent multiple instances.
         me = singleton.SingleInstance()
-        # Mark previous updates which weren't completed as failed.
-        db.session.query(Update).filter(Update.status==Update.CURRENT) \
-                                .update({'status': Update.FAILED})
+        fail_unfinished_updates()
+
+        engine = engine or current_app.config['SCRAPER_ENGINE']
+        board_scraper_class = get_board_scraper_class(engine)
 
         boards = Board.query.filter(Board.active==True).all()
-        for board in boards:
-            update_info = UpdateInfo(board)
-            scraper = BoardScraper(board, progress=progress)
-            try:
-                scraper.update()
-            except Exception as e:
-                update_info.encoutered_error(e)
-                sys.stderr.write('%s\n' % e)
-            finally:
-                update_info.end(scraper)
+        kwargs = {}
+        connection_pool = create_capture_pool(record, replay)
+        if connection_pool is not None:
+            # All boards record to or replay from the same capture.
+            kwargs['connection_pool'] = connection_pool
+        # Boards share a single pool of the parser processes.
+        parser_pool = create_parser_pool()
+        try:
+            update_boards(board_scraper_class, boards, progress=progress,
+                          parser_pool=parser_pool, **kwargs)
+        finally:
+            if parser_pool is not None:
+                parser_pool.shutdown()
+            if connection_pool is not None:
+                connection_pool.close()
+                connection_pool.capture.close()
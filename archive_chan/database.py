@@ -7,14 +7,24 @@
 
 
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
 
 
 db = SQLAlchemy()
 
 
 def init_db():
-    """Create all defined database tables."""
+    """Create all defined database tables and the indexes missing in the
+    existing tables.
+    """
     db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {index['name']
+                    for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
 
 
 def destroy_db():
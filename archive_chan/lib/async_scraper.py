@@ -0,0 +1,568 @@
+"""
+    Scraping engine based on asyncio. Instead of running a number of OS threads
+    which block on network calls it drives all downloads as coroutines in a
+    single event loop. Parsing and the database access are reused from the
+    threaded scraper and happen in the thread running the loop, which means
+    that a single database session is used for the entire board update.
+
+    aiohttp is used for downloading the data if it is installed. Otherwise
+    blocking calls to the ConnectionPool are executed in the default executor
+    of the loop which works but limits the number of concurrent downloads to
+    the size of that executor.
+"""
+
+
+import asyncio
+import collections
+import datetime
+import functools
+import sys
+import time
+from flask import current_app
+from ..database import db
+from ..models import CacheValidator
+from .connection import HostUnavailable
+from .scraper import ScrapError, CatalogParser, Queuer, \
+    ThreadScraper, BoardScraper, FileWriter, get_post_files_name, \
+    reuse_post_files, save_post_files, remove_post_files, parse_thread_content, \
+    check_status
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+# Response downloaded with aiohttp. Mimics requests.Response.
+Response = collections.namedtuple('Response',
+                                  ['status_code', 'headers', 'content'])
+
+
+class AsyncQueuer(Queuer):
+    """Queuer which can be used in the coroutines. It follows exactly the same
+    rules but waits without blocking the event loop.
+    """
+
+    async def wait(self, bucket_name):
+        """Wait until a slot in the bucket is available."""
+        delay = self.reserve(bucket_name)
+        if delay > 0:
+            wait_start = time.monotonic()
+            await asyncio.sleep(delay)
+            self.add_wait_time(time.monotonic() - wait_start)
+
+    async def api_wait(self):
+        """Wait in order to satisfy the API rules. Awaited before each API
+        query.
+        """
+        await self.wait('api')
+
+    async def file_wait(self):
+        """Wait in order to satisfy the rules. Awaited before each file
+        download.
+        """
+        await self.wait('file')
+
+
+class AsyncScraperMixin(object):
+    """Implements the coroutines downloading the data. Scrapers using this
+    mixin must have an AsyncQueuer assigned to them.
+
+    **kwargs:
+    session: aiohttp.ClientSession object or None if aiohttp is not available.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.session = kwargs.pop('session', None)
+        super().__init__(*args, **kwargs)
+
+    async def request(self, url, wait=None, read=False, **kwargs):
+        """Perform a GET request with aiohttp. Transient errors are retried
+        and the circuit breakers of the hosts are shared with the connection
+        pool, see ConnectionPool.get. Returns the response which must be
+        released.
+
+        wait: coroutine function awaited before each retry, used to take a
+              slot from the rate limiter.
+        read: if True the body is read before the response is returned so
+              the connections reset while reading it are retried as well.
+        """
+        pool = self.connection_pool
+        breaker = pool.get_breaker(url)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise HostUnavailable('Host of %s is unavailable.' % url)
+            try:
+                response = await self.session.get(url, **kwargs)
+                if read:
+                    try:
+                        await response.read()
+                    except BaseException:
+                        response.release()
+                        raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                breaker.record_failure()
+                if attempt >= pool.retries:
+                    raise
+            except BaseException:
+                # Cancelled or interrupted requests say nothing about the
+                # host, only the trial is given up.
+                breaker.release()
+                raise
+            else:
+                if not pool.should_retry(response.status):
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt >= pool.retries:
+                    return response
+                response.release()
+            await asyncio.sleep(pool.get_backoff(attempt))
+            if wait is not None:
+                await wait()
+            attempt += 1
+
+    async def fetch_url(self, url, headers=None):
+        """Download data from an url. Returns requests.Response or an object
+        with the same status_code, headers and content attributes.
+        """
+        download_start = datetime.datetime.now()
+        timeout = current_app.config['CONNECTION_TIMEOUT']
+        if self.session is not None:
+            timeout = aiohttp.ClientTimeout(total=timeout)
+            response = await self.request(url, wait=self.queuer.api_wait,
+                                          read=True, headers=headers,
+                                          timeout=timeout)
+            try:
+                data = Response(response.status, response.headers,
+                                await response.read())
+            finally:
+                response.release()
+        else:
+            loop = asyncio.get_event_loop()
+            data = await loop.run_in_executor(
+                None,
+                functools.partial(self.connection_pool.get, url,
+                                  wait=self.queuer.get_waiter('api'),
+                                  headers=headers, timeout=timeout)
+            )
+        self.stats.add('total_download_time',
+                        datetime.datetime.now() - download_start)
+        return data
+
+    async def fetch_file(self, url, file_writer):
+        """Download a file and write it using the FileWriter. Returns the path
+        of the file.
+        """
+        if self.session is None:
+            app = current_app._get_current_object()
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                None,
+                functools.partial(self.get_file_with_context, app, url,
+                                  file_writer)
+            )
+
+        download_start = datetime.datetime.now()
+        timeout = aiohttp.ClientTimeout(
+            total=current_app.config['CONNECTION_TIMEOUT']
+        )
+        chunk_size = current_app.config['SCRAPER_DOWNLOAD_CHUNK_SIZE']
+        try:
+            response = await self.request(url, wait=self.queuer.file_wait,
+                                          timeout=timeout)
+            try:
+                check_status(response.status)
+                with file_writer:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        file_writer.write(chunk)
+            finally:
+                response.release()
+        finally:
+            self.stats.add('total_download_time',
+                            datetime.datetime.now() - download_start)
+        return file_writer.path
+
+    def get_file_with_context(self, app, url, file_writer):
+        """Calls get_file in the executor thread which has no app context."""
+        with app.app_context():
+            return self.get_file(url, file_writer)
+
+
+class AsyncThreadScraper(AsyncScraperMixin, ThreadScraper):
+    """Scraps the data from a single thread. Files attached to the added posts
+    are put in the asyncio queue processed by the download coroutines of the
+    AsyncBoardScraper.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Tasks waiting to be put in the download queue.
+        self.scheduled_downloads = []
+
+    async def fetch_thread_json(self, thread_number, conditional=False,
+                                decode=True):
+        """Get the thread data from the official API. Returns None if the
+        request was conditional and the thread was not modified. If decode is
+        False the data is returned as bytes.
+        """
+        url = self.get_api_url('thread/%s.json' % thread_number)
+        headers = self.validators.get_headers(thread_number) \
+                  if conditional else None
+        await self.queuer.api_wait()
+        self.stats.add('downloaded_threads', 1)
+        response = await self.fetch_url(url, headers=headers)
+        return self.read_api_response(thread_number, response, decode=decode)
+
+    def schedule_download(self, task):
+        """Download the files attached to the post which was commited. The
+        task is put in the download queue by queue_downloads since the
+        commits are not coroutines.
+        """
+        self.scheduled_downloads.append(task)
+
+    async def queue_downloads(self):
+        """Put the scheduled tasks in the download queue. Waits if the queue
+        is full.
+        """
+        tasks, self.scheduled_downloads = self.scheduled_downloads, []
+        for task in tasks:
+            await self.download_queue.put(task)
+
+    async def handle_thread_async(self):
+        """Download/update the thread if necessary."""
+        thread = self.get_thread_to_update()
+        if thread is None:
+            self.completed = True
+            return
+        last_post_number = self.get_last_post_number(thread)
+        conditional = thread.replies > 0
+
+        # The session is shared by all coroutines, nothing can be left pending
+        # while other coroutines run since they might commit or roll it back.
+        # New threads are not stored yet, see save_thread.
+        db.session.rollback()
+
+        # Download the thread data.
+        try:
+            content = await self.fetch_thread_json(self.thread_data.number,
+                                                   conditional=conditional,
+                                                   decode=False)
+        except Exception as e:
+            self.error = e
+            raise ScrapError('Unable to download the thread data. It might not '
+                             'exist anymore.')
+
+        # Not modified.
+        if content is None:
+            self.completed = True
+            return
+
+        try:
+            parsed_thread = await self.parse_thread_content_async(
+                content, last_post_number)
+        except Exception as e:
+            self.on_thread_error(e)
+            return
+        try:
+            self.handle_parsed_thread(thread, parsed_thread, last_post_number)
+        finally:
+            await self.queue_downloads()
+
+    async def parse_thread_content_async(self, content, last_post_number):
+        """Parse the downloaded thread data without blocking the loop if the
+        parser pool is used, see parse_thread.
+        """
+        if self.use_parser_pool(content):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.parser_pool,
+                                              parse_thread_content, content,
+                                              last_post_number)
+        return parse_thread_content(content, last_post_number)
+
+
+class AsyncBoardScraper(AsyncScraperMixin, BoardScraper):
+    """Board scraper using the asyncio engine. It can be used exactly like
+    BoardScraper.
+    """
+
+    queuer_class = AsyncQueuer
+
+    @property
+    def workers_number(self):
+        """Number of threads which are processed concurrently."""
+        return current_app.config['SCRAPER_ASYNC_TASKS']
+
+    async def fetch_catalog(self):
+        """Start downloading the catalog from the official API. Returns the
+        response or None if the catalog was not modified since the last
+        update. Without aiohttp the catalog is downloaded at once.
+        """
+        url = self.get_catalog_url()
+        headers = self.validators.get_headers(CacheValidator.CATALOG)
+        await self.queuer.api_wait()
+        if self.session is None:
+            response = await self.fetch_url(url, headers=headers)
+            status_code = response.status_code
+        else:
+            timeout = aiohttp.ClientTimeout(
+                total=current_app.config['CONNECTION_TIMEOUT']
+            )
+            response = await self.request(url, wait=self.queuer.api_wait,
+                                          headers=headers, timeout=timeout)
+            status_code = response.status
+        if status_code == 304 or status_code >= 400:
+            if self.session is not None:
+                response.release()
+            return self.read_api_response(
+                CacheValidator.CATALOG,
+                Response(status_code, response.headers, b'')
+            )
+        return response
+
+    async def catalog_generator_async(self, response):
+        """Asynchronous generator for the thread data parsed from the catalog
+        while it is being downloaded.
+        """
+        download_start = datetime.datetime.now()
+        parser = CatalogParser()
+        chunk_size = current_app.config['SCRAPER_DOWNLOAD_CHUNK_SIZE']
+        try:
+            if self.session is None:
+                for thread_json in parser.feed(response.content):
+                    yield thread_json
+            else:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    for thread_json in parser.feed(chunk):
+                        yield thread_json
+            for thread_json in parser.close():
+                yield thread_json
+        finally:
+            if self.session is not None:
+                response.release()
+            self.stats.add('total_download_time',
+                            datetime.datetime.now() - download_start)
+        self.validators.set(CacheValidator.CATALOG, response.headers)
+
+    async def fetch_archive(self):
+        """Download the list of the archived threads, see read_archive."""
+        url = self.get_api_url('archive.json')
+        await self.queuer.api_wait()
+        return self.read_archive(await self.fetch_url(url))
+
+    async def get_archived_threads_async(self, thread_numbers):
+        """Coroutine version of get_archived_threads."""
+        if not current_app.config['SCRAPER_FETCH_ARCHIVED']:
+            return []
+        disappeared = self.get_disappeared_threads(thread_numbers)
+        if not disappeared:
+            return []
+        try:
+            archive = await self.fetch_archive()
+        except Exception as e:
+            sys.stderr.write('Unable to download the archive (%s).\n' % e)
+            return []
+        return sorted(disappeared & archive)
+
+    def create_session(self):
+        """Create the aiohttp session shared by all coroutines or return None
+        if aiohttp is not installed or the connection pool doesn't allow it.
+        """
+        if aiohttp is None or not self.connection_pool.allows_sessions:
+            return None
+        connector = aiohttp.TCPConnector(
+            limit=current_app.config['SCRAPER_ASYNC_DOWNLOADS'],
+            force_close=not current_app.config['HTTP_KEEP_ALIVE']
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    def get_thread_scraper(self, thread_data):
+        """AsyncThreadScraper factory."""
+        return AsyncThreadScraper(self.board, thread_data,
+                                  session=self.session,
+                                  download_queue=self.download_queue,
+                                  **self.get_shared_objects())
+
+    def add_to_queue(self, queue, item):
+        """Adds the item returned by get_queue_item to the queue."""
+        queue.put_nowait(item)
+
+    async def queue_retried_files_async(self, download_queue):
+        """Coroutine version of queue_retried_files."""
+        for task in self.retry_queue.get_files():
+            self.stats.add('retried_files', 1)
+            await download_queue.put(task)
+
+    async def worker(self, queue):
+        """Coroutine processing the threads from the queue until it gets
+        None.
+        """
+        while True:
+            priority, thread_data = await queue.get()
+            if thread_data is None:
+                return
+            if self.is_out_of_time():
+                self.on_thread_skipped()
+                continue
+
+            thread_scraper = self.get_thread_scraper(thread_data)
+            try:
+                await thread_scraper.handle_thread_async()
+            except Exception as e:
+                db.session.rollback()
+                sys.stderr.write('%s\n' % e)
+            finally:
+                self.on_thread_scraper_done(thread_scraper)
+
+    async def process_catalog_async(self, response):
+        """Process all threads present in the catalog. Threads are queued
+        once the catalog is parsed and processed in the order of their
+        priority. Threads and files from the retry queue are processed first.
+        If the response is None only the retry queue is processed.
+        """
+        queue = asyncio.PriorityQueue()
+
+        # Files are downloaded concurrently with the threads. Thread scrapers
+        # wait if the queue is full.
+        self.download_queue = asyncio.Queue(
+            maxsize=current_app.config['SCRAPER_DOWNLOAD_QUEUE_SIZE']
+        )
+        downloaders = [
+            asyncio.ensure_future(self.download_worker())
+            for i in range(current_app.config['SCRAPER_ASYNC_DOWNLOADS'])
+        ]
+
+        # Populate queue.
+        await self.queue_retried_files_async(self.download_queue)
+        thread_numbers = []
+        catalog = []
+        catalog_error = None
+        try:
+            if response is not None:
+                async for page, thread_json in \
+                        self.catalog_generator_async(response):
+                    self.add_to_catalog(catalog, thread_json, page)
+        except Exception as e:
+            catalog_error = e
+        items = self.prioritize_catalog(catalog, catalog_error, thread_numbers)
+        if catalog_error is None:
+            archived = []
+            if response is not None:
+                archived = await self.get_archived_threads_async(
+                    thread_numbers)
+            items.extend(self.get_archived_queue_item(number)
+                         for number in archived)
+            items.extend(self.get_retried_queue_item(number) for number
+                         in self.get_retried_threads(thread_numbers
+                                                     + archived))
+        self.queue_items(queue, items)
+
+        # Process all threads. Workers start once all threads are queued so
+        # they take them in the order of their priority. They stop once they
+        # get None, it is queued with a priority lower than the priority of
+        # any thread.
+        workers = [asyncio.ensure_future(self.worker(queue))
+                   for i in range(self.workers_number)]
+        for i in range(len(workers)):
+            queue.put_nowait(((2, i), None))
+        await asyncio.gather(*workers)
+
+        # Wait for the files.
+        await self.download_queue.join()
+        for downloader in downloaders:
+            downloader.cancel()
+
+        if catalog_error is not None:
+            raise ScrapError('Unable to download or parse the catalog data '
+                             '(%s). Board update stopped.' % catalog_error)
+        if response is None:
+            self.on_retries_processed()
+        else:
+            self.on_catalog_processed(thread_numbers)
+
+    async def fetch_image(self, task):
+        """Download an image. Returns the path relative to MEDIA_ROOT."""
+        url = self.get_image_url(task)
+        file_writer = FileWriter(
+            'post_images',
+            '%s%s' % (get_post_files_name(task), task.extension),
+            size=task.size,
+            md5=task.md5
+        )
+        await self.queuer.file_wait()
+        self.stats.add('downloaded_images', 1)
+        return await self.fetch_file(url, file_writer)
+
+    async def fetch_thumbnail(self, task):
+        """Download a thumbnail. Returns the path relative to MEDIA_ROOT."""
+        url = self.get_thumbnail_url(task)
+        file_writer = FileWriter('post_thumbnails',
+                                 '%s.jpg' % get_post_files_name(task))
+        await self.queuer.file_wait()
+        self.stats.add('downloaded_thumbnails', 1)
+        return await self.fetch_file(url, file_writer)
+
+    async def download_post_files_async(self, task):
+        """Coroutine version of download_post_files."""
+        if reuse_post_files(task):
+            self.stats.add('reused_files', 1)
+            return
+        paths = {'image': await self.fetch_image(task)}
+        try:
+            paths['thumbnail'] = await self.fetch_thumbnail(task)
+        except:
+            remove_post_files(task, paths)
+            raise
+        save_post_files(task, paths)
+
+    async def download_worker(self):
+        """Coroutine downloading the files attached to the posts until it is
+        cancelled.
+        """
+        while True:
+            task = await self.download_queue.get()
+            try:
+                await self.download_post_files_async(task)
+            except Exception as e:
+                self.on_download_error(task, e)
+            else:
+                self.on_download_done(task)
+            finally:
+                self.download_queue.task_done()
+
+    async def update_async(self):
+        """Coroutine updating the database."""
+        self.session = self.create_session()
+        try:
+            self.load_validators()
+            self.load_retry_queue()
+
+            # Get catalog.
+            try:
+                response = await self.fetch_catalog()
+            except:
+                raise ScrapError('Unable to download or parse the catalog '
+                                 'data. Board update stopped.')
+
+            # Nothing changed since the last update if the catalog was not
+            # modified, only the retry queue is processed.
+            if response is not None or self.has_retries():
+                self.load_thread_index()
+                db.session.commit()
+                self.start_time_budget()
+                await self.process_catalog_async(response)
+
+        except:
+            self.discard_state()
+            raise
+
+        finally:
+            if self.session is not None:
+                await self.session.close()
+            self.close_pools()
+
+    def update(self):
+        """Call this to update the database."""
+        asyncio.run(self.update_async())
+        self.save_wait_time()
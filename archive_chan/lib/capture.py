@@ -0,0 +1,194 @@
+"""
+    Record and replay of the HTTP responses received by the scraper. A
+    capture stores every API and file response of a real run in a single
+    SQLite file, bodies are compressed and indexed by the url. Replaying it
+    feeds the same responses back to the scrapers without accessing the
+    network, which makes it possible to profile the ingest path on real data
+    and reproduce the problems with specific threads.
+
+    Responses to the same url are replayed in the order in which they were
+    recorded so replaying a capture of a few updates performs the same
+    updates again. The last response is repeated once they run out.
+"""
+
+
+import collections
+import json
+import sqlite3
+import threading
+import zlib
+import requests
+from requests.structures import CaseInsensitiveDict
+from .connection import ConnectionPool
+
+
+class Capture(object):
+    """File with the recorded responses.
+
+    path: path of the file, it is created if it doesn't exist.
+    """
+
+    # Recorded response headers.
+    headers = ('Content-Type', 'ETag', 'Last-Modified')
+
+    # Number of responses added in a single transaction.
+    commit_interval = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS response ('
+            'id INTEGER PRIMARY KEY, '
+            'url TEXT NOT NULL, '
+            'status INTEGER NOT NULL, '
+            'headers TEXT NOT NULL, '
+            'body BLOB NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS response_url ON response (url, id)'
+        )
+        self.uncommitted = 0
+        self.lock = threading.Lock()
+
+    def add(self, url, status, headers, body):
+        """Store the response."""
+        headers = {name: headers[name] for name in self.headers
+                   if headers.get(name) is not None}
+        row = (url, status, json.dumps(headers), zlib.compress(body))
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO response (url, status, headers, body) '
+                'VALUES (?, ?, ?, ?)', row
+            )
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_interval:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def get_responses(self, url):
+        """Returns the list of the tuples (id, status, headers) describing
+        the responses recorded for the url in the order of recording.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, status, headers FROM response WHERE url = ? '
+                'ORDER BY id', (url,)
+            ).fetchall()
+        return [(id, status, json.loads(headers))
+                for id, status, headers in rows]
+
+    def get_body(self, id):
+        """Returns the body of the response."""
+        with self.lock:
+            body, = self.connection.execute(
+                'SELECT body FROM response WHERE id = ?', (id,)
+            ).fetchone()
+        return zlib.decompress(body)
+
+    def get_boards(self):
+        """Returns the names of the boards whose thread lists were
+        recorded.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT url FROM response "
+                "WHERE url LIKE '%/catalog.json' OR url LIKE '%/threads.json'"
+            ).fetchall()
+        return sorted({url.split('/')[-2] for url, in rows})
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+
+def create_response(url, status, headers, body):
+    """Returns requests.Response with the already downloaded body."""
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    response._content_consumed = True
+    return response
+
+
+class RecordingConnectionPool(ConnectionPool):
+    """Connection pool which stores all received responses in the capture.
+    Streamed responses are read entirely before they are returned.
+    """
+
+    # The asyncio engine must not bypass the pool with its own sessions.
+    allows_sessions = False
+
+    def __init__(self, capture):
+        super().__init__()
+        self.capture = capture
+
+    def get(self, url, **kwargs):
+        response = super().get(url, **kwargs)
+        self.capture.add(url, response.status_code, response.headers,
+                         response.content)
+        return response
+
+
+class ReplayConnectionPool(ConnectionPool):
+    """Connection pool which returns the responses from the capture instead
+    of performing the requests. Conditional requests are answered with
+    304 Not Modified if the validators match the replayed response. Urls
+    which were not recorded are answered with 404 Not Found.
+    """
+
+    allows_sessions = False
+
+    def __init__(self, capture):
+        super().__init__()
+        self.capture = capture
+        self.positions = collections.Counter()
+        # Number of the replayed responses.
+        self.requests = 0
+
+    def get_full_response(self, responses, position):
+        """Returns the recorded response with the body which is the closest
+        to the position. Used to answer the unconditional requests which
+        were answered with 304 Not Modified during the recording.
+        """
+        candidates = sorted(range(len(responses)),
+                            key=lambda i: (abs(i - position), -i))
+        for i in candidates:
+            if responses[i][1] != 304:
+                return responses[i]
+        return responses[position]
+
+    def is_not_modified(self, request_headers, response_headers):
+        """True if the validators sent with the request match the
+        response.
+        """
+        if not request_headers:
+            return False
+        etag = request_headers.get('If-None-Match')
+        if etag:
+            return etag == response_headers.get('ETag')
+        last_modified = request_headers.get('If-Modified-Since')
+        return bool(last_modified) \
+               and last_modified == response_headers.get('Last-Modified')
+
+    def get(self, url, headers=None, **kwargs):
+        responses = self.capture.get_responses(url)
+        with self.lock:
+            self.requests += 1
+            position = min(self.positions[url], len(responses) - 1)
+            self.positions[url] += 1
+        if not responses:
+            return create_response(url, 404, {}, b'')
+
+        id, status, response_headers = responses[position]
+        if status == 304 and not self.is_not_modified(headers,
+                                                      response_headers):
+            id, status, response_headers = self.get_full_response(responses,
+                                                                  position)
+        if status == 200 and self.is_not_modified(headers, response_headers):
+            return create_response(url, 304, response_headers, b'')
+        body = self.capture.get_body(id) if status != 304 else b''
+        return create_response(url, status, response_headers, body)
@@ -0,0 +1,218 @@
+"""
+    Implements the HTTP connection pool used by the scrapers. Without it each
+    request would open a new TCP connection and perform a new TLS handshake
+    which takes more time than downloading a small thumbnail.
+
+    Transient errors (connection errors, timeouts and server errors) are
+    retried with a randomized exponential backoff. Each host has a circuit
+    breaker: after a number of consecutive failures the requests to that host
+    fail immediately for a while instead of waiting for the timeouts.
+"""
+
+
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+
+
+class HostUnavailable(requests.exceptions.ConnectionError):
+    """Raised without performing the request if the circuit breaker of the
+    host is open.
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """Tracks the failures of the requests sent to a single host. After
+    threshold consecutive failures the breaker opens and no requests are
+    allowed for reset_timeout seconds. After that a single trial request is
+    allowed, the breaker closes if it succeeds and opens again otherwise.
+
+    threshold: number of consecutive failures which open the breaker. 0
+               disables the breaker.
+    reset_timeout: time for which the breaker stays open [seconds].
+    clock: function returning the current monotonic time in seconds.
+    """
+
+    def __init__(self, threshold, reset_timeout, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+
+        self.failures = 0
+        # Time at which the breaker opened or None if it is closed.
+        self.opened_at = None
+        self.trial_pending = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """True if a request can be performed."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_pending \
+                    or self.clock() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial_pending = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_pending = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_pending or (self.threshold
+                                      and self.failures >= self.threshold):
+                self.opened_at = self.clock()
+            self.trial_pending = False
+
+    def release(self):
+        """Give up the trial request without recording its result. Used if
+        the request was interrupted, which says nothing about the host.
+        """
+        with self.lock:
+            self.trial_pending = False
+
+
+class ConnectionPool(object):
+    """Keeps a separate requests session with a pool of persistent connections
+    for each host (API, images, thumbnails). One instance is created by the
+    BoardScraper and shared by all its workers. Sessions are used only to
+    perform GET requests without cookies so sharing them between the threads
+    is safe, urllib3 pools are thread safe.
+    """
+
+    # Server errors which are retried.
+    retry_statuses = (500, 502, 503, 504)
+
+    # Exceptions which are retried, including the connections reset while
+    # the body is being read.
+    retry_exceptions = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        requests.exceptions.ContentDecodingError,
+    )
+
+    # False if all requests must go through the get method, the asyncio
+    # engine uses its own aiohttp session otherwise.
+    allows_sessions = True
+
+    def __init__(self):
+        self.pool_size = current_app.config['HTTP_POOL_SIZE']
+        self.keep_alive = current_app.config['HTTP_KEEP_ALIVE']
+        self.retries = current_app.config['HTTP_RETRIES']
+        self.retry_backoff = current_app.config['HTTP_RETRY_BACKOFF']
+        self.max_retry_backoff = current_app.config['HTTP_RETRY_MAX_BACKOFF']
+        self.breaker_threshold = current_app.config['HTTP_BREAKER_THRESHOLD']
+        self.breaker_timeout = current_app.config['HTTP_BREAKER_TIMEOUT']
+
+        self.sessions = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get_backoff(self, attempt):
+        """Returns the delay before the next attempt [seconds]. The limit
+        grows exponentially and the delay is picked randomly below it so the
+        workers which failed at the same time don't retry at the same time.
+
+        attempt: number of the failed attempt starting from 0.
+        """
+        limit = min(self.retry_backoff * 2 ** attempt, self.max_retry_backoff)
+        return random.uniform(0, limit)
+
+    def should_retry(self, status_code):
+        """True if the response with this status is a transient error."""
+        return status_code in self.retry_statuses
+
+    def create_session(self):
+        """Creates a new session with a mounted pooled adapter. Retries are
+        performed by the pool, not by the adapter.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=0,
+            pool_block=True
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def get_session(self, url):
+        """Returns the session used to access the host of the url."""
+        host = urlparse(url).netloc
+        with self.lock:
+            if not host in self.sessions:
+                self.sessions[host] = self.create_session()
+            return self.sessions[host]
+
+    def get_breaker(self, url):
+        """Returns the circuit breaker of the host of the url. Breakers are
+        kept when the pool is closed.
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            if not host in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.breaker_threshold,
+                                                     self.breaker_timeout)
+            return self.breakers[host]
+
+    def get(self, url, wait=None, **kwargs):
+        """Perform a GET request. Accepts the same arguments as requests.get.
+        Raises HostUnavailable if the host failed too many times recently.
+        Server errors are returned once the retries are exhausted.
+
+        wait: function called before each retry, used to take a slot from the
+              rate limiter. The caller waits before the first attempt.
+        """
+        breaker = self.get_breaker(url)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise HostUnavailable('Host of %s is unavailable.' % url)
+            try:
+                response = self.get_session(url).get(url, **kwargs)
+            except self.retry_exceptions:
+                breaker.record_failure()
+                if attempt >= self.retries:
+                    raise
+            except Exception:
+                # Every failed attempt is recorded, otherwise a failed trial
+                # request would leave the breaker open for good.
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # Interrupted, see CircuitBreaker.release.
+                breaker.release()
+                raise
+            else:
+                if not self.should_retry(response.status_code):
+                    breaker.record_success()
+                    return response
+                breaker.record_failure()
+                if attempt >= self.retries:
+                    return response
+                response.close()
+            time.sleep(self.get_backoff(attempt))
+            if wait is not None:
+                wait()
+            attempt += 1
+
+    def close(self):
+        """Close all open connections."""
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
@@ -0,0 +1,491 @@
+"""
+    Local stand-in for the 4chan API and the image servers. It serves
+    synthetic catalogs, thread lists, archives, thread data, images and
+    thumbnails so the scraper can be benchmarked without accessing the real
+    API. Boards are generated randomly from a seed and change only when
+    advance is called, which makes the scenarios repeatable.
+
+    All hosts are served by a single server under different prefixes, point
+    the scraper at it with the following settings:
+
+    API_URL = 'http://127.0.0.1:8000/a'
+    IMAGES_URL = 'http://127.0.0.1:8000/i'
+    THUMBNAILS_URL = 'http://127.0.0.1:8000/t'
+
+    The server also accepts the following control requests:
+
+    POST /_advance?posts=N - add N posts to each board
+    GET /_stats - JSON with the numbers of the served requests
+"""
+
+
+import base64
+import collections
+import email.utils
+import hashlib
+import json
+import multiprocessing
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import requests
+
+
+def get_file_content(tim, size):
+    """Returns the content of the fake file. It is unique for each file."""
+    block = hashlib.sha256(str(tim).encode()).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+class FakeThread:
+    """Thread of a fake board."""
+
+    def __init__(self, op):
+        self.number = op['no']
+        self.posts = [op]
+        self.last_modified = op['time']
+        self.archived = False
+        # Changes each time the thread is modified, used to create ETags.
+        self.version = 0
+        self.content = None
+
+    @property
+    def replies(self):
+        return len(self.posts) - 1
+
+    @property
+    def images(self):
+        return sum(1 for post in self.posts[1:] if 'tim' in post)
+
+    def modify(self, now):
+        self.last_modified = max(now, self.last_modified)
+        self.version += 1
+        self.content = None
+
+    def get_etag(self):
+        return '"%s-%s"' % (self.number, self.version)
+
+    def get_content(self):
+        """Returns the encoded thread data."""
+        if self.content is None:
+            posts = [dict(post) for post in self.posts]
+            if self.archived:
+                posts[0]['archived'] = 1
+                posts[0]['archived_on'] = self.last_modified
+            self.content = json.dumps({'posts': posts}).encode()
+        return self.content
+
+
+class FakeBoard:
+    """Board with randomly generated threads and posts. Threads are kept in
+    the order of their last bump, threads which fall off the last page are
+    moved to the archive.
+
+    name: name of the board.
+    rand: random.Random object used to generate the data.
+    threads: number of active threads.
+    replies: average number of replies in the initial threads.
+    threads_per_page: number of threads on a single catalog page.
+    file_ratio: fraction of the posts with an attached file.
+    file_size: size of the images (bytes).
+    new_thread_ratio: fraction of the new posts which start a new thread.
+    delete_ratio: number of the deleted replies per new post.
+    bump_limit: number of replies after which the thread is not bumped.
+    """
+
+    # Size of the thumbnails (bytes).
+    thumbnail_size = 2 * 1024
+
+    # Max number of the threads kept in the archive.
+    archive_size = 3000
+
+    words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+             'eiusmod tempor incididunt ut labore et dolore magna aliqua ut '
+             'enim ad minim veniam quis nostrud exercitation ullamco laboris '
+             'nisi aliquip ex ea commodo consequat').split()
+
+    def __init__(self, name, rand, threads=150, replies=50,
+                 threads_per_page=15, file_ratio=0.5, file_size=16 * 1024,
+                 new_thread_ratio=0.02, delete_ratio=0.01, bump_limit=300):
+        self.name = name
+        self.rand = rand
+        self.max_threads = threads
+        self.threads_per_page = threads_per_page
+        self.file_ratio = file_ratio
+        self.file_size = file_size
+        self.new_thread_ratio = new_thread_ratio
+        self.delete_ratio = delete_ratio
+        self.bump_limit = bump_limit
+
+        self.threads = collections.OrderedDict()
+        self.archive = collections.OrderedDict()
+        self.next_number = 10 ** 7
+        self.last_time = 0
+        self.version = 0
+        self.catalog = None
+        self.thread_list = None
+
+        # Initial posts are spread over the last hours, a post every second.
+        now = int(time.time())
+        total = threads * (replies + 1)
+        post_time = now - total
+        for i in range(threads):
+            thread = self.add_thread(post_time)
+            post_time += 1
+            for j in range(self.rand.randint(0, 2 * replies)):
+                self.add_reply(thread, min(post_time, now))
+                post_time += 1
+
+    def create_post(self, now, thread=None):
+        """Returns the data of a new post, see the 4chan API."""
+        post = {
+            'no': self.next_number,
+            'resto': thread.number if thread is not None else 0,
+            'time': now,
+            'name': 'Anonymous',
+            'com': ' '.join(self.rand.choice(self.words)
+                            for i in range(self.rand.randint(5, 40))),
+        }
+        self.next_number += 1
+        self.last_time = max(self.last_time, now)
+        if thread is None:
+            post['sub'] = ' '.join(self.rand.sample(self.words, 3))
+        elif self.rand.random() < 0.3:
+            quoted = self.rand.choice(thread.posts)['no']
+            post['com'] = '<a href="#p%s" class="quotelink">&gt;&gt;%s</a>' \
+                          '<br>%s' % (quoted, quoted, post['com'])
+        if thread is None or self.rand.random() < self.file_ratio:
+            tim = post['no'] * 1000
+            content = get_file_content(tim, self.file_size)
+            post.update({
+                'tim': tim,
+                'ext': '.jpg',
+                'filename': 'file%s' % post['no'],
+                'fsize': self.file_size,
+                'md5': base64.b64encode(hashlib.md5(content).digest())
+                             .decode(),
+                'w': 1000,
+                'h': 1000,
+                'tn_w': 250,
+                'tn_h': 250,
+            })
+        return post
+
+    def modify(self):
+        self.version += 1
+        self.catalog = None
+        self.thread_list = None
+
+    def add_thread(self, now):
+        thread = FakeThread(self.create_post(now))
+        self.threads[thread.number] = thread
+        self.threads.move_to_end(thread.number, last=False)
+        self.prune()
+        self.modify()
+        return thread
+
+    def add_reply(self, thread, now):
+        thread.posts.append(self.create_post(now, thread))
+        thread.modify(now)
+        if thread.replies < self.bump_limit:
+            self.threads.move_to_end(thread.number, last=False)
+        self.modify()
+
+    def delete_reply(self, thread, now):
+        if thread.replies > 0:
+            thread.posts.pop(self.rand.randint(1, thread.replies))
+            thread.modify(now)
+            self.modify()
+
+    def prune(self):
+        """Move the threads which fell off the last page to the archive."""
+        while len(self.threads) > self.max_threads:
+            number, thread = self.threads.popitem()
+            thread.archived = True
+            thread.modify(thread.last_modified)
+            self.archive[number] = thread
+        while len(self.archive) > self.archive_size:
+            self.archive.popitem(last=False)
+
+    def advance(self, posts, now=None):
+        """Add the posts to the board and delete some of the replies. The
+        time of the changes is at least a second after the previous ones
+        since the API reports the modification times in seconds.
+        """
+        now = max(now or int(time.time()), self.last_time + 1)
+        for i in range(posts):
+            if not self.threads or self.rand.random() < self.new_thread_ratio:
+                self.add_thread(now)
+            else:
+                number = self.rand.choice(list(self.threads))
+                self.add_reply(self.threads[number], now)
+        for i in range(int(posts * self.delete_ratio)):
+            if self.threads:
+                number = self.rand.choice(list(self.threads))
+                self.delete_reply(self.threads[number], now)
+
+    def get_etag(self):
+        return '"%s-%s"' % (self.name, self.version)
+
+    def get_last_modified(self):
+        return max((thread.last_modified for thread in self.threads.values()),
+                   default=0)
+
+    def get_pages(self, get_entry):
+        threads = list(self.threads.values())
+        return [{
+            'page': i // self.threads_per_page + 1,
+            'threads': [get_entry(thread) for thread
+                        in threads[i:i + self.threads_per_page]],
+        } for i in range(0, len(threads), self.threads_per_page)]
+
+    def get_catalog_entry(self, thread):
+        entry = dict(thread.posts[0])
+        entry.update({
+            'replies': thread.replies,
+            'images': thread.images,
+            'last_modified': thread.last_modified,
+        })
+        if thread.replies >= self.bump_limit:
+            entry['bumplimit'] = 1
+        if thread.replies > 0:
+            entry['last_replies'] = thread.posts[-5:]
+        return entry
+
+    def get_catalog(self):
+        """Returns the encoded catalog.json."""
+        if self.catalog is None:
+            self.catalog = json.dumps(
+                self.get_pages(self.get_catalog_entry)).encode()
+        return self.catalog
+
+    def get_thread_list(self):
+        """Returns the encoded threads.json."""
+        if self.thread_list is None:
+            self.thread_list = json.dumps(self.get_pages(lambda thread: {
+                'no': thread.number,
+                'last_modified': thread.last_modified,
+                'replies': thread.replies,
+            })).encode()
+        return self.thread_list
+
+    def get_archive(self):
+        """Returns the encoded archive.json."""
+        return json.dumps(list(self.archive)).encode()
+
+    def get_thread(self, number):
+        """Returns the thread or None if it doesn't exist."""
+        return self.threads.get(number) or self.archive.get(number)
+
+
+# Response of the fake server.
+Response = collections.namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class FakeChan:
+    """State of the fake server shared by the request handlers.
+
+    boards: names of the boards.
+    seed: seed of the generated data.
+    latency: delay of each response [seconds].
+    error_rate: fraction of the requests answered with 500.
+    **kwargs: passed to FakeBoard.
+    """
+
+    def __init__(self, boards=('g',), seed=0, latency=0, error_rate=0,
+                 **kwargs):
+        self.rand = random.Random(seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.boards = {name: FakeBoard(name, self.rand, **kwargs)
+                       for name in boards}
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+
+    def advance(self, posts):
+        """Add the posts to each board."""
+        with self.lock:
+            for board in self.boards.values():
+                board.advance(posts)
+
+    def get_stats(self):
+        """Returns a dict with the numbers of the requests served by each host
+        ('a', 'i', 't'), the number of the errors and of the 304 responses.
+        """
+        with self.lock:
+            stats = dict(self.requests)
+        stats['total'] = sum(stats.get(host, 0) for host in 'ait')
+        return stats
+
+    def get_json_response(self, content, etag, last_modified, headers):
+        if headers.get('If-None-Match') == etag:
+            self.requests['not_modified'] += 1
+            return Response(304, {'ETag': etag}, b'')
+        return Response(200, {
+            'Content-Type': 'application/json',
+            'ETag': etag,
+            'Last-Modified': email.utils.formatdate(last_modified,
+                                                    usegmt=True),
+        }, content)
+
+    def get_response(self, path, headers):
+        """Returns the Response for the GET request."""
+        parts = path.strip('/').split('/')
+        if len(parts) < 3 or parts[0] not in ('a', 'i', 't') \
+                or parts[1] not in self.boards:
+            return Response(404, {}, b'')
+        host, board, name = parts[0], self.boards[parts[1]], parts[-1]
+
+        with self.lock:
+            self.requests[host] += 1
+            if self.error_rate and self.rand.random() < self.error_rate:
+                self.requests['errors'] += 1
+                return Response(500, {}, b'')
+
+            if host == 'a':
+                if name == 'catalog.json':
+                    return self.get_json_response(
+                        board.get_catalog(), board.get_etag(),
+                        board.get_last_modified(), headers)
+                if name == 'threads.json':
+                    return self.get_json_response(
+                        board.get_thread_list(), board.get_etag(),
+                        board.get_last_modified(), headers)
+                if name == 'archive.json':
+                    return Response(200, {'Content-Type': 'application/json'},
+                                    board.get_archive())
+                if parts[2] == 'thread' and name.endswith('.json'):
+                    try:
+                        thread = board.get_thread(int(name[:-5]))
+                    except ValueError:
+                        thread = None
+                    if thread is not None:
+                        return self.get_json_response(
+                            thread.get_content(), thread.get_etag(),
+                            thread.last_modified, headers)
+                return Response(404, {}, b'')
+
+        # Files are not tracked, any file with a valid name exists.
+        try:
+            if host == 'i':
+                tim = int(name.split('.')[0])
+                size = board.file_size
+            else:
+                tim = int(name[:-len('s.jpg')])
+                size = board.thumbnail_size
+        except ValueError:
+            return Response(404, {}, b'')
+        return Response(200, {'Content-Type': 'image/jpeg'},
+                        get_file_content(tim, size))
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Passes the requests to the FakeChan of the server."""
+
+    # Keep the connections open like the real servers. Headers and the body
+    # are written separately so Nagle's algorithm would delay the responses.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def send(self, response):
+        self.send_response(response.status)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response.body)))
+        self.end_headers()
+        self.wfile.write(response.body)
+
+    def do_GET(self):
+        chan = self.server.chan
+        url = urlparse(self.path)
+        if url.path == '/_stats':
+            body = json.dumps(chan.get_stats()).encode()
+            self.send(Response(200, {'Content-Type': 'application/json'},
+                               body))
+            return
+        if chan.latency:
+            time.sleep(chan.latency)
+        self.send(chan.get_response(url.path, self.headers))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/_advance':
+            self.send(Response(404, {}, b''))
+            return
+        posts = int(parse_qs(url.query).get('posts', ['0'])[0])
+        self.server.chan.advance(posts)
+        self.send(Response(200, {}, b''))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_server(chan, host='127.0.0.1', port=0):
+    """Returns the HTTP server serving the FakeChan. Port 0 picks a free
+    port, see server.server_address.
+    """
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.chan = chan
+    return server
+
+
+def run_server(connection, host, port, kwargs):
+    """Entry point of the server process. Sends the port through the
+    connection and serves until the process is terminated.
+    """
+    server = create_server(FakeChan(**kwargs), host, port)
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeServer:
+    """Runs the fake server in a separate process so serving the requests
+    doesn't compete with the benchmarked scraper for the interpreter.
+
+    **kwargs: passed to FakeChan.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        self.host = host
+        self.port = port
+        self.kwargs = kwargs
+        self.process = None
+        self.url = None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        parent_connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=run_server,
+            args=(child_connection, self.host, self.port, self.kwargs),
+            daemon=True
+        )
+        self.process.start()
+        self.port = parent_connection.recv()
+        self.url = 'http://%s:%s' % (self.host, self.port)
+
+    def get_settings(self):
+        """Returns the settings pointing the scraper at the server."""
+        return {
+            'API_URL': self.url + '/a',
+            'IMAGES_URL': self.url + '/i',
+            'THUMBNAILS_URL': self.url + '/t',
+        }
+
+    def advance(self, posts):
+        """Add the posts to each board."""
+        requests.post(self.url + '/_advance',
+                      params={'posts': posts}).raise_for_status()
+
+    def get_stats(self):
+        """See FakeChan.get_stats."""
+        return requests.get(self.url + '/_stats').json()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
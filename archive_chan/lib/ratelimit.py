@@ -0,0 +1,50 @@
+"""
+    Implements the rate limiter used by the scrapers to follow the API rules.
+    Waiting threads don't hold any locks while sleeping, instead each request
+    reserves a time slot and sleeps until it arrives. Because of that the same
+    limiter can be used by the threads and the coroutines.
+"""
+
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Token bucket refilled with one token every interval seconds which holds
+    up to burst tokens. Each request takes one token. Slots are reserved in
+    the order in which the requests arrive, so the requests are served in FIFO
+    order and no request can be starved by the others.
+
+    interval: time between two requests once the burst is used up [seconds].
+    burst: number of requests which can be performed at once after a period
+           of inactivity.
+    clock: function returning the current monotonic time in seconds.
+    """
+
+    def __init__(self, interval, burst=1, clock=time.monotonic):
+        self.interval = interval
+        self.burst = max(burst, 1)
+        self.clock = clock
+
+        # Time at which the next slot becomes available if the bucket is
+        # empty.
+        self.next_slot = None
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Reserve a slot for a single request. Returns the number of seconds
+        for which the caller has to wait before performing the request.
+        """
+        if self.interval <= 0:
+            return 0
+        with self.lock:
+            now = self.clock()
+            # Slots which were not used accumulate up to the size of the burst.
+            earliest = now - (self.burst - 1) * self.interval
+            if self.next_slot is None or self.next_slot < earliest:
+                slot = earliest
+            else:
+                slot = self.next_slot
+            self.next_slot = slot + self.interval
+            return max(slot - now, 0)
@@ -1,57 +1,379 @@
+import base64
+import codecs
+import collections
 import datetime
+import email.utils
+import functools
+import hashlib
 import html
-import io
-from queue import Queue
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue, PriorityQueue
 import re
-import requests
 import sys
 import threading
 import time
+import uuid
 import pytz
 from flask import current_app
-from sqlalchemy.orm.attributes import instance_state
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
-from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
 from ..database import db
-from .helpers import timestamp_to_datetime
+from .connection import ConnectionPool
+from .helpers import timestamp_to_datetime, utc_now
+from .ratelimit import TokenBucket
 from ..models import Board, Thread, Post, Image, Trigger, TagToThread, Update, \
-    Tag
+    Tag, CacheValidator, File, RetryTask
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 
 class ScrapError(Exception):
     pass
 
 
+class NotFound(ScrapError):
+    """Raised if the server responded with 404 Not Found. Requests which
+    failed this way are not retried.
+    """
+    pass
+
+
+class CatalogParser:
+    """Parses the catalog incrementally. Chunks of the data are fed as they
+    are downloaded and the objects describing the threads are returned
+    together with the number of the page as soon as they are complete, so the
+    raw catalog is never kept in memory. The BoardScraper keeps only the
+    compact ThreadData of each thread until the catalog is parsed.
+    Only the structure of the catalog is parsed here, the values themselves
+    are decoded using the json module.
+    """
+
+    whitespace = ' \t\n\r'
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.state = 'start'
+        self.finished = False
+        self.key = None
+        self.page = None
+
+    def feed(self, chunk):
+        """Parse the next chunk of the data. Returns a list of tuples (page,
+        thread object) for the threads which were completed.
+        """
+        self.buffer = self.buffer[self.position:] \
+                    + self.text_decoder.decode(chunk)
+        self.position = 0
+        return self.parse()
+
+    def close(self):
+        """Call after all data was fed. Returns a list of the remaining
+        threads. Raises ValueError if the catalog is incomplete or malformed.
+        """
+        self.buffer = self.buffer[self.position:] \
+                    + self.text_decoder.decode(b'', final=True)
+        self.position = 0
+        self.finished = True
+        threads = self.parse()
+        if self.state != 'end':
+            raise ValueError('Catalog data is incomplete.')
+        return threads
+
+    def next_character(self):
+        """Skip the whitespace and return the next character or None if more
+        data is needed.
+        """
+        while self.position < len(self.buffer):
+            character = self.buffer[self.position]
+            if not character in self.whitespace:
+                return character
+            self.position += 1
+        return None
+
+    def decode_value(self):
+        """Decode the value starting at the current position. Returns a tuple
+        (True, value) or (False, None) if more data is needed.
+        """
+        try:
+            value, end = self.decoder.raw_decode(self.buffer, self.position)
+        except ValueError:
+            if self.finished:
+                raise
+            return False, None
+        # Numbers and literals might continue in the next chunk.
+        if end == len(self.buffer) and not self.finished:
+            return False, None
+        self.position = end
+        return True, value
+
+    def parse(self):
+        threads = []
+        while True:
+            character = self.next_character()
+            if character is None:
+                return threads
+
+            if self.state == 'start':
+                self.expect(character, '[')
+                self.state = 'pages'
+
+            elif self.state == 'pages':
+                if character == ']':
+                    self.state = 'end'
+                elif character == '{':
+                    self.state = 'page'
+                else:
+                    self.expect(character, ',')
+                    continue
+                self.position += 1
+
+            elif self.state == 'page':
+                if character == '}':
+                    self.state = 'pages'
+                    self.position += 1
+                elif character == ',':
+                    self.position += 1
+                else:
+                    complete, self.key = self.decode_value()
+                    if not complete:
+                        return threads
+                    self.state = 'threads_key' if self.key == 'threads' \
+                                 else 'value_key'
+
+            elif self.state in ('threads_key', 'value_key'):
+                self.expect(character, ':')
+                self.state = 'threads_start' if self.state == 'threads_key' \
+                             else 'value'
+
+            elif self.state == 'value':
+                complete, value = self.decode_value()
+                if not complete:
+                    return threads
+                if self.key == 'page':
+                    self.page = value
+                self.state = 'page'
+
+            elif self.state == 'threads_start':
+                self.expect(character, '[')
+                self.state = 'threads'
+
+            elif self.state == 'threads':
+                if character == ']':
+                    self.position += 1
+                    self.state = 'page'
+                elif character == ',':
+                    self.position += 1
+                else:
+                    complete, thread = self.decode_value()
+                    if not complete:
+                        return threads
+                    threads.append((self.page, thread))
+
+            else:
+                raise ValueError('Unexpected data after the catalog.')
+
+    def expect(self, character, expected):
+        """Consume the expected character."""
+        if character != expected:
+            raise ValueError('Expected "%s" in the catalog data, got "%s".'
+                             % (expected, character))
+        self.position += 1
+
+
 class ThreadData:
-    """Class used for storing information about the thread."""
+    """Class used for storing information about the thread. It can be
+    created using the entries of catalog.json or the shorter entries of
+    threads.json which contain only the number, the number of replies and the
+    time of the last modification.
+    """
 
-    def __init__(self, thread_json):
-        self.number = int(thread_json['no'])
+    __slots__ = ('number', 'created', 'last_reply_time', 'last_modified',
+                 'replies', 'page', 'limit_reached', 'urgent', 'archived',
+                 'retried', 'matched')
 
-        # Get the time of the last reply or thread creation time.
+    def __init__(self, thread_json, page=None):
+        """page: number of the catalog page on which the thread is located."""
+        self.number = int(thread_json['no'])
+        self.page = page
+        self.created = None
+        if 'time' in thread_json:
+            self.created = timestamp_to_datetime(int(thread_json['time']))
+
+        # Changes when the posts are added, modified or deleted.
+        self.last_modified = None
+        if thread_json.get('last_modified'):
+            self.last_modified = timestamp_to_datetime(
+                int(thread_json['last_modified']))
+
+        # Set by the BoardScraper if the thread is likely to disappear soon.
+        self.urgent = False
+
+        # Set for the threads which were moved to the archive, those are
+        # downloaded one last time.
+        self.archived = False
+
+        # Set for the threads which failed during one of the previous
+        # updates and are not present in the catalog.
+        self.retried = False
+
+        # Set by the BoardScraper if the first post is matched by the
+        # triggers saving the thread or adding a tag to it.
+        self.matched = False
+
+        # Threads which reached the bump or image limit will soon be pruned.
+        self.limit_reached = bool(thread_json.get('bumplimit')
+                                  or thread_json.get('imagelimit'))
+
+        # Get the time of the last reply, thread creation time or the time of
+        # the last modification.
         if 'last_replies' in thread_json and len(thread_json['last_replies']) > 0:
-            last_reply_time = int(thread_json['last_replies'][-1]['time'])
+            self.last_reply_time = timestamp_to_datetime(
+                int(thread_json['last_replies'][-1]['time']))
         else:
-            last_reply_time = int(thread_json['time'])
-        self.last_reply_time = timestamp_to_datetime(last_reply_time)
+            self.last_reply_time = self.created or self.last_modified
 
         # 4chan doesn't count the first post.
         self.replies = int(thread_json['replies'])
 
+    @classmethod
+    def for_archived_thread(cls, number):
+        """Returns ThreadData for the thread which was archived since the
+        last update.
+        """
+        thread_data = cls({'no': number, 'replies': 0})
+        thread_data.archived = True
+        thread_data.urgent = True
+        return thread_data
+
+    @classmethod
+    def for_retried_thread(cls, number):
+        """Returns ThreadData for the thread which failed during one of the
+        previous updates and is not present in the catalog.
+        """
+        thread_data = cls({'no': number, 'replies': 0})
+        thread_data.retried = True
+        thread_data.urgent = True
+        return thread_data
+
+    def get_reply_rate(self):
+        """Average number of replies per second since the thread was
+        created. Returns None if the creation time is not known.
+        """
+        if self.created is None or self.last_reply_time is None:
+            return None
+        lifetime = (self.last_reply_time - self.created).total_seconds()
+        return self.replies / max(lifetime, 1)
+
 
 class PostData:
     """Class used for storing information about the post."""
 
+    __slots__ = ('number', 'time', 'name', 'trip', 'email', 'country',
+                 'subject', 'comment', 'filename', 'extension',
+                 'original_filename', 'md5', 'size')
+
+    # Markup removed by replace_content.
+    markup_re = re.compile(r'<(/?)(a|span|pre|br|wbr)([^>]*)>')
+
+    entities = (
+        ('&gt;', '>'),
+        ('&lt;', '<'),
+        ('&quot;', '"'),
+        ('&#039;', "'"),
+    )
+
+    quotelink_re = re.compile(r'\<a.*?class="quotelink".*?\>(.*?)\</a\>')
+    span_re = re.compile(r'\<span.*?\>(.*?)\</span\>')
+    pre_re = re.compile(r'\<pre.*?\>(.*?)\</pre\>')
+
     def replace_content(self, text):
-        """Cleans the HTML from the post comment. Returns a string."""
+        """Cleans the HTML from the post comment. Returns a string.
+
+        The markup is removed in a single scan. Unusual markup for which the
+        result could differ from the one of replace_content_regex is passed to
+        that method instead so the result is always the same.
+        """
+        if not '<' in text or '\n' in text:
+            return self.replace_content_regex(text)
+
+        output = []
+        inside = set()
+        position = 0
+        for match in self.markup_re.finditer(text):
+            output.append(text[position:match.start()])
+            position = match.end()
+            closing, name, rest = match.groups()
+
+            if name == 'br' or name == 'wbr':
+                if closing or rest:
+                    output.append(match.group())
+                elif name == 'br':
+                    output.append('\n')
+
+            elif closing:
+                if rest or not name in inside:
+                    output.append(match.group())
+                else:
+                    inside.remove(name)
+                    if name == 'pre':
+                        output.append('[/code]')
+
+            else:
+                # Nested tags and other links are handled differently by the
+                # regular expressions.
+                if name in inside \
+                   or (name == 'a' and not 'class="quotelink"' in rest):
+                    return self.replace_content_regex(text)
+                inside.add(name)
+                if name == 'pre':
+                    output.append('[code]')
+
+        # Tags which were not closed are not removed by the regular
+        # expressions.
+        if inside:
+            return self.replace_content_regex(text)
+
+        output.append(text[position:])
+        return self.unescape(''.join(output))
+
+    def unescape(self, text):
+        """Same as html.unescape but faster if the text contains only the
+        entities used by 4chan.
+        """
+        if not '&' in text:
+            return text
+        for entity, character in self.entities:
+            text = text.replace(entity, character)
+        # &amp; has to be replaced last so the created & characters don't
+        # form new entities.
+        if text.count('&') != text.count('&amp;'):
+            return html.unescape(text)
+        return text.replace('&amp;', '&')
+
+    def replace_content_regex(self, text):
+        """Cleans the HTML from the post comment using regular expressions.
+        Returns a string.
+        """
         # Remove >>quotes.
-        text = re.sub(r'\<a.*?class="quotelink".*?\>(.*?)\</a\>', r'\1', text)
+        text = self.quotelink_re.sub(r'\1', text)
 
         # Remove spans: >le meme arrows/deadlinks etc.
-        text = re.sub(r'\<span.*?\>(.*?)\</span\>', r'\1', text)
+        text = self.span_re.sub(r'\1', text)
 
         # Replace <pre> with [code].
-        text = re.sub(r'\<pre.*?\>(.*?)\</pre\>', r'[code]\1[/code]', text)
+        text = self.pre_re.sub(r'[code]\1[/code]', text)
 
         # Replace <br> with newline character.
         text = text.replace('<br>', '\n')
@@ -83,6 +405,147 @@ class PostData:
         self.extension = post_json.get('ext')
         self.original_filename = post_json.get('filename')
 
+        # API provides base64 encoded MD5 of the image.
+        self.md5 = base64.b64decode(post_json['md5']).hex() \
+                   if post_json.get('md5') \
+                   else None
+        self.size = post_json.get('fsize')
+
+
+class TriggerMatcher:
+    """Triggers compiled to the structures which make it possible to check all
+    of them at once. Triggers are grouped by the field and case sensitivity so
+    the value of each field is converted only once per post. Identical phrases
+    are checked only once, is/isnot events are checked using a dict lookup
+    and contains/containsno events use a single Aho-Corasick automaton per
+    group if pyahocorasick is installed.
+    """
+
+    def __init__(self, triggers):
+        # (field, case_sensitive) => event => phrase => [trigger, ...]
+        self.groups = {}
+        for trigger in triggers:
+            phrase = trigger.phrase
+            if not trigger.case_sensitive:
+                phrase = phrase.lower()
+            key = (trigger.field, bool(trigger.case_sensitive))
+            events = self.groups.setdefault(key, {})
+            events.setdefault(trigger.event, {}) \
+                  .setdefault(phrase, []) \
+                  .append(trigger)
+
+        self.automatons = {}
+        if ahocorasick is not None:
+            for key, events in self.groups.items():
+                self.automatons[key] = self.build_automaton(events)
+
+    def build_automaton(self, events):
+        """Build an automaton finding all phrases of the contains and
+        containsno events. Returns None if there are no such phrases.
+        """
+        phrases = set(events.get('contains', {})) \
+                | set(events.get('containsno', {}))
+        phrases.discard('')
+        if not phrases:
+            return None
+        automaton = ahocorasick.Automaton()
+        for phrase in phrases:
+            automaton.add_word(phrase, phrase)
+        automaton.make_automaton()
+        return automaton
+
+    def find_phrases(self, key, events, field_value):
+        """Returns a set of the contains/containsno phrases which are present
+        in the value.
+        """
+        automaton = self.automatons.get(key)
+        if automaton is not None:
+            found = {phrase for end, phrase in automaton.iter(field_value)}
+            found.add('')
+            return found
+        found = set()
+        for event in ('contains', 'containsno'):
+            for phrase in events.get(event, ()):
+                if phrase in field_value:
+                    found.add(phrase)
+        return found
+
+    def match(self, post_data, master):
+        """Returns a list of the triggers whose event terms are fulfilled by
+        the post. Post type of the triggers is checked as well.
+
+        master: True if the post is the first post of the thread.
+        """
+        excluded_post_type = 'sub' if master else 'master'
+        matched = []
+        for key, events in self.groups.items():
+            field, case_sensitive = key
+            field_value = str(getattr(post_data, field))
+            if not case_sensitive:
+                field_value = field_value.lower()
+
+            if 'contains' in events or 'containsno' in events:
+                found = self.find_phrases(key, events, field_value)
+                for phrase, triggers in events.get('contains', {}).items():
+                    if phrase in found:
+                        matched.extend(triggers)
+                for phrase, triggers in events.get('containsno', {}).items():
+                    if not phrase in found:
+                        matched.extend(triggers)
+
+            if 'is' in events:
+                matched.extend(events['is'].get(field_value, ()))
+            for phrase, triggers in events.get('isnot', {}).items():
+                if phrase != field_value:
+                    matched.extend(triggers)
+
+            for phrase, triggers in events.get('begins', {}).items():
+                if field_value.startswith(phrase):
+                    matched.extend(triggers)
+            for phrase, triggers in events.get('ends', {}).items():
+                if field_value.endswith(phrase):
+                    matched.extend(triggers)
+
+        return [trigger for trigger in matched
+                if trigger.post_type != excluded_post_type]
+
+
+class ThreadTags:
+    """Tags assigned to a thread. They are loaded from the database once and
+    kept in memory, new assignments are gathered and inserted in bulk.
+    """
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.tag_ids = None
+        self.pending = []
+
+    def add(self, tag):
+        """Assign the tag to the thread unless it is already assigned."""
+        if self.tag_ids is None:
+            rows = db.session.query(TagToThread.tag_id) \
+                             .filter(TagToThread.thread==self.thread)
+            self.tag_ids = {row.tag_id for row in rows}
+        if not tag.id in self.tag_ids:
+            self.tag_ids.add(tag.id)
+            self.pending.append(tag.id)
+
+    def flush(self):
+        """Insert the new assignments."""
+        if not self.pending:
+            return
+        save_time = utc_now()
+        db.session.execute(TagToThread.__table__.insert(), [
+            {
+                'thread_id': self.thread.id,
+                'tag_id': tag_id,
+                'automatically_added': True,
+                'save_time': save_time,
+            }
+            for tag_id in self.pending
+        ])
+        self.pending = []
+
 
 class Triggers:
     """Class handling triggers. It analyzes the post, prepares the actions and
@@ -94,6 +557,18 @@ class Triggers:
         self.triggers = Trigger.query.outerjoin(Tag) \
                                      .filter(Trigger.active==True) \
                                      .all()
+        self.detach()
+        self.matcher = TriggerMatcher(self.triggers)
+
+    def detach(self):
+        """Remove the triggers and their tags (loaded together with them)
+        from the session. They are used by all workers, commits of the session
+        of this thread would otherwise expire them and the workers would load
+        them again through it.
+        """
+        tags = {trigger.tag for trigger in self.triggers} - {None}
+        for instance in self.triggers + list(tags):
+            db.session.expunge(instance)
 
     def check_post_type(self, trigger, thread, post_data):
         """True if the type of the post is correct, false otherwise.
@@ -164,17 +639,44 @@ class Triggers:
         """Returns a set of actions to execute."""
         actions = set()
 
-        # Prepare a set of actions to execute.
-        for trigger in self.triggers:
-            new_actions = self.get_single_trigger_actions(trigger, thread,
-                                                          post_data)
-            if not new_actions is None:
-                actions = actions | new_actions
+        # Prepare a set of actions to execute. The matcher returns the same
+        # triggers for which get_single_trigger_actions would return actions.
+        master = post_data.number == thread.number
+        for trigger in self.matcher.match(post_data, master):
+            if trigger.save_thread:
+                actions.add(('save', 0))
+            if trigger.tag is not None:
+                actions.add(('add_tag', trigger.tag))
         return actions
 
-    def handle(self, post_data, thread):
-        """Main function called to execute the triggers."""
+    def match_thread(self, thread_json):
+        """True if any trigger saving the thread or adding a tag to it matches
+        the first post of the thread. Used to prioritize the threads listed in
+        the catalog.
+        """
+        try:
+            post_data = PostData(thread_json)
+        except:
+            return False
+        for trigger in self.matcher.match(post_data, True):
+            if trigger.save_thread or trigger.tag is not None:
+                return True
+        return False
+
+    def handle(self, post_data, thread, thread_tags=None):
+        """Main function called to execute the triggers.
+
+        thread_tags: ThreadTags of the thread which gathers the tags added by
+                     the triggers. If not provided the tags are added
+                     immediately.
+        """
         actions = self.get_actions(thread, post_data)
+        if not actions:
+            return
+
+        flush_tags = thread_tags is None
+        if flush_tags:
+            thread_tags = ThreadTags(thread)
 
         # Execute actions.
         for action in actions:
@@ -184,33 +686,317 @@ class Triggers:
                 db.session.add(thread)
 
             if action[0] == 'add_tag':
-                if TagToThread.query.filter(
-                        TagToThread.thread==thread,
-                        TagToThread.tag==action[1]
-                    ).first() is None:
-                    tag_to_thread = TagToThread(
-                        thread_id=thread.id,
-                        tag_id=action[1].id,
-                        automatically_added=True
-                    )
-                    if instance_state(tag_to_thread).transient:
-                        db.session.add(tag_to_thread)
+                thread_tags.add(action[1])
+
+        if flush_tags:
+            thread_tags.flush()
+
+
+class Validators:
+    """Stores the values of the ETag and Last-Modified headers received with
+    the catalog and the thread data. They are sent back in the following
+    requests and the API responds with 304 Not Modified if the data didn't
+    change. A validator is kept only if the database reflects the data it
+    describes. Validators are persisted between the updates.
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.values = {}
+        self.lock = threading.Lock()
+        # Validators kept between the updates by the daemon are loaded only
+        # once, see BoardScraper.update.
+        self.loaded = False
+
+    def load(self):
+        """Load the validators of the board from the database."""
+        rows = db.session.query(CacheValidator.thread_number,
+                                CacheValidator.etag,
+                                CacheValidator.last_modified) \
+                         .filter(CacheValidator.board_id==self.board.name)
+        with self.lock:
+            self.values = {row.thread_number: (row.etag, row.last_modified)
+                           for row in rows}
+        self.loaded = True
+
+    def save(self, thread_numbers):
+        """Store the validators of the catalog and the threads with the given
+        numbers in the database. Validators of other threads are discarded
+        since they will not be requested again.
+        """
+        thread_numbers = set(thread_numbers)
+        thread_numbers.add(CacheValidator.CATALOG)
+        with self.lock:
+            self.values = {number: value
+                           for number, value in self.values.items()
+                           if number in thread_numbers}
+            rows = [{
+                'board_id': self.board.name,
+                'thread_number': number,
+                'etag': value[0],
+                'last_modified': value[1],
+            } for number, value in self.values.items()]
+
+        CacheValidator.query.filter(CacheValidator.board_id==self.board.name) \
+                            .delete(synchronize_session=False)
+        if rows:
+            db.session.execute(CacheValidator.__table__.insert(), rows)
+        db.session.commit()
+
+    def get_headers(self, number):
+        """Returns the headers which should be sent to perform a conditional
+        request.
+
+        number: thread number or CacheValidator.CATALOG.
+        """
+        with self.lock:
+            etag, last_modified = self.values.get(number, (None, None))
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def set(self, number, headers):
+        """Set the validator using the headers of the response."""
+        value = (headers.get('ETag'), headers.get('Last-Modified'))
+        with self.lock:
+            if any(value):
+                self.values[number] = value
+            else:
+                self.values.pop(number, None)
+
+    def remove(self, number):
+        """Remove the validator. Used when the response was not processed
+        correctly.
+        """
+        with self.lock:
+            self.values.pop(number, None)
+
+    def get_last_modified(self, number):
+        """Returns the value of the Last-Modified header as a datetime or None
+        if it is not known.
+        """
+        with self.lock:
+            etag, last_modified = self.values.get(number, (None, None))
+        if not last_modified:
+            return None
+        try:
+            return email.utils.parsedate_to_datetime(last_modified)
+        except (TypeError, ValueError):
+            return None
+
+    def get_thread_numbers(self):
+        """Returns the set of the numbers of the threads which have
+        validators.
+        """
+        with self.lock:
+            numbers = set(self.values)
+        numbers.discard(CacheValidator.CATALOG)
+        return numbers
+
+
+# State of a thread stored in the database.
+ThreadState = collections.namedtuple('ThreadState', ['id', 'last_reply',
+                                                     'replies',
+                                                     'last_post_number',
+                                                     'saved'])
+
+
+class ThreadIndex:
+    """Index of the threads of the board present in the database. It is
+    loaded using a single query when the update starts and kept up to date by
+    the ThreadScrapers, which makes it possible to skip the threads which
+    didn't change without accessing the database. Threads missing in the
+    index are checked using the database.
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.threads = {}
+
+        # Number of the last page of the catalog processed by the current
+        # update, see BoardScraper.set_last_page.
+        self.last_page = None
+
+        # Index kept between the updates by the daemon is loaded only once,
+        # see BoardScraper.update.
+        self.loaded = False
+
+    def load(self):
+        """Load the state of all threads of the board."""
+        rows = db.session.query(Thread.number, Thread.id, Thread.last_reply,
+                                Thread.replies, func.max(Post.number),
+                                Thread.saved) \
+                         .outerjoin(Post, Post.thread_id==Thread.id) \
+                         .filter(Thread.board_id==self.board.name) \
+                         .group_by(Thread.id, Thread.number, Thread.last_reply,
+                                   Thread.replies, Thread.saved)
+        self.threads = {
+            number: ThreadState(thread_id, self.localize(last_reply), replies,
+                                last_post_number, saved)
+            for number, thread_id, last_reply, replies, last_post_number, saved
+            in rows
+        }
+        self.loaded = True
+
+    def localize(self, value):
+        """Some databases return naive datetimes, those are stored in UTC."""
+        if value is not None and value.tzinfo is None:
+            return pytz.utc.localize(value)
+        return value
+
+    def get(self, number):
+        """Returns ThreadState or None if the thread is not in the index."""
+        return self.threads.get(number)
+
+    def set(self, number, state):
+        self.threads[number] = state._replace(
+            last_reply=self.localize(state.last_reply)
+        )
+
+
+class RetryQueue:
+    """Persistent queue of the threads and the files which could not be
+    downloaded. Pending tasks are loaded when the update starts and processed
+    before the other threads, also when the catalog was not modified, so
+    recovering from an outage doesn't require processing all threads again.
+    Tasks are dropped after SCRAPER_RETRY_MAX_ATTEMPTS failed attempts or once
+    they are older than SCRAPER_RETRY_MAX_AGE.
+    """
+
+    def __init__(self, board):
+        self.board = board
+        # Numbers of the threads and DownloadTasks keyed by the post ids.
+        self.threads = set()
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def get_query(self, kind=None):
+        query = RetryTask.query.filter(RetryTask.board_id==self.board.name)
+        if kind is not None:
+            query = query.filter(RetryTask.kind==kind)
+        return query
+
+    def load(self):
+        """Remove the expired tasks and load the pending ones."""
+        max_age = datetime.timedelta(
+            seconds=current_app.config['SCRAPER_RETRY_MAX_AGE'])
+        max_attempts = current_app.config['SCRAPER_RETRY_MAX_ATTEMPTS']
+        self.get_query().filter(db.or_(
+            RetryTask.attempts >= max_attempts,
+            RetryTask.created < utc_now() - max_age
+        )).delete(synchronize_session=False)
+        # Files of the posts which were removed or already have them.
+        missing_files = db.session.query(Image.post_id) \
+                                  .filter(Image.image=='')
+        self.get_query(RetryTask.FILE) \
+            .filter(~RetryTask.number.in_(missing_files)) \
+            .delete(synchronize_session=False)
+        rows = self.get_query().all()
+        db.session.commit()
+
+        with self.lock:
+            self.threads = {row.number for row in rows
+                            if row.kind == RetryTask.THREAD}
+            self.files = {
+                row.number: DownloadTask(row.number, row.filename,
+                                         row.extension, row.md5, row.size)
+                for row in rows if row.kind == RetryTask.FILE
+            }
+
+    def get_threads(self):
+        """Returns the set of the numbers of the threads to retry."""
+        with self.lock:
+            return set(self.threads)
+
+    def get_files(self):
+        """Returns the list of the DownloadTasks to retry."""
+        with self.lock:
+            return list(self.files.values())
+
+    def add(self, kind, number, error, **values):
+        """Record a failed attempt and commit it.
+
+        kind: RetryTask.THREAD or RetryTask.FILE.
+        number: thread number or post id.
+        error: exception which caused the failure or None.
+        **values: data of the file.
+        """
+        now = utc_now()
+        try:
+            task = self.get_query(kind).filter(RetryTask.number==number) \
+                                       .first()
+            if task is None:
+                task = RetryTask(board_id=self.board.name, kind=kind,
+                                 number=number, created=now, attempts=0,
+                                 **values)
+            task.attempts += 1
+            task.last_attempt = now
+            task.error = str(error)[:255] if error is not None else None
+            db.session.add(task)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    def remove(self, kind, number):
+        """Remove the task once it succeeded and commit it."""
+        try:
+            self.get_query(kind).filter(RetryTask.number==number) \
+                                .delete(synchronize_session=False)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+    def add_thread(self, number, error=None):
+        self.add(RetryTask.THREAD, number, error)
+
+    def remove_thread(self, number):
+        """Remove the thread from the queue if it was queued."""
+        with self.lock:
+            if not number in self.threads:
+                return
+            self.threads.discard(number)
+        self.remove(RetryTask.THREAD, number)
+
+    def add_file(self, task, error=None):
+        self.add(RetryTask.FILE, task.post_id, error, filename=task.filename,
+                 extension=task.extension, md5=task.md5, size=task.size)
+
+    def remove_file(self, task):
+        """Remove the file from the queue if it was queued."""
+        with self.lock:
+            if self.files.pop(task.post_id, None) is None:
+                return
+        self.remove(RetryTask.FILE, task.post_id)
 
 
 class Queuer:
     """Exposes the functions which allow the threads to synchronise their wait
-    times to prevent accessing the API too often.
+    times to prevent accessing the API too often. API queries and file
+    downloads are limited by separate token buckets.
+
+    buckets: buckets of another Queuer. Queuers sharing the buckets follow
+             the same limits but count their wait times separately, this is
+             used to update many boards at once.
     """
 
-    def __init__(self):
-        self.last_api_request = None
-        self.last_file_request = None
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = {
+                'api': TokenBucket(current_app.config['API_WAIT'],
+                                   current_app.config['API_BURST']),
+                'file': TokenBucket(current_app.config['FILE_WAIT'],
+                                    current_app.config['FILE_BURST']),
+            }
+        self.buckets = buckets
 
         self.total_wait = 0
-        self.total_wait_time_with_lock = datetime.timedelta()
-
-        self.file_wait_lock = threading.Lock()
-        self.api_wait_lock = threading.Lock()
+        self.total_blocked = 0
+        self.lock = threading.Lock()
 
     def get_total_wait_time(self):
         """Get the total time for which this class forced the threads to wait.
@@ -223,41 +1009,48 @@ class Queuer:
         plus the time spent waiting for the lock. This is used for generating
         statistics.
         """
-        return self.total_wait_time_with_lock
+        return datetime.timedelta(seconds=self.total_wait + self.total_blocked)
 
-    def wait(self, time_beetwen_requests, last_request):
-        """Wait to make sure that the specified time passed since the last
-        request.
+    def reserve(self, bucket_name):
+        """Reserve a slot in the bucket. Returns the number of seconds for
+        which the caller has to wait.
         """
-        # Convert seconds to microseconds.
-        time_beetwen_requests *= 1000000
-        if not last_request is None:
-            time_passed = datetime.datetime.now() - last_request
-            if time_passed.microseconds < time_beetwen_requests:
-                wait_for_seconds = (time_beetwen_requests - \
-                                    time_passed.microseconds) / 1000000
-                self.total_wait += wait_for_seconds
-                time.sleep(wait_for_seconds)
+        reserve_start = time.monotonic()
+        delay = self.buckets[bucket_name].reserve()
+        with self.lock:
+            self.total_blocked += time.monotonic() - reserve_start
+        return delay
+
+    def add_wait_time(self, seconds):
+        with self.lock:
+            self.total_wait += seconds
+
+    def wait(self, bucket_name):
+        """Wait until a slot in the bucket is available."""
+        delay = self.reserve(bucket_name)
+        if delay > 0:
+            wait_start = time.monotonic()
+            time.sleep(delay)
+            self.add_wait_time(time.monotonic() - wait_start)
 
     def api_wait(self):
         """Wait in order to satisfy the API rules. Called before each API
         query.
         """
-        wait_start = datetime.datetime.now()
-        with self.api_wait_lock:
-            self.wait(current_app.config['API_WAIT'], self.last_api_request)
-            self.last_api_request = datetime.datetime.now()
-        self.total_wait_time_with_lock += datetime.datetime.now() - wait_start
+        self.wait('api')
+
+    def get_waiter(self, bucket_name):
+        """Returns a function which blocks until a slot in the bucket is
+        available. It is passed to ConnectionPool.get to rate limit the
+        retries and can be called from any thread.
+        """
+        return functools.partial(Queuer.wait, self, bucket_name)
 
     def file_wait(self):
         """Wait in order to satisfy the rules. Called before each file
         download.
         """
-        wait_start = datetime.datetime.now()
-        with self.file_wait_lock:
-            self.wait(current_app.config['FILE_WAIT'], self.last_file_request)
-            self.last_file_request = datetime.datetime.now()
-        self.total_wait_time_with_lock += datetime.datetime.now() - wait_start
+        self.wait('file')
 
 
 class Stats:
@@ -276,6 +1069,13 @@ class Stats:
             'downloaded_images': 0,
             'downloaded_thumbnails': 0,
             'downloaded_threads': 0,
+            'not_modified': 0,
+            'reused_files': 0,
+            'skipped_threads': 0,
+            'deferred_threads': 0,
+            'archived_threads': 0,
+            'retried_threads': 0,
+            'retried_files': 0,
         }
 
         self.lock = threading.Lock()
@@ -317,16 +1117,18 @@ class Stats:
 
         total_time: timedelta object
         """
+        used_threads = kwargs.get('used_threads',
+                                  current_app.config['SCRAPER_THREADS_NUMBER'])
         try:
             wait_percent = round(
                 self.get('total_wait_time_with_lock').total_seconds() \
                 / total_time.total_seconds() * 100 \
-                / current_app.config['SCRAPER_THREADS_NUMBER']
+                / used_threads
             )
             downloading_percent = round(
                 self.get('total_download_time').total_seconds() \
                 / total_time.total_seconds() * 100 \
-                / current_app.config['SCRAPER_THREADS_NUMBER']
+                / used_threads
             )
 
         except:
@@ -337,7 +1139,10 @@ class Stats:
         return ('Time passed: %s seconds (%s%% waiting, %s%% downloading files) '
                 'Processed threads: %s Added posts: %s Removed posts: %s '
                 'Downloaded images: %s Downloaded thumbnails: %s '
-                'Downloaded threads: %s' % (
+                'Downloaded threads: %s Not modified: %s Reused files: %s '
+                'Skipped threads: %s Deferred threads: %s '
+                'Archived threads: %s Retried threads: %s Retried files: %s'
+                % (
             round(total_time.total_seconds(), 2),
             wait_percent,
             downloading_percent,
@@ -347,6 +1152,13 @@ class Stats:
             self.get('downloaded_images'),
             self.get('downloaded_thumbnails'),
             self.get('downloaded_threads'),
+            self.get('not_modified'),
+            self.get('reused_files'),
+            self.get('skipped_threads'),
+            self.get('deferred_threads'),
+            self.get('archived_threads'),
+            self.get('retried_threads'),
+            self.get('retried_files'),
         ))
 
     def merge(self, stats):
@@ -355,6 +1167,198 @@ class Stats:
             self.add(key, stats.get(key))
 
 
+# Files attached to the post which was already added to the database.
+DownloadTask = collections.namedtuple('DownloadTask',
+                                      ['post_id', 'filename', 'extension', 'md5',
+                                       'size'])
+
+
+class FileWriter(object):
+    """Writes a downloaded file chunk by chunk to a temporary file located in
+    the target directory and moves it in place once the download is finished,
+    so the files in MEDIA_ROOT are never partially written. Size and MD5 of
+    the file are verified if known. Use it as a context manager, if an
+    exception occurs the temporary file is removed.
+
+    directory: directory located in MEDIA_ROOT.
+    filename: name of the file.
+    size: expected size of the file in bytes or None.
+    md5: expected hex encoded MD5 of the file or None.
+    """
+
+    def __init__(self, directory, filename, size=None, md5=None):
+        self.media_root = current_app.config['MEDIA_ROOT']
+        self.directory = directory
+        self.path = os.path.join(directory, secure_filename(filename))
+        self.size = size
+        self.md5 = md5
+        self.received = 0
+        self.hash = hashlib.md5()
+        self.file = None
+        self.temp_path = None
+
+    def __enter__(self):
+        # Unlike tempfile this creates the file with the default permissions
+        # so it can be served by the web server once it is moved in place.
+        self.temp_path = os.path.join(self.media_root, self.directory,
+                                      '.%s.part' % uuid.uuid4().hex)
+        fd = os.open(self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                     0o666)
+        self.file = os.fdopen(fd, 'wb')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            try:
+                self.finish()
+            except:
+                self.abort()
+                raise
+        else:
+            self.abort()
+
+    def write(self, chunk):
+        """Write the next chunk of the file."""
+        self.received += len(chunk)
+        if self.size is not None and self.received > self.size:
+            raise ScrapError('File %s is larger than expected.' % self.path)
+        self.hash.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self):
+        """Verify the file and move it in place."""
+        if self.size is not None and self.received != self.size:
+            raise ScrapError('File %s is smaller than expected.' % self.path)
+        if self.md5 is not None and self.hash.hexdigest() != self.md5:
+            raise ScrapError('MD5 of the file %s does not match.' % self.path)
+        self.file.close()
+        os.replace(self.temp_path, os.path.join(self.media_root, self.path))
+
+    def abort(self):
+        """Remove the temporary file."""
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+def assign_post_files(task, paths):
+    """Assign the stored files to the image record of the post. Returns False
+    if the post no longer exists.
+    """
+    table = Image.__table__
+    result = db.session.execute(
+        table.update().where(table.c.post_id==task.post_id).values(**paths)
+    )
+    return result.rowcount > 0
+
+
+def reuse_post_files(task):
+    """Assign the files which are already stored to the image record of the
+    post. Returns False if the files are not stored and have to be downloaded.
+    """
+    if task.md5 is None:
+        return False
+    paths = File.acquire(task.md5)
+    if paths is None:
+        return False
+    if assign_post_files(task, paths):
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return True
+
+
+def get_post_files_name(task):
+    """Returns the name under which the files attached to the post are stored.
+    Files of the images with a known MD5 are stored under a name based on that
+    hash and shared with other posts.
+    """
+    return task.md5 if task.md5 is not None else task.filename
+
+
+def save_post_files(task, paths):
+    """Assign the downloaded files to the image record of the post.
+
+    task: DownloadTask.
+    paths: dict with the paths of the image and the thumbnail.
+    """
+    if task.md5 is not None:
+        try:
+            db.session.execute(File.__table__.insert().values(
+                md5=task.md5,
+                reference_count=1,
+                **paths
+            ))
+        except IntegrityError:
+            # Stored by other worker in the meantime.
+            db.session.rollback()
+            stored_paths = File.acquire(task.md5)
+            if stored_paths is None:
+                remove_post_files(task, paths)
+                raise ScrapError('Files of the post %s were removed in the '
+                                 'meantime.' % task.post_id)
+            paths = stored_paths
+
+    if assign_post_files(task, paths):
+        db.session.commit()
+        return
+
+    # The post was removed in the meantime.
+    db.session.rollback()
+    remove_post_files(task, paths)
+
+
+def remove_post_files(task, paths):
+    """Remove the downloaded files which are not assigned to any post."""
+    if task.md5 is None or File.query.filter(File.md5==task.md5).first() is None:
+        for path in paths.values():
+            Image.remove_file(path)
+
+
+def check_status(status_code):
+    """Raises an exception if the status code indicates an error."""
+    if status_code == 404:
+        raise NotFound('Server responded with status 404.')
+    if status_code >= 400:
+        raise ScrapError('Server responded with status %s.' % status_code)
+
+
+def parse_thread(thread_json, last_post_number):
+    """Returns a tuple (post_numbers, new_posts) containing the numbers of all
+    posts present in the thread data and the PostData objects created for the
+    posts newer than last_post_number.
+    """
+    post_numbers = []
+    new_posts = []
+    for post_json in thread_json['posts']:
+        number = int(post_json['no'])
+        post_numbers.append(number)
+        if number > last_post_number:
+            new_posts.append(PostData(post_json))
+    return post_numbers, new_posts
+
+
+def parse_thread_content(content, last_post_number):
+    """Decodes the thread data downloaded from the API and parses it, see
+    parse_thread. This is executed by the parser processes.
+    """
+    return parse_thread(json.loads(content.decode('utf-8')), last_post_number)
+
+
+def create_parser_pool():
+    """Returns the pool of processes parsing the large threads or None if it
+    is disabled. The processes are spawned instead of forked since the
+    scrapers run many threads.
+    """
+    processes = current_app.config['SCRAPER_PARSER_PROCESSES']
+    if not processes:
+        return None
+    return ProcessPoolExecutor(max_workers=processes,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
 class Scraper(object):
     """Base class for the scrapers."""
 
@@ -371,6 +1375,11 @@ class Scraper(object):
         progress: bool value, indicates if the progress should be displayed.
         queuer: Queuer object.
         triggers: Triggers object.
+        connection_pool: ConnectionPool object.
+        validators: Validators object.
+        thread_index: ThreadIndex object.
+        retry_queue: RetryQueue object.
+        parser_pool: ProcessPoolExecutor parsing the large threads or None.
         """
         self.board = board
         self.stats = Stats()
@@ -384,45 +1393,209 @@ class Scraper(object):
         if self.triggers is None:
             self.triggers = Triggers()
 
-    def get_url(self, url):
+        # The pool is closed after the update only by the scraper which
+        # created it, pools passed from the outside are kept open.
+        self.connection_pool = kwargs.pop('connection_pool', None)
+        self.owns_connection_pool = self.connection_pool is None
+        if self.connection_pool is None:
+            self.connection_pool = ConnectionPool()
+
+        self.validators = kwargs.pop('validators', None)
+        if self.validators is None:
+            self.validators = Validators(board)
+
+        self.thread_index = kwargs.pop('thread_index', None)
+        if self.thread_index is None:
+            self.thread_index = ThreadIndex(board)
+
+        self.retry_queue = kwargs.pop('retry_queue', None)
+        if self.retry_queue is None:
+            self.retry_queue = RetryQueue(board)
+
+        # Parsing in other processes is optional so the pool is created only
+        # by the BoardScraper.
+        self.parser_pool = kwargs.pop('parser_pool', None)
+
+    def get_shared_objects(self):
+        """Returns the objects which should be passed as **kwargs to the
+        scrapers created by this one.
+        """
+        return {
+            'queuer': self.queuer,
+            'triggers': self.triggers,
+            'connection_pool': self.connection_pool,
+            'validators': self.validators,
+            'thread_index': self.thread_index,
+            'retry_queue': self.retry_queue,
+            'parser_pool': self.parser_pool,
+            'progress': self.show_progress,
+        }
+
+    def get_api_url(self, path):
+        """Returns the url of the API resource of the board, see API_URL
+        setting.
+
+        path: path relative to the board, for example 'catalog.json'.
+        """
+        return '%s/%s/%s' % (current_app.config['API_URL'], self.board.name,
+                             path)
+
+    def get_image_url(self, task):
+        """Returns the url of the image attached to the post."""
+        return '%s/%s/%s%s' % (current_app.config['IMAGES_URL'],
+                               self.board.name, task.filename, task.extension)
+
+    def get_thumbnail_url(self, task):
+        """Returns the url of the thumbnail of the image attached to the
+        post.
+        """
+        return '%s/%s/%ss.jpg' % (current_app.config['THUMBNAILS_URL'],
+                                  self.board.name, task.filename)
+
+    def get_url(self, url, headers=None):
         """Download data from an url."""
         download_start = datetime.datetime.now()
-        data = requests.get(url, timeout=current_app.config['CONNECTION_TIMEOUT'])
+        data = self.connection_pool.get(
+            url,
+            wait=self.queuer.get_waiter('api'),
+            headers=headers,
+            timeout=current_app.config['CONNECTION_TIMEOUT']
+        )
         self.stats.add('total_download_time',
                         datetime.datetime.now() - download_start)
         return data
 
+    def get_file(self, url, file_writer):
+        """Download a file and write it using the FileWriter. The file is
+        streamed so it is never entirely kept in memory.
+        """
+        download_start = datetime.datetime.now()
+        response = self.connection_pool.get(
+            url,
+            wait=self.queuer.get_waiter('file'),
+            stream=True,
+            timeout=current_app.config['CONNECTION_TIMEOUT']
+        )
+        try:
+            check_status(response.status_code)
+            chunk_size = current_app.config['SCRAPER_DOWNLOAD_CHUNK_SIZE']
+            with file_writer:
+                for chunk in response.iter_content(chunk_size):
+                    file_writer.write(chunk)
+        finally:
+            response.close()
+            self.stats.add('total_download_time',
+                            datetime.datetime.now() - download_start)
+        return file_writer.path
+
+    def read_api_response(self, number, response, decode=True):
+        """Returns the decoded JSON data or None if the server responded with
+        304 Not Modified. Updates the validator.
+
+        number: thread number or CacheValidator.CATALOG.
+        response: requests.Response or an object with the same status_code,
+                  headers and content attributes.
+        decode: if False the content is returned without decoding it.
+        """
+        if response.status_code == 304:
+            self.stats.add('not_modified', 1)
+            return None
+        check_status(response.status_code)
+        if not decode:
+            self.validators.set(number, response.headers)
+            return response.content
+        data = json.loads(response.content.decode('utf-8'))
+        self.validators.set(number, response.headers)
+        return data
+
+    def get_image(self, task):
+        """Download an image. Returns the path relative to MEDIA_ROOT."""
+        url = self.get_image_url(task)
+        file_writer = FileWriter(
+            'post_images',
+            '%s%s' % (get_post_files_name(task), task.extension),
+            size=task.size,
+            md5=task.md5
+        )
+        self.queuer.file_wait()
+        self.stats.add('downloaded_images', 1)
+        return self.get_file(url, file_writer)
+
+    def get_thumbnail(self, task):
+        """Download a thumbnail. Returns the path relative to MEDIA_ROOT."""
+        url = self.get_thumbnail_url(task)
+        file_writer = FileWriter('post_thumbnails',
+                                 '%s.jpg' % get_post_files_name(task))
+        self.queuer.file_wait()
+        self.stats.add('downloaded_thumbnails', 1)
+        return self.get_file(url, file_writer)
+
+    def download_post_files(self, task):
+        """Download the image and the thumbnail attached to the post and assign
+        them to the image record. Files which are already stored are not
+        downloaded again.
+        """
+        if reuse_post_files(task):
+            self.stats.add('reused_files', 1)
+            return
+        paths = {'image': self.get_image(task)}
+        try:
+            paths['thumbnail'] = self.get_thumbnail(task)
+        except:
+            remove_post_files(task, paths)
+            raise
+        save_post_files(task, paths)
+
+    def on_download_done(self, task):
+        """Called after the files attached to the post were downloaded."""
+        self.retry_queue.remove_file(task)
+
+    def on_download_error(self, task, e):
+        """Called if the files attached to the post could not be downloaded.
+        The download is retried during the next updates unless the files no
+        longer exist.
+        """
+        db.session.rollback()
+        sys.stderr.write('%s\n' % e)
+        if not isinstance(e, NotFound):
+            self.retry_queue.add_file(task, e)
+
 
 class ThreadScraper(Scraper):
     """Scraps the data from a single thread."""
 
+    # Max number of ids in a single IN clause of the bulk statements.
+    delete_chunk_size = 500
+
     def __init__(self, board, thread_data, **kwargs):
+        """**kwargs:
+        download_queue: queue to which the DownloadTask objects are added
+                        once the posts are commited. If not provided the
+                        files are downloaded immediately.
+        """
+        self.download_queue = kwargs.pop('download_queue', None)
         super(ThreadScraper, self).__init__(board, **kwargs)
         self.thread_data = thread_data
         self.modified = False
-
-    def get_image(self, filename, extension):
-        """Download an image."""
-        url = 'https://i.4cdn.org/%s/%s%s' % (self.board.name, filename,
-                                              extension)
-        self.queuer.file_wait()
-        self.stats.add('downloaded_images', 1)
-        return self.get_url(url).content
-
-    def get_thumbnail(self, filename):
-        """Download a thumbnail."""
-        url = 'https://t.4cdn.org/%s/%ss.jpg' % (self.board.name, filename)
-        self.queuer.file_wait()
-        self.stats.add('downloaded_thumbnails', 1)
-        return self.get_url(url).content
-
-    def get_thread_json(self, thread_number):
-        """Get the thread data from the official API."""
-        url = 'https://a.4cdn.org/%s/thread/%s.json' % (self.board.name,
-                                                        thread_number)
+        self.completed = False
+        self.pending_downloads = []
+        self.pending_removals = []
+        self.thread_tags = None
+        # Exception which caused the failure of the thread or None.
+        self.error = None
+
+    def get_thread_json(self, thread_number, conditional=False, decode=True):
+        """Get the thread data from the official API. Returns None if the
+        request was conditional and the thread was not modified. If decode is
+        False the data is returned as bytes.
+        """
+        url = self.get_api_url('thread/%s.json' % thread_number)
+        headers = self.validators.get_headers(thread_number) \
+                  if conditional else None
         self.queuer.api_wait()
         self.stats.add('downloaded_threads', 1)
-        return self.get_url(url).json()
+        response = self.get_url(url, headers=headers)
+        return self.read_api_response(thread_number, response, decode=decode)
 
     def get_thread_number(self):
         """Get the number of a thread scrapped by this instance."""
@@ -437,7 +1610,8 @@ class ThreadScraper(Scraper):
             # Thread has to have new replies or different number of replies.
             # Note: use count_replies because 4chan does not count the first
             # post as a reply.
-            if (self.thread_data.last_reply_time <= thread.last_reply
+            last_reply = self.thread_index.localize(thread.last_reply)
+            if (self.thread_data.last_reply_time <= last_reply
                 and self.thread_data.replies == thread.count_replies()):
                 return False
         return True
@@ -446,72 +1620,197 @@ class ThreadScraper(Scraper):
         """Get the last post's number or pick an imaginary one. Only posts with
         a higher number will be added to the database.
         """
+        # Threads which are not stored yet have no posts.
+        if thread.id is None:
+            return -1
+        state = self.thread_index.get(thread.number)
+        if state is not None and state.id == thread.id:
+            if state.last_post_number is None:
+                return -1
+            return state.last_post_number
+
         last_post = thread.posts.order_by(Post.number.desc()).first()
         if last_post is not None:
             return last_post.number
         return -1
 
-    def add_post(self, post_data, thread):
-        """Add the post to the database."""
-        # Download the images.
-        if not post_data.filename is None:
-            try:
-                image_storage = FileStorage(
-                    io.BytesIO(self.get_image(post_data.filename,
-                                              post_data.extension))
-                )
-                thumbnail_storage = FileStorage(
-                    io.BytesIO(self.get_thumbnail(post_data.filename))
-                )
-                filename_image = '%s%s' % (post_data.filename, post_data.extension)
-                filename_thumbnail = '%s%s' % (post_data.filename, '.jpg')
-            except:
-                raise ScrapError('Image download failed. Stopping at this post.')
-
-        # Save post.
-        post = Post(
-            thread=thread,
-            number=post_data.number,
-            time=post_data.time,
-            name=post_data.name,
-            trip=post_data.trip,
-            email=post_data.email,
-            country=post_data.country,
-            subject=post_data.subject,
-            comment=post_data.comment
-        )
-        if instance_state(post).transient:
-            db.session.add(post)
+    def prepare_post(self, post_data, thread):
+        """Returns a tuple containing the post data, the post row and the image
+        row (or None) which should be inserted by add_posts. Files are not
+        downloaded here, the image row is updated once they are.
+        """
+        post_row = {
+            'thread_id': thread.id,
+            'number': post_data.number,
+            'time': post_data.time,
+            'name': post_data.name,
+            'trip': post_data.trip,
+            'email': post_data.email,
+            'country': post_data.country,
+            'subject': post_data.subject,
+            'comment': post_data.comment,
+        }
+        image_row = None
 
-        # Save image.
+        # Paths are empty until the files are downloaded.
         if not post_data.filename is None:
-            image = Image(original_name=post_data.original_filename, post=post)
-            image.save_image(image_storage, filename_image)
-            image.save_thumbnail(thumbnail_storage, filename_thumbnail)
-            if instance_state(image).transient:
-                db.session.add(image)
+            image_row = {
+                'original_name': post_data.original_filename,
+                'image': '',
+                'thumbnail': '',
+            }
 
         # Just to give something to look at.
         # "_" is a post without an image, "-" is a post with an image
         if self.show_progress:
             print('-' if post_data.filename else '_', end='', flush=True)
-        self.stats.add('added_posts', 1)
 
-    def delete_post(self, post):
-        # SQL Alchemy's ORM events can not modify related objects and it is not
-        # possible to create a single trigger for all supported databases. The
-        # denormalized number of posts must be adjusted here manually.
-        post.thread.post_deleted()
-        if post.image is not None:
-            post.thread.image_deleted()
-        db.session.add(post.thread)
+        return (post_data, post_row, image_row)
+
+    def insert_post_rows(self, thread, post_rows):
+        """Insert the posts. Returns a dict mapping the post numbers to the ids
+        of the inserted rows.
+        """
+        table = Post.__table__
+        if db.engine.dialect.implicit_returning:
+            result = db.session.execute(
+                table.insert().values(post_rows)
+                              .returning(table.c.id, table.c.number)
+            )
+        else:
+            db.session.execute(table.insert(), post_rows)
+            result = db.session.query(Post.id, Post.number).filter(
+                Post.thread_id==thread.id,
+                Post.number.in_([row['number'] for row in post_rows])
+            )
+        return {row.number: row.id for row in result}
+
+    def acquire_stored_files(self, prepared_posts):
+        """Find the files of the prepared posts which are already stored and
+        add references to them. Returns a dict mapping MD5 hashes to the paths
+        of the stored files.
+        """
+        references = collections.Counter(
+            post_data.md5 for post_data, post_row, image_row in prepared_posts
+            if image_row is not None and post_data.md5 is not None
+        )
+        if not references:
+            return {}
+
+        rows = db.session.query(File.md5, File.image, File.thumbnail) \
+                         .filter(File.md5.in_(references.keys()))
+        stored_files = {}
+        for row in rows:
+            # Files might have been removed in the meantime.
+            if File.add_references(row.md5, references[row.md5]):
+                stored_files[row.md5] = {
+                    'image': row.image,
+                    'thumbnail': row.thumbnail,
+                }
+        return stored_files
+
+    def add_posts(self, thread, prepared_posts):
+        """Add the posts prepared by prepare_post to the database. Rows are
+        inserted using bulk statements and the denormalized data of the thread
+        is updated once.
+        """
+        if not prepared_posts:
+            return
 
-        db.session.delete(post)
-        self.stats.add('removed_posts', 1)
+        post_rows = [post_row for post_data, post_row, image_row in prepared_posts]
+        post_ids = self.insert_post_rows(thread, post_rows)
+
+        stored_files = self.acquire_stored_files(prepared_posts)
+
+        image_rows = []
+        for post_data, post_row, image_row in prepared_posts:
+            if image_row is not None:
+                image_row['post_id'] = post_ids[post_data.number]
+                image_rows.append(image_row)
+                if post_data.md5 in stored_files:
+                    image_row.update(stored_files[post_data.md5])
+                    self.stats.add('reused_files', 1)
+                else:
+                    self.pending_downloads.append(DownloadTask(
+                        image_row['post_id'],
+                        post_data.filename,
+                        post_data.extension,
+                        post_data.md5,
+                        post_data.size
+                    ))
+        if image_rows:
+            db.session.execute(Image.__table__.insert(), image_rows)
+
+        # SQL Alchemy's ORM events are not triggered by bulk statements so the
+        # denormalized data must be updated here.
+        times = [post_row['time'] for post_row in post_rows]
+        thread.replies += len(post_rows)
+        thread.images += len(image_rows)
+        first_reply = self.thread_index.localize(thread.first_reply)
+        last_reply = self.thread_index.localize(thread.last_reply)
+        if first_reply is None or min(times) < first_reply:
+            thread.first_reply = min(times)
+        if last_reply is None or max(times) > last_reply:
+            thread.last_reply = max(times)
+        db.session.add(thread)
+
+        if self.thread_tags is not None:
+            self.thread_tags.flush()
+
+        self.stats.add('added_posts', len(post_rows))
+
+    def delete_posts(self, thread, post_numbers):
+        """Remove the posts of the thread which are not present in the
+        downloaded data. Posts and images are removed using bulk statements,
+        the files are removed after the changes are commited.
+
+        post_numbers: numbers of the posts present in the thread data.
+        """
+        post_numbers = set(post_numbers)
+        post_ids = [
+            row.id for row in
+            db.session.query(Post.id, Post.number) \
+                      .filter(Post.thread_id==thread.id)
+            if not row.number in post_numbers
+        ]
+        if not post_ids:
+            return
+        self.modified = True
+
+        post_table = Post.__table__
+        image_table = Image.__table__
+        removed_images = 0
+        for i in range(0, len(post_ids), self.delete_chunk_size):
+            chunk = post_ids[i:i + self.delete_chunk_size]
+            images = db.session.execute(
+                db.select([image_table.c.image, image_table.c.thumbnail])
+                  .where(image_table.c.post_id.in_(chunk))
+            ).fetchall()
+            for image in images:
+                paths = File.dereference(db.session, image.image)
+                if paths is None:
+                    paths = [image.image, image.thumbnail]
+                self.pending_removals.extend(paths)
+            removed_images += len(images)
+
+            db.session.execute(image_table.delete() \
+                                          .where(image_table.c.post_id.in_(chunk)))
+            db.session.execute(post_table.delete() \
+                                         .where(post_table.c.id.in_(chunk)))
+
+        # SQL Alchemy's ORM events are not triggered by bulk statements so the
+        # denormalized data must be updated here.
+        thread.replies -= len(post_ids)
+        thread.images -= removed_images
+        db.session.add(thread)
+
+        self.stats.add('removed_posts', len(post_ids))
 
     def get_thread(self, board_name, thread_number):
         """Get the existing entry for this thread from the database or create
-        a new record for it.
+        a new record for it. New records are stored by save_thread once the
+        thread data is downloaded and parsed so the threads which failed are
+        not left empty in the database.
         """
         try:
             thread = Thread.query.filter(Thread.board_id==board_name,
@@ -519,75 +1818,266 @@ class ThreadScraper(Scraper):
                                  .one()
         except NoResultFound:
             thread = Thread(board_id=board_name, number=thread_number)
+        return thread
 
+    def save_thread(self, thread):
+        """Insert the new record created by get_thread, the posts need its
+        id.
+        """
         if not thread.id:
             db.session.add(thread)
             db.session.flush()
             db.session.refresh(thread)
 
-        return thread
+    def is_unchanged(self):
+        """True if the index shows that the thread didn't change since the
+        last update. Performs the same check as should_be_updated. The time of
+        the last modification listed by the API is compared with the one
+        received with the stored thread data if both are known, this also
+        detects the removed posts.
+        """
+        if self.thread_data.last_modified is not None:
+            last_modified = self.validators.get_last_modified(
+                self.thread_data.number)
+            if last_modified is not None:
+                return self.thread_data.last_modified <= last_modified
+
+        state = self.thread_index.get(self.thread_data.number)
+        return state is not None \
+               and state.last_reply is not None \
+               and state.replies > 0 \
+               and self.thread_data.last_reply_time <= state.last_reply \
+               and self.thread_data.replies == state.replies - 1
+
+    def get_poll_interval(self):
+        """Returns the minimum time between the downloads of the thread
+        [seconds]. The interval is inversely proportional to the rate at which
+        the replies are posted, busy threads are downloaded more often.
+        """
+        rate = self.thread_data.get_reply_rate()
+        if rate is None:
+            # Threads listed in threads.json are never deferred.
+            return 0
+        if rate == 0:
+            return current_app.config['SCRAPER_THREAD_MAX_INTERVAL']
+        interval = current_app.config['SCRAPER_THREAD_BATCH_REPLIES'] / rate
+        interval = max(interval, current_app.config['SCRAPER_THREAD_MIN_INTERVAL'])
+        return min(interval, current_app.config['SCRAPER_THREAD_MAX_INTERVAL'])
+
+    def is_deferred(self):
+        """True if the download of the new replies can wait until one of the
+        next updates. Only the threads which are unlikely to disappear and
+        received a few new replies shortly after the last reply stored in the
+        database are deferred.
+        """
+        if self.thread_data.urgent:
+            return False
+        # Threads which are about to be pruned are unknown without the last
+        # page of the catalog.
+        if self.thread_index.last_page is None:
+            return False
+        state = self.thread_index.get(self.thread_data.number)
+        if state is None or state.last_reply is None or state.replies == 0:
+            return False
+        new_replies = self.thread_data.replies + 1 - state.replies
+        if new_replies >= current_app.config['SCRAPER_THREAD_BATCH_REPLIES']:
+            return False
+        snapshot_age = (utc_now() - state.last_reply).total_seconds()
+        return snapshot_age < self.get_poll_interval()
+
+    def get_thread_to_update(self):
+        """Returns the database record of the thread if it has to be updated
+        or None otherwise.
+        """
+        # Archived threads are downloaded one last time, failed threads are
+        # retried.
+        if self.thread_data.archived or self.thread_data.retried:
+            if self.thread_data.archived:
+                self.stats.add('archived_threads', 1)
+            else:
+                self.stats.add('retried_threads', 1)
+            return self.get_thread(self.board.name, self.thread_data.number)
 
-    def handle_thread(self):
-        """Download/update the thread if necessary."""
         # Download only above a certain number of posts.
         # (seriously it is wise do let the moderators do their job first)
         if self.thread_data.replies < self.board.replies_threshold:
-            return
+            return None
+
+        if self.is_unchanged():
+            return None
+
+        if self.is_deferred():
+            self.stats.add('deferred_threads', 1)
+            return None
 
         thread = self.get_thread(self.board.name, self.thread_data.number)
         if not self.should_be_updated(thread):
+            return None
+        return thread
+
+    def handle_thread(self):
+        """Download/update the thread if necessary."""
+        thread = self.get_thread_to_update()
+        if thread is None:
+            self.completed = True
             return
         last_post_number = self.get_last_post_number(thread)
 
-        # Download the thread data.
+        # Download the thread data. Conditional request can be performed only
+        # if the thread is already present in the database.
         try:
-            thread_json = self.get_thread_json(self.thread_data.number)
-        except:
+            content = self.get_thread_json(self.thread_data.number,
+                                           conditional=thread.replies > 0,
+                                           decode=False)
+        except Exception as e:
+            self.error = e
             raise ScrapError('Unable to download the thread data. It might not '
                              'exist anymore.')
 
-        # Create a list of downloaded post numbers. Items present in
-        # the database but missing here will be removed.
-        post_numbers = []
+        # Not modified.
+        if content is None:
+            self.completed = True
+            return
 
         try:
+            parsed_thread = self.parse_thread_content(content,
+                                                      last_post_number)
+        except Exception as e:
+            self.on_thread_error(e)
+            return
+        self.handle_parsed_thread(thread, parsed_thread, last_post_number)
+
+    def use_parser_pool(self, content):
+        """True if the downloaded thread data should be parsed by the parser
+        processes. Small threads are parsed faster in place.
+        """
+        return self.parser_pool is not None \
+               and len(content) >= current_app.config['SCRAPER_PARSER_MIN_SIZE']
+
+    def parse_thread_content(self, content, last_post_number):
+        """Parse the downloaded thread data, see parse_thread."""
+        if self.use_parser_pool(content):
+            return self.parser_pool.submit(parse_thread_content, content,
+                                           last_post_number).result()
+        return parse_thread_content(content, last_post_number)
+
+    def commit(self):
+        """Commit the changes made to the thread and schedule the downloads of
+        the files attached to the added posts.
+        """
+        db.session.commit()
+        for path in self.pending_removals:
+            Image.remove_file(path)
+        self.pending_removals = []
+        for task in self.pending_downloads:
+            self.schedule_download(task)
+        self.pending_downloads = []
+
+    def rollback(self):
+        """Roll back the changes made to the thread since the last commit."""
+        db.session.rollback()
+        self.pending_downloads = []
+        self.pending_removals = []
+        self.thread_tags = None
+
+    def schedule_download(self, task):
+        """Download the files attached to the post which was commited."""
+        if self.download_queue is not None:
+            self.download_queue.put(task)
+        else:
+            try:
+                self.download_post_files(task)
+            except Exception as e:
+                self.on_download_error(task, e)
+            else:
+                self.on_download_done(task)
+
+    def should_retry(self):
+        """True if the thread which was not completed should be retried during
+        the next updates. Threads which no longer exist are not retried.
+        """
+        return not isinstance(self.error, NotFound)
+
+    def on_thread_error(self, e):
+        """Called if the downloaded thread data could not be parsed or
+        stored.
+        """
+        self.rollback()
+        sys.stderr.write('%s\n' % e)
+        self.error = e
+        self.modified = True
+        # The database doesn't reflect the downloaded data.
+        self.validators.remove(self.thread_data.number)
+
+    def handle_thread_json(self, thread, thread_json, last_post_number):
+        """Add the new posts present in the decoded thread data and remove
+        the ones which no longer exist.
+        """
+        try:
+            parsed_thread = parse_thread(thread_json, last_post_number)
+        except Exception as e:
+            self.on_thread_error(e)
+            return
+        self.handle_parsed_thread(thread, parsed_thread, last_post_number)
+
+    def handle_parsed_thread(self, thread, parsed_thread, last_post_number):
+        """Add the new posts and remove the ones which no longer exist.
+
+        parsed_thread: tuple returned by parse_thread.
+        """
+        # Numbers of the downloaded posts. Posts present in the database but
+        # missing here will be removed.
+        post_numbers, new_posts = parsed_thread
+
+        # Everything is commited in a single transaction unless the interval
+        # is set. Posts are added in order so each commit is a checkpoint
+        # from which the next update can resume.
+        commit_interval = current_app.config['SCRAPER_COMMIT_INTERVAL']
+        prepared_posts = []
+        self.thread_tags = ThreadTags(thread)
+        new_last_post_number = last_post_number
+
+        try:
+            self.save_thread(thread)
+
             # Add posts.
-            for post_json in thread_json['posts']:
-                post_data = PostData(post_json)
-                post_numbers.append(post_data.number)
-                if post_data.number > last_post_number:
-                    self.modified = True
-                    self.add_post(post_data, thread)
-                    self.triggers.handle(post_data, thread)
-                    db.session.commit()
+            for post_data in new_posts:
+                self.modified = True
+                new_last_post_number = max(new_last_post_number,
+                                           post_data.number)
+                prepared_posts.append(self.prepare_post(post_data, thread))
+                self.triggers.handle(post_data, thread, self.thread_tags)
+                if commit_interval and len(prepared_posts) >= commit_interval:
+                    self.add_posts(thread, prepared_posts)
+                    self.commit()
+                    prepared_posts = []
+            self.add_posts(thread, prepared_posts)
 
             # Remove posts which don't exist in the thread.
-            for post in thread.posts.all():
-                if not post.number in post_numbers:
-                    self.modified = True
-                    self.delete_post(post)
-                    db.session.commit()
+            self.delete_posts(thread, post_numbers)
+
+            state = ThreadState(thread.id, thread.last_reply, thread.replies,
+                                new_last_post_number, thread.saved)
+            self.commit()
+            self.thread_index.set(thread.number, state)
+            self.completed = True
 
         except Exception as e:
-            db.session.rollback()
-            sys.stderr.write('%s\n' % e)
-            self.modified = True
+            self.on_thread_error(e)
 
 
-class ThreadScraperWorker(Scraper, threading.Thread):
+class ThreadScraperWorker(threading.Thread):
     """Worker which processes threads. While running it gets the ThreadData
-    objects from the queue and creates the ThreadScraper to processes them.
-    It inherits from scraper because it must hold similar properties like
-    Triggers or Queuer to pass them to created ThreadScraper objects.
+    objects from the queue and processes them using the ThreadScrapers
+    created by the BoardScraper to which the pool is assigned.
 
     This requires an app to be passed since it needs to create an application
     context required to access the database and config in the ThreadScrapers.
     """
 
-    def __init__(self, app, board, board_scraper, queue, **kwargs):
-        super().__init__(board, **kwargs)
-        threading.Thread.__init__(self)
-        self.board_scraper = board_scraper
+    def __init__(self, app, pool, queue):
+        super().__init__()
+        self.pool = pool
         self.queue = queue
         self.app = app
 
@@ -597,23 +2087,78 @@ class ThreadScraperWorker(Scraper, threading.Thread):
     def on_task_end(self):
         db.session.remove()
 
-    def get_thread_scraper(self, thread_data):
-        """ThreadScraper factory."""
-        return ThreadScraper(self.board, thread_data, queuer=self.queuer,
-                             triggers=self.triggers, progress=self.show_progress)
-
     def run(self):
-        """Main method which gets the items from the queue and processes them."""
+        """Main method which gets the items from the queue and processes them
+        until it gets None.
+        """
         while True:
-            thread_data = self.queue.get()
+            priority, thread_data = self.queue.get()
+            if thread_data is None:
+                self.queue.task_done()
+                return
+            board_scraper = self.pool.board_scraper
             try:
+                if board_scraper.is_out_of_time():
+                    board_scraper.on_thread_skipped()
+                    continue
                 with self.app.app_context():
                     self.on_task_start()
-                    thread_scraper = self.get_thread_scraper(thread_data)
+                    thread_scraper = board_scraper.get_thread_scraper(
+                        thread_data)
                     try:
                         thread_scraper.handle_thread()
                     finally:
-                        self.board_scraper.on_thread_scraper_done(thread_scraper)
+                        board_scraper.on_thread_scraper_done(thread_scraper)
+
+            except Exception as e:
+                sys.stderr.write('%s\n' % e)
+
+            finally:
+                self.on_task_end()
+                self.queue.task_done()
+
+
+class FileDownloadWorker(threading.Thread):
+    """Worker which downloads the files attached to the posts. It gets the
+    DownloadTask objects from the queue. Posts are added to the database by
+    the ThreadScrapers without waiting for the files, those are downloaded by
+    a separate pool of workers.
+    """
+
+    def __init__(self, app, pool, queue):
+        super().__init__()
+        self.pool = pool
+        self.queue = queue
+        self.app = app
+
+    def on_task_start(self):
+        db.session()
+
+    def on_task_end(self):
+        db.session.remove()
+
+    def run(self):
+        """Main method which gets the items from the queue and processes them
+        until it gets None.
+        """
+        while True:
+            task = self.queue.get()
+            if task is None:
+                self.queue.task_done()
+                return
+            board_scraper = self.pool.board_scraper
+            try:
+                with self.app.app_context():
+                    self.on_task_start()
+                    scraper = board_scraper.get_file_scraper()
+                    try:
+                        scraper.download_post_files(task)
+                    except Exception as e:
+                        scraper.on_download_error(task, e)
+                    else:
+                        scraper.on_download_done(task)
+                    finally:
+                        board_scraper.on_file_download_done(scraper.stats)
 
             except Exception as e:
                 sys.stderr.write('%s\n' % e)
@@ -623,83 +2168,535 @@ class ThreadScraperWorker(Scraper, threading.Thread):
                 self.queue.task_done()
 
 
+class WorkerPool(object):
+    """Workers of the threaded engine processing the threads and the files
+    together with their queues. The BoardScraper creates a pool for each
+    update and stops it afterwards unless a pool is passed from the outside,
+    the daemon keeps one pool running so the workers are reused by all
+    updates. The pool is assigned to the BoardScraper of the current update.
+
+    app: Flask application, see ThreadScraperWorker.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = PriorityQueue()
+        self.download_queue = Queue(
+            maxsize=app.config['SCRAPER_DOWNLOAD_QUEUE_SIZE']
+        )
+        self.workers = []
+        self.download_workers = []
+        self.board_scraper = None
+        self.sequence = itertools.count()
+
+    def launch(self, worker_class, queue):
+        """Launch a new worker. Returns the started thread."""
+        worker = worker_class(self.app, self, queue)
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def start(self, board_scraper):
+        """Assign the pool to the board scraper and launch the missing
+        workers. Call it only while the queues are empty.
+        """
+        self.board_scraper = board_scraper
+        while len(self.download_workers) < \
+                self.app.config['SCRAPER_DOWNLOAD_THREADS']:
+            self.download_workers.append(
+                self.launch(FileDownloadWorker, self.download_queue))
+        while len(self.workers) < board_scraper.workers_number:
+            self.workers.append(self.launch(ThreadScraperWorker, self.queue))
+
+    def join(self):
+        """Wait until the queued threads and files are processed. Thread
+        workers add the files to the download queue so they are waited for
+        first.
+        """
+        self.queue.join()
+        self.download_queue.join()
+
+    def stop(self):
+        """Stop the workers once they process the remaining items. Workers
+        stop when they get None, in the priority queue it is put with a
+        priority lower than the priority of any thread. Thread workers are
+        stopped first since they add the files to the download queue.
+        """
+        for worker in self.workers:
+            self.queue.put(((2, next(self.sequence)), None))
+        for worker in self.workers:
+            worker.join()
+        for worker in self.download_workers:
+            self.download_queue.put(None)
+        for worker in self.download_workers:
+            worker.join()
+        self.workers = []
+        self.download_workers = []
+
+
 class BoardScraper(Scraper):
     """Main class which launches workers scrapping threads and assings tasks
     to them. It downloads the catalog, starts the workers and populates
     the queue with the data about the threads which need to be scrapped. After
     that it waits for all workers to finish processing the threads.
+
+    **kwargs:
+    worker_pool: WorkerPool which is kept running after the update. If not
+                 provided the workers are started for this update only.
     """
 
-    def get_catalog_json(self):
-        """Get the catalog data from the official API."""
-        url = 'https://a.4cdn.org/%s/catalog.json' % self.board.name
+    queuer_class = Queuer
+
+    def __init__(self, board, **kwargs):
+        self.worker_pool = kwargs.pop('worker_pool', None)
+        # Set while the threads are processed.
+        self.download_queue = None
+        if kwargs.get('queuer') is None:
+            kwargs['queuer'] = self.queuer_class()
+        self.owns_parser_pool = kwargs.get('parser_pool') is None
+        if self.owns_parser_pool:
+            kwargs['parser_pool'] = create_parser_pool()
+        super().__init__(board, **kwargs)
+
+        # Queuer can be shared by many updates so only the time spent waiting
+        # during this update is saved in the stats.
+        self.initial_wait_time = self.queuer.get_total_wait_time()
+        self.initial_wait_time_with_lock = \
+            self.queuer.get_total_wait_time_with_lock()
+        self.failed_threads = 0
+        # Failed threads which were added to the retry queue.
+        self.queued_threads = 0
+        self.failed_threads_lock = threading.Lock()
+        self.skipped_threads = 0
+        self.sequence = itertools.count()
+        self.deadline = None
+        # Numbers of the threads from the retry queue.
+        self.retried_threads = set()
+
+    @property
+    def workers_number(self):
+        """Number of threads which are processed concurrently."""
+        return current_app.config['SCRAPER_THREADS_NUMBER']
+
+    def get_catalog_url(self):
+        """Returns the url of the list of the threads, see SCRAPER_THREAD_LIST
+        setting. Both lists have the same structure.
+        """
+        if current_app.config['SCRAPER_THREAD_LIST'] == 'threads':
+            return self.get_api_url('threads.json')
+        return self.get_api_url('catalog.json')
+
+    def get_catalog(self):
+        """Start downloading the catalog from the official API. Returns the
+        streamed response or None if the catalog was not modified since the
+        last update.
+        """
+        url = self.get_catalog_url()
+        headers = self.validators.get_headers(CacheValidator.CATALOG)
         self.queuer.api_wait()
-        return self.get_url(url).json()
+        response = self.connection_pool.get(
+            url,
+            wait=self.queuer.get_waiter('api'),
+            headers=headers,
+            stream=True,
+            timeout=current_app.config['CONNECTION_TIMEOUT']
+        )
+        if response.status_code == 304 or response.status_code >= 400:
+            response.close()
+            return self.read_api_response(CacheValidator.CATALOG, response)
+        return response
+
+    def catalog_generator(self, response):
+        """Generator for the thread data parsed from the catalog while it is
+        being downloaded.
+        """
+        download_start = datetime.datetime.now()
+        parser = CatalogParser()
+        chunk_size = current_app.config['SCRAPER_DOWNLOAD_CHUNK_SIZE']
+        try:
+            for chunk in response.iter_content(chunk_size):
+                yield from parser.feed(chunk)
+            yield from parser.close()
+        finally:
+            response.close()
+            self.stats.add('total_download_time',
+                            datetime.datetime.now() - download_start)
+        self.validators.set(CacheValidator.CATALOG, response.headers)
 
     def on_thread_scraper_done(self, thread_scraper):
         """Called by a ThreadScraperWorker after a ThreadScraper finishes its
-        work. This is used only to merge the stats.
+        work. This is used to merge the stats, count the failed threads and
+        update the retry queue. Failed threads which were queued don't have to
+        be found in the catalog again.
         """
         try:
             self.stats.merge(thread_scraper.stats)
             self.stats.add('processed_threads', 1)
+            number = thread_scraper.thread_data.number
+            if thread_scraper.completed:
+                self.retry_queue.remove_thread(number)
+                return
+            with self.failed_threads_lock:
+                self.failed_threads += 1
+            if thread_scraper.should_retry():
+                # Changes left by the failed thread must not be commited
+                # together with the retry.
+                db.session.rollback()
+                self.retry_queue.add_thread(number, thread_scraper.error)
+                with self.failed_threads_lock:
+                    self.queued_threads += 1
 
         except Exception as e:
             sys.stderr.write('%s\n' % e)
 
-    def launch_worker(self, queue):
-        """Launch a new worker."""
-        # See werkzeug.local.LocalProxy for details about current_app. Remember
-        # to pass a real object, not the LocalProxy used to access it.
-        worker = ThreadScraperWorker(current_app._get_current_object(),
-                                     self.board, self, queue,
-                                     queuer=self.queuer, triggers=self.triggers,
-                                     progress=self.show_progress)
-        worker.daemon = True
-        worker.start()
+    def on_thread_skipped(self):
+        """Called by a worker which skipped a thread because the time budget
+        was exceeded.
+        """
+        with self.failed_threads_lock:
+            self.skipped_threads += 1
+        self.stats.add('skipped_threads', 1)
 
-    def thread_generator(self):
-        """Generator for the thread data objects. Simplifies the loop in the
-        update method.
+    def start_time_budget(self):
+        """Start counting the time after which no more threads are
+        processed.
         """
-        for page in self.catalog:
-            for thread in page['threads']:
-                yield thread
+        budget = current_app.config['SCRAPER_TIME_BUDGET']
+        if budget:
+            self.deadline = time.monotonic() + budget
+
+    def is_out_of_time(self):
+        """True if the time budget of the update was exceeded."""
+        return self.deadline is not None and time.monotonic() > self.deadline
 
-    def add_to_queue(self, queue, thread_json):
-        """Converts the data downloaded from the API to ThreadData and adds it
-        to the queue.
+    def on_file_download_done(self, stats):
+        """Called by a FileDownloadWorker after downloading the files. This is
+        used only to merge the stats.
         """
         try:
-            thread_data = ThreadData(thread_json)
-            queue.put(thread_data)
+            self.stats.merge(stats)
+
+        except Exception as e:
+            sys.stderr.write('%s\n' % e)
+
+    def get_thread_scraper(self, thread_data):
+        """ThreadScraper factory used by the workers."""
+        return ThreadScraper(self.board, thread_data,
+                             download_queue=self.download_queue,
+                             **self.get_shared_objects())
+
+    def get_file_scraper(self):
+        """Returns the Scraper downloading the files, used by the file
+        download workers.
+        """
+        return Scraper(self.board, **self.get_shared_objects())
+
+    def get_priority(self, thread_data):
+        """Returns the priority of the thread, threads with lower values are
+        processed first. Threads which are about to disappear go first: those
+        which reached the bump or image limit, threads on the last page of the
+        catalog, saved threads and threads matched by the triggers. Other
+        threads are ordered by the catalog page (last pages are pruned first)
+        and by the number of new replies.
+        """
+        state = self.thread_index.get(thread_data.number)
+        known_replies = state.replies if state is not None else 0
+        new_replies = thread_data.replies + 1 - known_replies
+        last_page = self.thread_index.last_page
+        thread_data.urgent = thread_data.limit_reached \
+            or (last_page is not None and thread_data.page is not None
+                and thread_data.page >= last_page) \
+            or (state is not None and state.saved) \
+            or thread_data.number in self.retried_threads \
+            or thread_data.matched
+        return (0 if thread_data.urgent else 1, -(thread_data.page or 0),
+                -new_replies, next(self.sequence))
+
+    def get_catalog_item(self, thread_json, page=None):
+        """Converts the data downloaded from the API to ThreadData. The
+        triggers are matched here since only the ThreadData is kept until the
+        catalog is parsed.
+        """
+        thread_data = ThreadData(thread_json, page)
+        thread_data.matched = self.triggers.match_thread(thread_json)
+        return thread_data
+
+    def add_to_catalog(self, catalog, thread_json, page=None):
+        """Converts the data downloaded from the API to ThreadData and appends
+        it to the catalog. Malformed entries are skipped.
+        """
+        try:
+            catalog.append(self.get_catalog_item(thread_json, page))
         except:
             pass
 
+    def get_queue_item(self, thread_data):
+        """Returns a tuple (priority, ThreadData) which can be put in a
+        priority queue.
+        """
+        return (self.get_priority(thread_data), thread_data)
+
+    def set_last_page(self, catalog):
+        """Store the number of the last page of the catalog in the thread
+        index. Threads on it are pruned first so they are never deferred,
+        see get_priority.
+
+        catalog: list of the ThreadData.
+        """
+        pages = [thread_data.page for thread_data in catalog
+                 if thread_data.page is not None]
+        self.thread_index.last_page = max(pages) if pages else None
+
+    def add_to_queue(self, queue, item):
+        """Adds the item returned by get_queue_item to the queue."""
+        queue.put(item)
+
+    def queue_items(self, queue, items):
+        """Add the items to the queue in the order of their priority, the
+        workers which are already running take them in this order.
+        """
+        for item in sorted(items, key=lambda item: item[0]):
+            self.add_to_queue(queue, item)
+
+    def get_archived_queue_item(self, number):
+        """Returns a tuple (priority, ThreadData) for the archived thread.
+        Archived threads are downloaded before the other ones since they will
+        soon be removed from the archive.
+        """
+        return ((0, 0, 0, next(self.sequence)),
+                ThreadData.for_archived_thread(number))
+
+    def get_retried_queue_item(self, number):
+        """Returns a tuple (priority, ThreadData) for the thread which failed
+        during one of the previous updates and is not present in the catalog.
+        """
+        return ((0, 0, 0, next(self.sequence)),
+                ThreadData.for_retried_thread(number))
+
+    def get_retried_threads(self, thread_numbers):
+        """Returns the numbers of the threads from the retry queue which are
+        not present in thread_numbers. Threads present in the catalog are
+        retried with the highest priority.
+        """
+        return sorted(self.retried_threads - set(thread_numbers))
+
+    def get_disappeared_threads(self, thread_numbers):
+        """Returns the set of the numbers of the threads which were processed
+        during the previous update but are no longer present in the catalog.
+        """
+        return self.validators.get_thread_numbers() - set(thread_numbers)
+
+    def read_archive(self, response):
+        """Returns the set of the numbers of the archived threads. Boards
+        without the archive respond with 404 Not Found.
+        """
+        if response.status_code != 200:
+            return set()
+        return set(json.loads(response.content.decode('utf-8')))
+
+    def get_archive(self):
+        """Download the list of the archived threads, see read_archive."""
+        url = self.get_api_url('archive.json')
+        self.queuer.api_wait()
+        return self.read_archive(self.get_url(url))
+
+    def get_archived_threads(self, thread_numbers):
+        """Returns the numbers of the threads which disappeared from the
+        catalog because they were archived. The list of the archived threads
+        is downloaded only if some threads disappeared, threads which are not
+        in it were removed and there is no point in requesting them.
+        """
+        if not current_app.config['SCRAPER_FETCH_ARCHIVED']:
+            return []
+        disappeared = self.get_disappeared_threads(thread_numbers)
+        if not disappeared:
+            return []
+        try:
+            archive = self.get_archive()
+        except Exception as e:
+            sys.stderr.write('Unable to download the archive (%s).\n' % e)
+            return []
+        return sorted(disappeared & archive)
+
+    def save_validators(self, thread_numbers):
+        """Persist the validators after all threads were processed."""
+        # Threads which were not processed correctly and were not added to the
+        # retry queue must be scraped again during the next update even if the
+        # catalog doesn't change.
+        if self.failed_threads > self.queued_threads \
+                or self.skipped_threads > 0 \
+                or self.stats.get('deferred_threads') > 0:
+            self.validators.remove(CacheValidator.CATALOG)
+        self.validators.save(thread_numbers)
+
+    def on_catalog_processed(self, thread_numbers):
+        """Called once all threads present in the catalog were processed."""
+        self.save_validators(thread_numbers)
+
+    def on_retries_processed(self):
+        """Called once the retry queue was processed without the catalog
+        because the catalog was not modified.
+        """
+        self.validators.save(self.validators.get_thread_numbers())
+
+    def queue_retried_files(self, download_queue):
+        """Add the files from the retry queue to the download queue."""
+        for task in self.retry_queue.get_files():
+            self.stats.add('retried_files', 1)
+            download_queue.put(task)
+
+    def prioritize_catalog(self, catalog, catalog_error, thread_numbers):
+        """Returns the queue items of the threads from the catalog once it is
+        entirely parsed, the number of the last page is needed to prioritize
+        them. Threads parsed before an error are processed as well but the
+        last page is unknown. Numbers of the threads are appended to
+        thread_numbers.
+
+        catalog: list of the ThreadData, see add_to_catalog.
+        """
+        self.set_last_page(catalog if catalog_error is None else [])
+        thread_numbers.extend(thread_data.number for thread_data in catalog)
+        return [self.get_queue_item(thread_data) for thread_data in catalog]
+
+    def populate_queue(self, queue, download_queue, response,
+                       thread_numbers):
+        """Queue the files from the retry queue and the threads from the
+        catalog, the archive and the retry queue. Threads are queued in the
+        order of their priority once the catalog is parsed. Numbers of the
+        threads present in the catalog are appended to thread_numbers.
+        Returns the exception raised while downloading or parsing the catalog
+        or None.
+        """
+        self.queue_retried_files(download_queue)
+        catalog = []
+        catalog_error = None
+        try:
+            if response is not None:
+                for page, thread_json in self.catalog_generator(response):
+                    self.add_to_catalog(catalog, thread_json, page)
+        except Exception as e:
+            catalog_error = e
+        items = self.prioritize_catalog(catalog, catalog_error, thread_numbers)
+        if catalog_error is None:
+            archived = []
+            if response is not None:
+                archived = self.get_archived_threads(thread_numbers)
+            items.extend(self.get_archived_queue_item(number)
+                         for number in archived)
+            items.extend(self.get_retried_queue_item(number) for number
+                         in self.get_retried_threads(thread_numbers
+                                                     + archived))
+        self.queue_items(queue, items)
+        return catalog_error
+
+    def process_catalog(self, response):
+        """Process all threads present in the catalog using the workers of
+        the pool. Threads and files from the retry queue are processed first.
+        If the response is None only the retry queue is processed.
+        """
+        worker_pool = self.worker_pool
+        if worker_pool is None:
+            worker_pool = WorkerPool(current_app._get_current_object())
+        worker_pool.start(self)
+        self.download_queue = worker_pool.download_queue
+
+        thread_numbers = []
+        try:
+            catalog_error = self.populate_queue(worker_pool.queue,
+                                                worker_pool.download_queue,
+                                                response, thread_numbers)
+        finally:
+            # Wait for all tasks to finish. Workers of the pool created for
+            # this update are stopped.
+            if self.worker_pool is None:
+                worker_pool.stop()
+            else:
+                worker_pool.join()
+
+        if catalog_error is not None:
+            raise ScrapError('Unable to download or parse the catalog data '
+                             '(%s). Board update stopped.' % catalog_error)
+        if response is None:
+            self.on_retries_processed()
+        else:
+            self.on_catalog_processed(thread_numbers)
+
+    def load_validators(self):
+        """Load the validators unless they are kept between the updates."""
+        if not self.validators.loaded:
+            self.validators.load()
+
+    def load_thread_index(self):
+        """Load the thread index unless it is kept between the updates."""
+        if not self.thread_index.loaded:
+            self.thread_index.load()
+
+    def discard_state(self):
+        """Called if the update failed. The validators and the thread index
+        might not reflect the database, they are loaded again by the next
+        update.
+        """
+        self.validators.loaded = False
+        self.thread_index.loaded = False
+
     def update(self):
         """Call this to update the database."""
-        # Get catalog.
         try:
-            self.catalog = self.get_catalog_json()
+            self.load_validators()
+            self.load_retry_queue()
+
+            # Get catalog.
+            try:
+                response = self.get_catalog()
+            except:
+                raise ScrapError('Unable to download or parse the catalog '
+                                 'data. Board update stopped.')
+
+            # Nothing changed since the last update if the catalog was not
+            # modified, only the retry queue is processed.
+            if response is not None or self.has_retries():
+                self.load_thread_index()
+                self.start_time_budget()
+                self.process_catalog(response)
+
         except:
-            raise ScrapError('Unable to download or parse the catalog data. '
-                             'Board update stopped.')
+            self.discard_state()
+            raise
 
-        queue = Queue()
+        finally:
+            self.close_pools()
 
-        # Launch workers.
-        for i in range(current_app.config['SCRAPER_THREADS_NUMBER']):
-            self.launch_worker(queue)
+        self.save_wait_time()
 
-        # Populate queue.
-        for thread_json in self.thread_generator():
-            self.add_to_queue(queue, thread_json)
+    def load_retry_queue(self):
+        """Load the retry queue. Failures to do so don't stop the update."""
+        try:
+            self.retry_queue.load()
+        except Exception as e:
+            db.session.rollback()
+            sys.stderr.write('Unable to load the retry queue (%s).\n' % e)
+        self.retried_threads = self.retry_queue.get_threads()
 
-        # Wait for all tasks to finish.
-        queue.join()
+    def has_retries(self):
+        """True if there are threads or files in the retry queue."""
+        return bool(self.retried_threads or self.retry_queue.get_files())
 
-        # Save total wait time in stats (self.queuer is passed everywhere so
-        # it contains the total amount).
-        self.stats.add('total_wait_time', self.queuer.get_total_wait_time())
+    def close_pools(self):
+        """Close the connection pool and the parser pool unless they were
+        passed from the outside.
+        """
+        if self.owns_connection_pool:
+            self.connection_pool.close()
+        if self.owns_parser_pool and self.parser_pool is not None:
+            self.parser_pool.shutdown()
+
+    def save_wait_time(self):
+        """Save total wait time in stats (self.queuer is passed everywhere so
+        it contains the total amount).
+        """
+        self.stats.add('total_wait_time',
+                       self.queuer.get_total_wait_time()
+                       - self.initial_wait_time)
         self.stats.add('total_wait_time_with_lock',
-                       self.queuer.get_total_wait_time_with_lock())
+                       self.queuer.get_total_wait_time_with_lock()
+                       - self.initial_wait_time_with_lock)
@@ -43,6 +43,14 @@ class Board(db.Model):
         backref='board',
         lazy='dynamic'
     )
+    cache_validators = db.relationship('CacheValidator',
+        cascade='all,delete-orphan',
+        lazy='dynamic'
+    )
+    retry_tasks = db.relationship('RetryTask',
+        cascade='all,delete-orphan',
+        lazy='dynamic'
+    )
 
     @property
     def id(self):
@@ -208,33 +216,147 @@ class Image(db.Model):
     def thumbnail_url(self):
         return url_for('files.media', filename=self.thumbnail)
 
-    def save_image(self, file_storage, filename):
+    @staticmethod
+    def store_file(file_storage, directory, filename):
+        """Save the file in a directory located in MEDIA_ROOT. Returns the path
+        relative to MEDIA_ROOT.
+        """
         filename = secure_filename(filename)
-        path = os.path.join('post_images', filename)
-        self.image = path
+        path = os.path.join(directory, filename)
+        file_storage.save(os.path.join(current_app.config['MEDIA_ROOT'], path))
+        return path
+
+    @staticmethod
+    def remove_file(path):
+        """Remove the file. Path is relative to MEDIA_ROOT. Empty path means
+        that the file was not downloaded.
+        """
+        if not path:
+            return
         path = os.path.join(current_app.config['MEDIA_ROOT'], path)
-        file_storage.save(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def save_image(self, file_storage, filename):
+        self.image = self.store_file(file_storage, 'post_images', filename)
 
     def save_thumbnail(self, file_storage, filename):
-        filename = secure_filename(filename)
-        path = os.path.join('post_thumbnails', filename)
-        self.thumbnail = path
-        path = os.path.join(current_app.config['MEDIA_ROOT'], path)
-        file_storage.save(path)
+        self.thumbnail = self.store_file(file_storage, 'post_thumbnails',
+                                         filename)
 
-    def delete_files(self):
+    def delete_files(self, connection=None):
+        """Delete the files of the image. Files shared with other images are
+        deleted with the last one, see File.release.
+        """
+        if File.release(connection or db.session, self.image):
+            return
         for filename in [self.image, self.thumbnail]:
-            path = os.path.join(current_app.config['MEDIA_ROOT'], filename)
-            try:
-                os.remove(path)
-            except FileNotFoundError:
-                pass
+            self.remove_file(filename)
 
     def get_extension(self):
         name, extension = os.path.splitext(self.image)
         return extension
 
 
+class File(db.Model):
+    """Image and thumbnail stored only once for all posts with the same image.
+    Files are named after the MD5 hash of the image. The number of image
+    records referencing the files is counted and they are removed when the
+    last one is deleted.
+    """
+
+    __tablename__ = 'archive_chan_file'
+    __table_args__ = (
+        db.UniqueConstraint('md5', name='_md5_uc'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    md5 = db.Column(db.String(32), nullable=False)
+    # Images are released using their paths.
+    image = db.Column(db.String(255), nullable=False, index=True)
+    thumbnail = db.Column(db.String(255), nullable=False)
+    reference_count = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def add_references(cls, md5, amount=1):
+        """Add references to the stored files. Returns False if the files are
+        not stored.
+        """
+        table = cls.__table__
+        result = db.session.execute(
+            table.update().where(table.c.md5==md5).values(
+                reference_count=table.c.reference_count + amount
+            )
+        )
+        return result.rowcount > 0
+
+    @classmethod
+    def acquire(cls, md5):
+        """Add a reference to the stored files. Returns a dict with the paths
+        of the image and the thumbnail or None if the files are not stored.
+        """
+        table = cls.__table__
+        statement = table.update().where(table.c.md5==md5).values(
+            reference_count=table.c.reference_count + 1
+        )
+        if db.engine.dialect.implicit_returning:
+            row = db.session.execute(
+                statement.returning(table.c.image, table.c.thumbnail)
+            ).first()
+        else:
+            # The updated row stays locked until the transaction ends.
+            if db.session.execute(statement).rowcount == 0:
+                return None
+            row = db.session.execute(
+                db.select([table.c.image, table.c.thumbnail])
+                  .where(table.c.md5==md5)
+            ).first()
+        if row is None:
+            return None
+        return {'image': row.image, 'thumbnail': row.thumbnail}
+
+    @classmethod
+    def dereference(cls, connection, image_path):
+        """Remove a reference to the stored files. Returns a list of the paths
+        of the files which are no longer used and should be removed or None if
+        the image is not stored by this class. The count is decremented and
+        checked by the database so concurrent updates can't remove the files
+        which are still referenced.
+        """
+        table = cls.__table__
+        result = connection.execute(
+            table.update().where(table.c.image==image_path).values(
+                reference_count=table.c.reference_count - 1
+            )
+        )
+        if result.rowcount == 0:
+            return None
+        thumbnail = connection.execute(
+            db.select([table.c.thumbnail]).where(table.c.image==image_path)
+        ).scalar()
+        result = connection.execute(
+            table.delete().where(db.and_(table.c.image==image_path,
+                                         table.c.reference_count <= 0))
+        )
+        if result.rowcount == 0:
+            return []
+        return [image_path, thumbnail]
+
+    @classmethod
+    def release(cls, connection, image_path):
+        """Remove a reference to the stored files and delete them if they are
+        no longer used. Returns False if the image is not stored by this class.
+        """
+        paths = cls.dereference(connection, image_path)
+        if paths is None:
+            return False
+        for path in paths:
+            Image.remove_file(path)
+        return True
+
+
 class Tag(db.Model):
     __tablename__ = 'archive_chan_tag'
     __table_args__ = (
@@ -379,7 +501,80 @@ class Update(db.Model):
         return dict(self.STATUS_CHOICES)[self.status]
 
 
+class CacheValidator(db.Model):
+    """Values of the ETag and Last-Modified headers received with the catalog
+    or the thread data. Used by the scraper to perform conditional requests.
+    """
+
+    __tablename__ = 'archive_chan_cachevalidator'
+    __table_args__ = (
+        db.UniqueConstraint('board_id', 'thread_number',
+                            name='_board_thread_number_uc'),
+    )
+
+    # Value of thread_number used for the catalog.
+    CATALOG = 0
+
+    id = db.Column(db.Integer, primary_key=True)
+    board_id = db.Column(
+        db.String(255),
+        db.ForeignKey(Board.name, deferrable=True, initially='DEFERRED'),
+        nullable=False
+    )
+    thread_number = db.Column(db.Integer, nullable=False)
+    etag = db.Column(db.String(255), nullable=True)
+    last_modified = db.Column(db.String(255), nullable=True)
+
+
+class RetryTask(db.Model):
+    """Thread or file which could not be downloaded during an update. Tasks
+    are retried at the beginning of the following updates until they succeed,
+    fail too many times or expire.
+    """
+
+    __tablename__ = 'archive_chan_retrytask'
+    __table_args__ = (
+        db.UniqueConstraint('board_id', 'kind', 'number',
+                            name='_board_kind_number_uc'),
+    )
+
+    THREAD = 0
+    FILE = 1
+
+    KIND_CHOICES = (
+        (THREAD, 'Thread'),
+        (FILE, 'File'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    board_id = db.Column(
+        db.String(255),
+        db.ForeignKey(Board.name, deferrable=True, initially='DEFERRED'),
+        nullable=False
+    )
+    kind = db.Column(db.SmallInteger, nullable=False)
+
+    # Thread number or id of the post to which the file is attached.
+    number = db.Column(db.Integer, nullable=False)
+
+    # Data of the file, see scraper.DownloadTask.
+    filename = db.Column(db.String(255), nullable=True)
+    extension = db.Column(db.String(255), nullable=True)
+    md5 = db.Column(db.String(32), nullable=True)
+    size = db.Column(db.Integer, nullable=True)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime(timezone=True), nullable=False)
+    last_attempt = db.Column(db.DateTime(timezone=True), nullable=False)
+    error = db.Column(db.String(255), nullable=True)
+
+    def get_kind_display(self):
+        return dict(self.KIND_CHOICES)[self.kind]
+
+
 def pre_image_delete(mapper, connection, target):
-    """Delete the files stored on HDD while deleting the database record."""
-    target.delete_files()
+    """Delete the files stored on HDD while deleting the database record.
+    Files shared with other images are deleted with the last one.
+    """
+    target.delete_files(connection)
 db.event.listen(Image, 'before_delete', pre_image_delete)
@@ -18,6 +18,13 @@
 """
 
 
+# Base urls of the 4chan hosts (API, images, thumbnails) without the trailing
+# slash. They can be changed to point the scraper at a different server, for
+# example the fake server used by the benchmark command.
+API_URL = 'https://a.4cdn.org'
+IMAGES_URL = 'https://i.4cdn.org'
+THUMBNAILS_URL = 'https://t.4cdn.org'
+
 # Delay between two calls to 4chan API (catalog/posts).
 # This should follow the API rules: https://github.com/4chan/4chan-API
 # [seconds]
@@ -28,10 +35,40 @@ API_WAIT = 1
 # [seconds]
 FILE_WAIT = 0
 
+# Number of API calls/file downloads which can be performed immediately one
+# after another if no requests were made recently. After that the requests
+# are spaced by API_WAIT/FILE_WAIT again. The default value of 1 never allows
+# more than one request per interval.
+API_BURST = 1
+FILE_BURST = 1
+
 # Code downloading the data will stop waiting for a response after that time.
 # [seconds]
 CONNECTION_TIMEOUT = 10
 
+# Number of connections kept open to each 4chan host (API, images, thumbnails).
+# Should not be lower than SCRAPER_THREADS_NUMBER otherwise the workers will
+# wait for a free connection. Connections are shared by the boards updated at
+# the same time, see SCRAPER_CONCURRENT_BOARDS.
+HTTP_POOL_SIZE = 10
+
+# Reuse the connections instead of opening a new one for each request.
+HTTP_KEEP_ALIVE = True
+
+# Number of times a request is retried after a connection error, a timeout or
+# a server error. The delay before each retry is random, its limit grows
+# exponentially starting with HTTP_RETRY_BACKOFF up to HTTP_RETRY_MAX_BACKOFF.
+# [seconds]
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF = 0.5
+HTTP_RETRY_MAX_BACKOFF = 30
+
+# After HTTP_BREAKER_THRESHOLD consecutive failed requests to a host no
+# requests are sent to it for HTTP_BREAKER_TIMEOUT seconds, they fail
+# immediately instead. 0 disables this.
+HTTP_BREAKER_THRESHOLD = 10
+HTTP_BREAKER_TIMEOUT = 30
+
 # Used for calculating statistics (e.g. posts per hour).
 # Read more in lib.stats
 # [hours]
@@ -41,6 +78,101 @@ RECENT_POSTS_AGE = 48
 # In other words that many 4chan threads will be updated concurrently.
 SCRAPER_THREADS_NUMBER = 4
 
+# Number of additional threads downloading the images and thumbnails. Posts
+# are added to the database immediately and the files attached to them are
+# downloaded separately.
+SCRAPER_DOWNLOAD_THREADS = 4
+
+# Max number of files waiting to be downloaded. Scrapers adding the posts will
+# wait if the queue is full.
+SCRAPER_DOWNLOAD_QUEUE_SIZE = 1000
+
+# Size of the chunks in which the files are written to disk (bytes). Files are
+# streamed to a temporary file so they are never entirely kept in memory.
+SCRAPER_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Max duration of a board update [seconds]. Threads are processed in the order
+# of their priority, threads which are still queued once the time runs out are
+# skipped until the next update. None disables the limit.
+SCRAPER_TIME_BUDGET = None
+
+# Threads which received fewer than SCRAPER_THREAD_BATCH_REPLIES new replies are
+# downloaded only once the time since the last stored reply exceeds their poll
+# interval, so the quiet threads are downloaded less often. The interval is the
+# time in which the thread usually gets that many replies, limited to the range
+# SCRAPER_THREAD_MIN_INTERVAL - SCRAPER_THREAD_MAX_INTERVAL [seconds]. Threads
+# which are likely to disappear soon are never deferred. Set the max interval
+# to 0 to download all modified threads during each update.
+SCRAPER_THREAD_BATCH_REPLIES = 5
+SCRAPER_THREAD_MIN_INTERVAL = 60
+SCRAPER_THREAD_MAX_INTERVAL = 900
+
+# Number of boards updated at the same time by the update command. All boards
+# share the limits set by API_WAIT and FILE_WAIT.
+SCRAPER_CONCURRENT_BOARDS = 4
+
+# Number of processes which decode and parse the downloaded threads larger than
+# SCRAPER_PARSER_MIN_SIZE (bytes). This lets the scraper use more than one core
+# while updating big threads, the posts are still added to the database by the
+# scraper threads. 0 - threads are parsed by the scraper threads
+SCRAPER_PARSER_PROCESSES = 0
+SCRAPER_PARSER_MIN_SIZE = 128 * 1024
+
+# List of the threads downloaded at the beginning of each update.
+# 'catalog' - catalog.json, contains the first posts which are checked by the
+#             triggers to prioritize the threads and the bump limit flags
+# 'threads' - threads.json, much smaller, contains only the numbers of the
+#             threads and the times of their last modification
+SCRAPER_THREAD_LIST = 'catalog'
+
+# Download the threads which were archived since the last update one last time
+# to catch the posts added just before. Threads which were removed instead of
+# being archived are not requested.
+SCRAPER_FETCH_ARCHIVED = True
+
+# Threads and files which could not be downloaded are stored in the database
+# and retried at the beginning of the following updates, also when the catalog
+# was not modified. A task is dropped after SCRAPER_RETRY_MAX_ATTEMPTS failed
+# attempts or once it is older than SCRAPER_RETRY_MAX_AGE [seconds]. Threads
+# and files which no longer exist (404 Not Found) are not retried.
+SCRAPER_RETRY_MAX_ATTEMPTS = 5
+SCRAPER_RETRY_MAX_AGE = 24 * 60 * 60
+
+# Number of new posts added to the database in a single transaction. By default
+# all changes made to a thread are committed at once. If the update of a thread
+# fails the changes are rolled back to the last commit and the next update
+# resumes from that point.
+# 0 - single transaction per thread
+SCRAPER_COMMIT_INTERVAL = 0
+
+# Scraping engine used by the update command by default. Can be overridden
+# with the --engine option of that command.
+# 'threads' - each of SCRAPER_THREADS_NUMBER threads processes one 4chan thread
+# 'asyncio' - all downloads are performed as coroutines in a single event loop,
+#             requires Python 3.7+, aiohttp is recommended
+SCRAPER_ENGINE = 'threads'
+
+# Number of 4chan threads updated concurrently by the asyncio engine.
+SCRAPER_ASYNC_TASKS = 16
+
+# Max number of concurrent file downloads in the asyncio engine.
+SCRAPER_ASYNC_DOWNLOADS = 100
+
+# Time between the starts of two updates of a board performed by the daemon
+# command [seconds]. Intervals of the individual boards can be overridden in
+# SCRAPER_DAEMON_BOARD_INTERVALS, for example {'b': 30, 'g': 300}.
+SCRAPER_DAEMON_INTERVAL = 600
+SCRAPER_DAEMON_BOARD_INTERVALS = {}
+
+# Intervals of the other boards are adjusted to the rate at which the posts are
+# added so that each update downloads about SCRAPER_DAEMON_TARGET_POSTS posts.
+# SCRAPER_DAEMON_INTERVAL is used until the rate is known. Set the target to 0
+# to disable this.
+# [seconds] (min and max interval)
+SCRAPER_DAEMON_TARGET_POSTS = 100
+SCRAPER_DAEMON_MIN_INTERVAL = 60
+SCRAPER_DAEMON_MAX_INTERVAL = 1800
+
 # Max cache age.
 # Cache is disabled in DEBUG or TESTING mode.
 # See cache.get_preferred_cache_system to learn more.
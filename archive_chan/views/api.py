@@ -222,8 +222,10 @@ class Gallery(ApiView):
         last = request.args.get('last')
         amount = int(request.args.get('amount', 10))
 
+        # Files which were not downloaded yet are skipped.
         queryset = Image.query.join(Post, Thread, Board) \
-                              .options(joinedload(Image.post))
+                              .options(joinedload(Image.post)) \
+                              .filter(Image.thumbnail!='')
 
         if board_name:
             queryset = queryset.filter(
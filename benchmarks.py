@@ -0,0 +1,123 @@
+"""
+    Microbenchmarks of the scraper hot paths. Each benchmark compares the
+    current implementation with the straightforward one it replaced.
+
+    Usage: python benchmarks.py [name ...]
+"""
+
+
+import html
+import random
+import re
+import sys
+import timeit
+from archive_chan import create_app, models, database
+from archive_chan.lib import scraper
+
+
+def get_words(rand, number):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rand.choice(letters) for i in range(rand.randint(3, 10)))
+            for j in range(number)]
+
+
+def report(name, legacy, current):
+    print('%s: legacy %.3fs current %.3fs speedup %.1fx'
+          % (name, legacy, current, legacy / current))
+
+
+def benchmark_triggers(rand):
+    """Triggers.get_actions with a few hundred triggers."""
+    words = get_words(rand, 2000)
+    triggers = [
+        models.Trigger(field=rand.choice(['comment', 'subject', 'name']),
+                       event=rand.choice(['contains', 'contains', 'is',
+                                          'containsno', 'begins']),
+                       phrase=rand.choice(words),
+                       case_sensitive=rand.choice([True, False]),
+                       post_type=rand.choice(['any', 'master', 'sub']),
+                       save_thread=True)
+        for i in range(300)
+    ]
+    thread = models.Thread(number=1)
+    posts = []
+    for i in range(500):
+        post_data = scraper.PostData({'no': i + 1, 'time': 0})
+        post_data.name = 'Anonymous'
+        post_data.subject = ' '.join(rand.sample(words, 3))
+        post_data.comment = ' '.join(rand.sample(words, 60))
+        posts.append(post_data)
+
+    handler = scraper.Triggers()
+    handler.triggers = triggers
+    handler.matcher = scraper.TriggerMatcher(triggers)
+
+    def legacy():
+        for post_data in posts:
+            actions = set()
+            for trigger in triggers:
+                new_actions = handler.get_single_trigger_actions(
+                    trigger, thread, post_data)
+                if not new_actions is None:
+                    actions = actions | new_actions
+
+    def current():
+        for post_data in posts:
+            handler.get_actions(thread, post_data)
+
+    report('triggers', min(timeit.repeat(legacy, number=1, repeat=3)),
+           min(timeit.repeat(current, number=1, repeat=3)))
+
+
+def legacy_replace_content(text):
+    text = re.sub(r'\<a.*?class="quotelink".*?\>(.*?)\</a\>', r'\1', text)
+    text = re.sub(r'\<span.*?\>(.*?)\</span\>', r'\1', text)
+    text = re.sub(r'\<pre.*?\>(.*?)\</pre\>', r'[code]\1[/code]', text)
+    text = text.replace('<br>', '\n')
+    text = text.replace('<wbr>', '')
+    text = html.unescape(text)
+    return text
+
+
+def benchmark_replace_content(rand):
+    """PostData.replace_content with typical comments."""
+    words = get_words(rand, 500)
+    lines = [
+        lambda: '<a href="#p%s" class="quotelink">&gt;&gt;%s</a>'
+                % ((rand.randint(10**7, 10**8),) * 2),
+        lambda: '<span class="quote">&gt;%s</span>'
+                % ' '.join(rand.sample(words, 8)),
+        lambda: ' '.join(rand.sample(words, 15)),
+        lambda: '%s &quot;%s&quot; &amp; %s' % tuple(rand.sample(words, 3)),
+        lambda: 'https://%s.com/%s/<wbr>%s' % tuple(rand.sample(words, 3)),
+    ]
+    comments = ['<br>'.join(rand.choice(lines)() for i in range(5))
+                for j in range(5000)]
+    post_data = scraper.PostData({'no': 1, 'time': 0})
+
+    def legacy():
+        for comment in comments:
+            legacy_replace_content(comment)
+
+    def current():
+        for comment in comments:
+            post_data.replace_content(comment)
+
+    report('replace_content', min(timeit.repeat(legacy, number=1, repeat=3)),
+           min(timeit.repeat(current, number=1, repeat=3)))
+
+
+benchmarks = {
+    'replace_content': benchmark_replace_content,
+    'triggers': benchmark_triggers,
+}
+
+
+if __name__ == '__main__':
+    app = create_app(config={'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+                             'TESTING': True}, envvar=None)
+    names = sys.argv[1:] or sorted(benchmarks)
+    with app.app_context():
+        database.init_db()
+        for name in names:
+            benchmarks[name](random.Random(0))
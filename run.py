@@ -4,8 +4,9 @@ from archive_chan import create_app, commands
 
 
 commands = [
-    'create_user', 'update', 'remove_orphaned_files', 'remove_old_threads',
-    'recount_denormalized', 'sql', 'init_db'
+    'create_user', 'update', 'daemon', 'remove_orphaned_files',
+    'remove_old_threads', 'recount_denormalized', 'sql', 'init_db',
+    'fake_server', 'benchmark'
 ]
 
 
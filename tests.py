@@ -1,13 +1,25 @@
+import base64
 import datetime
+import hashlib
+import html
 import json
 import os
+import queue
+import random
+import re
+import shutil
 import tempfile
+import threading
 import time
 import unittest
+import asyncio
 from flask import url_for
+from sqlalchemy import event, inspect
 from flask.ext.login import current_user
 from archive_chan import create_app, models, database, auth, cache
-from archive_chan.lib import scraper, modifiers, helpers
+from archive_chan.commands import daemon, update, remove_orphaned_files
+from archive_chan.lib import scraper, async_scraper, connection, modifiers, \
+    helpers, ratelimit, fake_server, capture
 from archive_chan.lib.helpers import utc_now, timestamp_to_datetime
 
 
@@ -127,6 +139,34 @@ class BaseTestCase(unittest.TestCase):
         """Custom teardown here."""
         pass
 
+    def use_fake_chan(self, chan):
+        """Answer the requests of all connection pools using the FakeChan
+        without starting the server. The asyncio engine uses the pools instead
+        of aiohttp.
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        for directory in ('post_images', 'post_thumbnails'):
+            os.mkdir(os.path.join(media_root, directory))
+        self.app.config.update({
+            'API_URL': 'http://fake/a',
+            'IMAGES_URL': 'http://fake/i',
+            'THUMBNAILS_URL': 'http://fake/t',
+            'MEDIA_ROOT': media_root,
+            'API_WAIT': 0,
+            'SCRAPER_THREAD_MAX_INTERVAL': 0,
+        })
+
+        def get(pool, url, headers=None, **kwargs):
+            response = chan.get_response(url[len('http://fake'):],
+                                         headers or {})
+            return capture.create_response(url, *response)
+
+        for name, value in (('get', get), ('allows_sessions', False)):
+            self.addCleanup(setattr, connection.ConnectionPool, name,
+                            getattr(connection.ConnectionPool, name))
+            setattr(connection.ConnectionPool, name, value)
+
     def add_model(self, model, **kwargs):
         item = model(**kwargs)
         database.db.session.add(item)
@@ -292,6 +332,1385 @@ class ThreadScraperTest(BaseTestCase):
         self.assertTrue(self.thread_scraper.should_be_updated(broken_thread))
 
 
+class ThreadIngestTest(BaseTestCase):
+
+    def setup(self):
+        thread_json = self.sample_thread_json
+        self.board = self.add_model(models.Board, name='g', replies_threshold=0)
+        self.thread_data = scraper.ThreadData(thread_json)
+        self.thread = self.add_model(models.Thread, board=self.board,
+                                     number=self.thread_data.number)
+
+        # Posts without files, the last one can't be added.
+        self.posts = []
+        for i in range(5):
+            post_json = self.sample_post_json_minimal
+            post_json['no'] = self.thread_data.number + i
+            self.posts.append(post_json)
+
+    def handle_thread_json(self):
+        failing_number = self.posts[-1]['no']
+
+        class TestThreadScraper(scraper.ThreadScraper):
+            def prepare_post(self, post_data, thread):
+                if post_data.number == failing_number:
+                    raise Exception('Failed.')
+                return super().prepare_post(post_data, thread)
+
+        thread_scraper = TestThreadScraper(self.board, self.thread_data)
+        thread_scraper.handle_thread_json(self.thread, {'posts': self.posts}, -1)
+        self.assertFalse(thread_scraper.completed)
+
+    def test_single_transaction(self):
+        """Nothing should be added if the thread could not be processed."""
+        self.app.config['SCRAPER_COMMIT_INTERVAL'] = 0
+        self.handle_thread_json()
+        self.assertEqual(models.Post.query.count(), 0)
+
+    def test_commit_interval(self):
+        """Posts from the commited chunks should be added."""
+        self.app.config['SCRAPER_COMMIT_INTERVAL'] = 4
+        self.handle_thread_json()
+        self.assertEqual(models.Post.query.count(), 4)
+        self.assertEqual(models.Thread.query.one().replies, 4)
+
+    def test_parser_pool(self):
+        """Threads parsed by the parser processes should be added like the
+        other ones.
+        """
+        self.app.config['SCRAPER_PARSER_PROCESSES'] = 1
+        self.app.config['SCRAPER_PARSER_MIN_SIZE'] = 0
+        content = json.dumps({'posts': self.posts}).encode()
+        last_post_number = self.posts[1]['no']
+        parser_pool = scraper.create_parser_pool()
+        try:
+            thread_scraper = scraper.ThreadScraper(self.board, self.thread_data,
+                                                   parser_pool=parser_pool)
+            self.assertTrue(thread_scraper.use_parser_pool(content))
+            parsed_thread = thread_scraper.parse_thread_content(
+                content, last_post_number)
+        finally:
+            parser_pool.shutdown()
+
+        post_numbers, new_posts = parsed_thread
+        self.assertEqual(post_numbers, [post['no'] for post in self.posts])
+        self.assertEqual([post_data.number for post_data in new_posts],
+                         post_numbers[2:])
+        thread_scraper.handle_parsed_thread(self.thread, parsed_thread,
+                                            last_post_number)
+        self.assertTrue(thread_scraper.completed)
+        self.assertEqual(models.Post.query.count(), 3)
+
+    def test_add_posts(self):
+        """Test if the images are added and the denormalized data is
+        updated.
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        for directory in ['post_images', 'post_thumbnails']:
+            os.mkdir(os.path.join(media_root, directory))
+        self.app.config['MEDIA_ROOT'] = media_root
+
+        class TestThreadScraper(scraper.ThreadScraper):
+            def get_file(self, url, file_writer):
+                with file_writer:
+                    file_writer.write(b'file')
+                return file_writer.path
+
+        self.posts[0] = self.sample_post_json
+        self.posts[0]['no'] = self.thread_data.number
+        self.posts[0]['md5'] = base64.b64encode(
+            hashlib.md5(b'file').digest()).decode()
+        self.posts[0]['fsize'] = 4
+        for i, post_json in enumerate(self.posts):
+            post_json['time'] += i
+
+        thread_scraper = TestThreadScraper(self.board, self.thread_data)
+        thread_scraper.handle_thread_json(self.thread, {'posts': self.posts}, -1)
+        self.assertTrue(thread_scraper.completed)
+
+        thread = models.Thread.query.one()
+        self.assertEqual(thread.replies, 5)
+        self.assertEqual(thread.images, 1)
+        self.assertEqual(models.Post.query.count(), 5)
+        image = models.Image.query.one()
+        self.assertEqual(image.post.number, self.thread_data.number)
+        self.assertTrue(os.path.isfile(os.path.join(media_root, image.image)))
+        self.assertEqual(models.File.query.one().image, image.image)
+
+    def test_reuse_files(self):
+        """Files which are already stored should not be downloaded again."""
+        md5 = '0a929c1c73c4eb85cf7c6979328d1fca'
+        stored_file = self.add_model(models.File, md5=md5,
+                                     image='post_images/a.jpg',
+                                     thumbnail='post_thumbnails/a.jpg',
+                                     reference_count=1)
+
+        class TestThreadScraper(scraper.ThreadScraper):
+            def get_file(self, url, file_writer):
+                raise AssertionError('File was downloaded.')
+
+        post_json = self.sample_post_json
+        post_json['no'] = self.thread_data.number
+        post_json['md5'] = self.sample_thread_json['md5']
+        thread_scraper = TestThreadScraper(self.board, self.thread_data)
+        thread_scraper.handle_thread_json(self.thread, {'posts': [post_json]},
+                                          -1)
+
+        image = models.Image.query.one()
+        self.assertEqual(image.image, 'post_images/a.jpg')
+        self.assertEqual(thread_scraper.stats.get('reused_files'), 1)
+        database.db.session.refresh(stored_file)
+        self.assertEqual(stored_file.reference_count, 2)
+
+    def test_release_files(self):
+        """Files should be removed with the last referencing image."""
+        self.add_model(models.File, md5='a', image='post_images/a.jpg',
+                       thumbnail='post_thumbnails/a.jpg', reference_count=2)
+        path = 'post_images/a.jpg'
+        self.assertIsNone(models.File.acquire('b'))
+        self.assertEqual(models.File.acquire('a'),
+                         {'image': path, 'thumbnail': 'post_thumbnails/a.jpg'})
+        database.db.session.commit()
+        self.assertEqual(models.File.dereference(database.db.session, path),
+                         [])
+        database.db.session.commit()
+        with database.db.engine.connect() as connection:
+            self.assertTrue(models.File.release(connection, path))
+            self.assertEqual(models.File.query.one().reference_count, 1)
+            self.assertTrue(models.File.release(connection, path))
+            self.assertFalse(models.File.release(connection, path))
+        # Files are looked up by the image path.
+        indexes = inspect(database.db.engine).get_indexes('archive_chan_file')
+        self.assertIn(['image'], [index['column_names'] for index in indexes])
+
+    def test_delete_image(self):
+        """Deleting an image should release the shared files."""
+        thread_scraper = scraper.ThreadScraper(self.board, self.thread_data)
+        thread_scraper.handle_thread_json(self.thread, {'posts': self.posts},
+                                          -1)
+        post = models.Post.query.first()
+        stored_file = self.add_model(models.File, md5='a',
+                                     image='post_images/a.jpg',
+                                     thumbnail='post_thumbnails/a.jpg',
+                                     reference_count=2)
+        image = self.add_model(models.Image, post=post, original_name='a.jpg',
+                               image=stored_file.image,
+                               thumbnail=stored_file.thumbnail)
+        database.db.session.delete(image)
+        database.db.session.commit()
+        database.db.session.refresh(stored_file)
+        self.assertEqual(stored_file.reference_count, 1)
+
+    def test_orphaned_files(self):
+        """Files stored for many images and partial downloads should not be
+        removed as orphans.
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.app.config['MEDIA_ROOT'] = media_root
+        os.mkdir(os.path.join(media_root, 'post_images'))
+        for filename in ['a.jpg', 'b.jpg', '.c.part']:
+            with open(os.path.join(media_root, 'post_images', filename),
+                      'w') as f:
+                f.write('image')
+        self.add_model(models.File, md5='a', image='post_images/a.jpg',
+                       thumbnail='post_thumbnails/a.jpg', reference_count=1)
+
+        command = remove_orphaned_files.Command()
+        deleted = command.process_directory('post_images',
+                                            command.image_exists_in_db, False)
+        self.assertEqual(deleted, 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(media_root,
+                                                        'post_images'))),
+                         ['.c.part', 'a.jpg'])
+
+    def test_delete_posts(self):
+        """Posts missing in the thread data should be removed together with
+        their files.
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        os.mkdir(os.path.join(media_root, 'post_images'))
+        self.app.config['MEDIA_ROOT'] = media_root
+        with open(os.path.join(media_root, 'post_images', 'a.jpg'), 'w') as f:
+            f.write('image')
+
+        self.posts.pop()
+        thread_scraper = scraper.ThreadScraper(self.board, self.thread_data)
+        thread_scraper.handle_thread_json(self.thread, {'posts': self.posts}, -1)
+        post = models.Post.query.filter_by(number=self.posts[1]['no']).one()
+        self.add_model(models.Image, post=post, original_name='a.jpg',
+                       image='post_images/a.jpg', thumbnail='')
+
+        thread = models.Thread.query.one()
+        thread_scraper = scraper.ThreadScraper(self.board, self.thread_data)
+        thread_scraper.handle_thread_json(thread, {'posts': self.posts[2:]},
+                                          thread_scraper.get_last_post_number(thread))
+        self.assertTrue(thread_scraper.completed)
+        self.assertTrue(thread_scraper.modified)
+
+        thread = models.Thread.query.one()
+        self.assertEqual(thread.replies, 2)
+        self.assertEqual(thread.images, 0)
+        self.assertEqual(models.Post.query.count(), 2)
+        self.assertEqual(models.Image.query.count(), 0)
+        self.assertEqual(thread_scraper.stats.get('removed_posts'), 2)
+        self.assertEqual(os.listdir(os.path.join(media_root, 'post_images')), [])
+
+    def test_download_queue(self):
+        """Files should be scheduled for download after the posts are
+        commited.
+        """
+        self.posts[0] = self.sample_post_json
+        self.posts[0]['no'] = self.thread_data.number
+        download_queue = queue.Queue()
+        thread_scraper = scraper.ThreadScraper(self.board, self.thread_data,
+                                               download_queue=download_queue)
+        thread_scraper.handle_thread_json(self.thread, {'posts': self.posts}, -1)
+
+        image = models.Image.query.one()
+        self.assertEqual(image.image, '')
+        task = download_queue.get_nowait()
+        self.assertEqual(task.post_id, image.post_id)
+        self.assertEqual(task.filename, str(self.sample_post_json['tim']))
+        self.assertTrue(download_queue.empty())
+
+
+class ThreadIndexTest(BaseTestCase):
+
+    def setup(self):
+        self.board = self.add_model(models.Board, name='g', replies_threshold=0)
+        self.thread_data = scraper.ThreadData(self.sample_thread_json)
+        self.thread = self.add_model(models.Thread, board=self.board,
+                                     number=self.thread_data.number)
+        for i in range(self.thread_data.replies + 1):
+            database.db.session.add(models.Post(
+                thread=self.thread, number=self.thread_data.number + i,
+                time=self.thread_data.last_reply_time, name='', trip='',
+                email='', country='', subject='', comment=''
+            ))
+        database.db.session.commit()
+        self.thread_index = scraper.ThreadIndex(self.board)
+        self.thread_index.load()
+
+    def test_load(self):
+        state = self.thread_index.get(self.thread_data.number)
+        self.assertEqual(state.id, self.thread.id)
+        self.assertEqual(state.replies, self.thread_data.replies + 1)
+        self.assertEqual(state.last_post_number,
+                         self.thread_data.number + self.thread_data.replies)
+        self.assertIsNone(self.thread_index.get(1))
+
+    def test_unchanged(self):
+        """Unchanged threads should be skipped without accessing the
+        database.
+        """
+        statements = []
+        def count(*args, **kwargs):
+            statements.append(args)
+
+        thread_scraper = scraper.ThreadScraper(self.board, self.thread_data,
+                                               thread_index=self.thread_index)
+        event.listen(database.db.engine, 'before_cursor_execute', count)
+        try:
+            self.assertIsNone(thread_scraper.get_thread_to_update())
+        finally:
+            event.remove(database.db.engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+
+        self.thread_data.replies += 1
+        self.assertIsNotNone(thread_scraper.get_thread_to_update())
+
+    def test_deferred(self):
+        """Quiet threads with a few new replies should wait for the next
+        updates unless they are likely to disappear.
+        """
+        self.app.config['SCRAPER_THREAD_BATCH_REPLIES'] = 5
+        self.app.config['SCRAPER_THREAD_MIN_INTERVAL'] = 60
+        self.app.config['SCRAPER_THREAD_MAX_INTERVAL'] = 900
+        self.thread_index.last_page = 10
+        state = self.thread_index.get(self.thread_data.number)
+        self.thread_index.set(self.thread_data.number, state._replace(
+            last_reply=utc_now() - datetime.timedelta(seconds=100)
+        ))
+        self.thread_data.last_reply_time = utc_now()
+        self.thread_data.replies += 1
+        thread_scraper = scraper.ThreadScraper(self.board, self.thread_data,
+                                               thread_index=self.thread_index)
+        self.assertEqual(thread_scraper.get_poll_interval(), 900)
+        self.assertIsNone(thread_scraper.get_thread_to_update())
+        self.assertEqual(thread_scraper.stats.get('deferred_threads'), 1)
+
+        self.thread_data.urgent = True
+        self.assertFalse(thread_scraper.is_deferred())
+        self.thread_data.urgent = False
+        self.thread_data.replies += 4
+        self.assertFalse(thread_scraper.is_deferred())
+        self.thread_data.replies -= 4
+        self.thread_index.last_page = None
+        self.assertFalse(thread_scraper.is_deferred())
+        self.thread_index.last_page = 10
+        self.app.config['SCRAPER_THREAD_MAX_INTERVAL'] = 0
+        self.assertFalse(thread_scraper.is_deferred())
+
+
+class PriorityTest(BaseTestCase):
+
+    def setup(self):
+        self.board = self.add_model(models.Board, name='g', replies_threshold=0)
+        self.board_scraper = scraper.BoardScraper(self.board)
+        self.board_scraper.thread_index.load()
+
+    def get_thread_json(self, number, **kwargs):
+        thread_json = dict(self.sample_thread_json, no=number)
+        thread_json.update(kwargs)
+        return thread_json
+
+    def test_order(self):
+        """Threads about to be pruned and threads with many new replies should
+        be processed first.
+        """
+        self.add_model(models.Trigger, field='subject', event='contains',
+                       phrase='keep', case_sensitive=True, post_type='master',
+                       save_thread=True)
+        self.board_scraper.triggers = scraper.Triggers()
+        catalog = [
+            (1, self.get_thread_json(1, replies=1)),
+            (1, self.get_thread_json(2, replies=50)),
+            (1, self.get_thread_json(3, replies=1, sub='keep')),
+            (1, self.get_thread_json(4, replies=1, bumplimit=1)),
+            (10, self.get_thread_json(5, replies=1)),
+            (1, self.get_thread_json(6, replies=1)),
+        ]
+        queue = scraper.PriorityQueue()
+        for page, thread_json in catalog:
+            thread_data = self.board_scraper.get_catalog_item(thread_json,
+                                                              page)
+            self.board_scraper.add_to_queue(
+                queue, self.board_scraper.get_queue_item(thread_data))
+        numbers = [queue.get()[1].number for i in range(len(catalog))]
+        self.assertEqual(numbers, [3, 4, 5, 2, 1, 6])
+
+    def test_process_order(self):
+        """Workers should take the threads in the order of their priority,
+        not in the order of the catalog.
+        """
+        chan = fake_server.FakeChan(threads=6, threads_per_page=2, replies=2,
+                                    file_ratio=0)
+        self.use_fake_chan(chan)
+        self.app.config['SCRAPER_THREADS_NUMBER'] = 1
+        pages = []
+
+        class TestBoardScraper(scraper.BoardScraper):
+            def add_to_queue(self, queue, item):
+                super().add_to_queue(queue, item)
+                # Give the workers time to take the queued threads.
+                time.sleep(0.01)
+
+            def on_thread_scraper_done(self, thread_scraper):
+                pages.append(thread_scraper.thread_data.page)
+                super().on_thread_scraper_done(thread_scraper)
+
+        TestBoardScraper(self.board).update()
+        self.assertEqual(pages, [3, 3, 2, 2, 1, 1])
+
+    def test_catalog(self):
+        """Only the ThreadData should be kept until the catalog is parsed."""
+        chan = fake_server.FakeChan(threads=4, threads_per_page=2, replies=1,
+                                    file_ratio=0)
+        self.use_fake_chan(chan)
+        catalogs = []
+
+        class TestBoardScraper(scraper.BoardScraper):
+            def prioritize_catalog(self, catalog, *args):
+                catalogs.append(catalog)
+                return super().prioritize_catalog(catalog, *args)
+
+        TestBoardScraper(self.board).update()
+        catalog, = catalogs
+        self.assertEqual([thread_data.number for thread_data in catalog],
+                         list(chan.boards['g'].threads))
+        for thread_data in catalog:
+            self.assertIsInstance(thread_data, scraper.ThreadData)
+            self.assertFalse(thread_data.matched)
+
+    def test_time_budget(self):
+        """Threads left once the time budget is exceeded should be skipped."""
+        self.app.config['SCRAPER_TIME_BUDGET'] = 10
+        self.board_scraper.start_time_budget()
+        self.assertFalse(self.board_scraper.is_out_of_time())
+        self.board_scraper.deadline = time.monotonic() - 1
+        self.assertTrue(self.board_scraper.is_out_of_time())
+        self.board_scraper.on_thread_skipped()
+        self.assertEqual(self.board_scraper.stats.get('skipped_threads'), 1)
+
+
+class AsyncThreadScraperTest(BaseTestCase):
+
+    def setup(self):
+        thread_json = self.sample_thread_json
+        thread_json['replies'] = 1
+        self.board = self.add_model(models.Board, name='g', replies_threshold=0)
+        self.thread_data = scraper.ThreadData(thread_json)
+
+        # Post without files so nothing is downloaded.
+        post_json = self.sample_post_json_minimal
+        post_json['no'] = self.thread_data.number
+        self.thread_json = {'posts': [post_json]}
+
+    def get_thread_scraper(self):
+        content = json.dumps(self.thread_json).encode()
+
+        class TestThreadScraper(async_scraper.AsyncThreadScraper):
+            async def fetch_url(self, url, headers=None):
+                return async_scraper.Response(200, {}, content)
+
+        return TestThreadScraper(self.board, self.thread_data,
+                                 queuer=async_scraper.AsyncQueuer())
+
+    def test_handle_thread(self):
+        thread_scraper = self.get_thread_scraper()
+        asyncio.run(thread_scraper.handle_thread_async())
+        self.assertTrue(thread_scraper.modified)
+        self.assertEqual(thread_scraper.stats.get('added_posts'), 1)
+        self.assertEqual(models.Post.query.count(), 1)
+        self.assertEqual(models.Thread.query.one().replies, 1)
+
+
+    def test_failed_thread(self):
+        """Threads which failed should not be stored empty."""
+        for status in (404, 500):
+            class TestThreadScraper(async_scraper.AsyncThreadScraper):
+                async def fetch_url(self, url, headers=None):
+                    return async_scraper.Response(status, {}, b'')
+
+            thread_scraper = TestThreadScraper(
+                self.board, self.thread_data,
+                queuer=async_scraper.AsyncQueuer())
+            self.assertRises(scraper.ScrapError, asyncio.run,
+                             thread_scraper.handle_thread_async())
+        self.assertEqual(models.Thread.query.count(), 0)
+
+
+class AsyncBoardScraperTest(BaseTestCase):
+
+    def test_download_queue(self):
+        """Thread scrapers should wait for the bounded download queue."""
+        board = self.add_model(models.Board, name='g', replies_threshold=0)
+        chan = fake_server.FakeChan(threads=5, replies=5, file_ratio=1,
+                                    file_size=256)
+        self.use_fake_chan(chan)
+        self.app.config['SCRAPER_DOWNLOAD_QUEUE_SIZE'] = 1
+        self.app.config['SCRAPER_ASYNC_DOWNLOADS'] = 1
+        board_scraper = async_scraper.AsyncBoardScraper(board)
+        board_scraper.update()
+        self.assertEqual(board_scraper.download_queue.maxsize, 1)
+        posts = sum(len(thread.posts)
+                    for thread in chan.boards['g'].threads.values())
+        self.assertEqual(models.Image.query.filter(models.Image.image!='')
+                                           .count(), posts)
+
+
+class DaemonTest(BaseTestCase):
+
+    def get_config(self, db_path):
+        config = super().get_config(db_path)
+        config['SCRAPER_DAEMON_INTERVAL'] = 60
+        config['SCRAPER_DAEMON_BOARD_INTERVALS'] = {'b': 20}
+        return config
+
+    def setup(self):
+        self.add_model(models.Board, name='a')
+        self.add_model(models.Board, name='b')
+        self.add_model(models.Board, name='c', active=False)
+        self.now = 0
+        self.updated = []
+
+        test = self
+        class TestDaemon(daemon.Daemon):
+            def update(self, schedule):
+                test.updated.append(schedule.board.name)
+                test.now += 5
+
+        self.daemon = TestDaemon(clock=lambda: self.now)
+
+    def test_intervals(self):
+        """Each board should be updated in its own interval."""
+        self.assertEqual(sorted(self.daemon.schedules), ['a', 'b'])
+        self.assertEqual(self.daemon.run_pending(), 15)
+        self.assertEqual(sorted(self.updated), ['a', 'b'])
+
+        self.updated = []
+        self.now = 20
+        self.assertEqual(self.daemon.run_pending(), 5)
+        self.now = 25
+        self.assertEqual(self.daemon.run_pending(), 15)
+        self.now = 45
+        self.daemon.run_pending()
+        self.assertEqual(self.updated, ['b', 'b'])
+
+        self.updated = []
+        self.now = 60
+        self.daemon.run_pending()
+        self.assertEqual(self.updated, ['a', 'b'])
+
+    def test_reload(self):
+        """Reload should pick up the new boards and intervals and keep the
+        schedule of the existing boards.
+        """
+        self.daemon.run_pending()
+        self.updated = []
+        config, envvar = self.app.config_sources
+        config['SCRAPER_DAEMON_BOARD_INTERVALS'] = {'b': 30}
+        self.add_model(models.Board, name='d')
+        self.daemon.request_reload()
+        self.daemon.run_pending()
+        self.assertEqual(self.updated, [])
+        self.daemon.reload()
+        self.assertEqual(self.daemon.run_pending(), 20)
+        self.assertEqual(self.updated, ['d'])
+        self.assertEqual(self.daemon.schedules['b'].next_update, 35)
+
+    def test_adaptive_interval(self):
+        """Intervals should follow the post rate within the bounds, fixed
+        intervals should not change.
+        """
+        self.app.config['SCRAPER_DAEMON_TARGET_POSTS'] = 100
+        self.app.config['SCRAPER_DAEMON_MIN_INTERVAL'] = 30
+        self.app.config['SCRAPER_DAEMON_MAX_INTERVAL'] = 600
+        a = self.daemon.schedules['a']
+        b = self.daemon.schedules['b']
+        self.assertTrue(a.adaptive)
+        self.assertFalse(b.adaptive)
+
+        a.on_update(0, 1000)
+        self.assertEqual(a.interval, 60)
+        a.on_update(100, 200)
+        self.assertEqual(a.interval, 50)
+        a.on_update(150, 0)
+        self.assertEqual(a.interval, 100)
+        a.on_update(250, 10000)
+        self.assertEqual(a.interval, 30)
+        a.post_rate = 0
+        a.adapt_interval()
+        self.assertEqual(a.interval, 600)
+
+        b.on_update(0, 0)
+        b.on_update(100, 1000)
+        self.assertEqual(b.interval, 20)
+
+    def test_post_rate(self):
+        """Post rate should be estimated using the previous updates."""
+        board = models.Board.query.get('a')
+        start = utc_now()
+        for i, added_posts in enumerate([0, 50, 150]):
+            self.add_model(models.Update, board=board, used_threads=1,
+                           start=start + datetime.timedelta(seconds=100 * i),
+                           status=models.Update.COMPLETED,
+                           added_posts=added_posts)
+        self.assertEqual(self.daemon.get_post_rate(board), 1)
+        self.daemon.schedules = {}
+        self.daemon.load()
+        self.assertEqual(self.daemon.schedules['a'].interval, 100)
+
+
+class DaemonUpdateTest(BaseTestCase):
+
+    def test_threads(self):
+        """Updates should reuse the workers and the state of the board, the
+        workers are stopped with the daemon.
+        """
+        self.add_model(models.Board, name='g', replies_threshold=0)
+        chan = fake_server.FakeChan(threads=5, replies=3, file_ratio=0.5,
+                                    file_size=256)
+        self.use_fake_chan(chan)
+        updater = daemon.Daemon()
+        schedule = updater.schedules['g']
+        loads = []
+        for state in (schedule.validators, schedule.thread_index):
+            state.load = lambda load=state.load: loads.append(load())
+        try:
+            updater.update(schedule)
+            active_count = threading.active_count()
+            workers = list(updater.worker_pool.workers)
+            for i in range(3):
+                chan.advance(5)
+                updater.update(schedule)
+                self.assertEqual(threading.active_count(), active_count)
+            # Workers and the state of the board are reused.
+            self.assertEqual(updater.worker_pool.workers, workers)
+            self.assertEqual(len(loads), 2)
+        finally:
+            updater.close_pools()
+        self.assertEqual(threading.active_count(),
+                         active_count - len(workers)
+                         - self.app.config['SCRAPER_DOWNLOAD_THREADS'])
+        self.assertEqual(models.Update.query.count(), 4)
+        self.assertTrue(models.Image.query.count() > 0)
+
+
+class UpdateBoardsTest(BaseTestCase):
+
+    def test_concurrent(self):
+        """Boards should be updated concurrently with shared rate limits,
+        connection pool and separate Update records.
+        """
+        for name in ['a', 'b', 'c', 'd']:
+            self.add_model(models.Board, name=name)
+        self.app.config['SCRAPER_CONCURRENT_BOARDS'] = 2
+        lock = threading.Lock()
+        running = []
+        buckets = []
+        pools = []
+        max_running = []
+
+        class TestBoardScraper(scraper.BoardScraper):
+            def update(self):
+                with lock:
+                    running.append(self.board.name)
+                    max_running.append(len(running))
+                    buckets.append(self.queuer.buckets)
+                    pools.append(self.connection_pool)
+                time.sleep(0.1)
+                self.stats.add('added_posts', ord(self.board.name))
+                with lock:
+                    running.remove(self.board.name)
+
+        boards = models.Board.query.all()
+        update.update_boards(TestBoardScraper, boards)
+        self.assertEqual(max(max_running), 2)
+        self.assertTrue(all(bucket is buckets[0] for bucket in buckets))
+        self.assertTrue(all(pool is pools[0] for pool in pools))
+        updates = models.Update.query.all()
+        self.assertEqual(len(updates), 4)
+        for record in updates:
+            self.assertEqual(record.status, models.Update.COMPLETED)
+            self.assertEqual(record.added_posts, ord(record.board_id))
+
+
+    def test_last_page(self):
+        """Threads on the last page of the catalog should not be deferred by
+        the update command which doesn't keep the thread index.
+        """
+        board = self.add_model(models.Board, name='g', replies_threshold=0)
+        chan = fake_server.FakeChan(threads=4, threads_per_page=2, replies=3,
+                                    file_ratio=0)
+        self.use_fake_chan(chan)
+        self.app.config.update({
+            'SCRAPER_THREAD_BATCH_REPLIES': 5,
+            'SCRAPER_THREAD_MIN_INTERVAL': 60,
+            'SCRAPER_THREAD_MAX_INTERVAL': 900,
+        })
+        update.update_boards(scraper.BoardScraper, [board])
+
+        # Reply which doesn't bump the thread on the last page.
+        fake_board = chan.boards['g']
+        thread = list(fake_board.threads.values())[-1]
+        now = fake_board.last_time + 1
+        thread.posts.append(fake_board.create_post(now, thread))
+        thread.modify(now)
+        fake_board.modify()
+        update.update_boards(scraper.BoardScraper, [board])
+
+        posts = models.Post.query.join(models.Thread) \
+                                 .filter(models.Thread.number==thread.number)
+        self.assertEqual(posts.count(), len(thread.posts))
+
+
+class ValidatorsTest(BaseTestCase):
+
+    def setup(self):
+        self.board = self.add_model(models.Board, name='g')
+
+    def test_headers(self):
+        validators = scraper.Validators(self.board)
+        self.assertEqual(validators.get_headers(1), {})
+
+        validators.set(1, {'ETag': 'tag', 'Last-Modified': 'date'})
+        self.assertEqual(validators.get_headers(1), {
+            'If-None-Match': 'tag',
+            'If-Modified-Since': 'date',
+        })
+
+        validators.remove(1)
+        self.assertEqual(validators.get_headers(1), {})
+
+    def test_save_load(self):
+        """Test if the validators of the threads which are no longer present
+        in the catalog are discarded.
+        """
+        validators = scraper.Validators(self.board)
+        validators.set(models.CacheValidator.CATALOG, {'Last-Modified': 'date'})
+        validators.set(1, {'Last-Modified': 'date'})
+        validators.set(2, {'Last-Modified': 'date'})
+        validators.save([2])
+        self.assertEqual(validators.get_thread_numbers(), {2})
+
+        validators = scraper.Validators(self.board)
+        self.assertFalse(validators.loaded)
+        validators.load()
+        self.assertTrue(validators.loaded)
+        self.assertTrue(validators.get_headers(models.CacheValidator.CATALOG))
+        self.assertFalse(validators.get_headers(1))
+        self.assertTrue(validators.get_headers(2))
+
+    def test_not_modified(self):
+        """Test if the thread is not processed after receiving 304."""
+        thread_json = self.sample_thread_json
+        thread_json['replies'] = 0
+        self.board.replies_threshold = 0
+        thread = self.add_model(models.Thread, board=self.board,
+                                number=thread_json['no'], replies=1)
+
+        class TestThreadScraper(scraper.ThreadScraper):
+            def get_url(self, url, headers=None):
+                self.headers = headers
+                return async_scraper.Response(304, {}, b'')
+
+        validators = scraper.Validators(self.board)
+        validators.set(thread.number, {'ETag': 'tag'})
+        thread_scraper = TestThreadScraper(self.board,
+                                           scraper.ThreadData(thread_json),
+                                           validators=validators)
+        thread_scraper.handle_thread()
+        self.assertEqual(thread_scraper.headers, {'If-None-Match': 'tag'})
+        self.assertTrue(thread_scraper.completed)
+        self.assertFalse(thread_scraper.modified)
+        self.assertEqual(thread_scraper.stats.get('not_modified'), 1)
+
+
+class ThreadListTest(BaseTestCase):
+
+    def setup(self):
+        self.board = self.add_model(models.Board, name='g', replies_threshold=0)
+        self.last_modified = 'Wed, 27 Aug 2014 10:00:00 GMT'
+        self.timestamp = 1409133600
+
+    def test_last_modified(self):
+        """Threads should be skipped if the last modification listed by the
+        API is not newer than the one of the stored data.
+        """
+        validators = scraper.Validators(self.board)
+        validators.set(1, {'Last-Modified': self.last_modified})
+        thread_data = scraper.ThreadData({'no': 1, 'replies': 10,
+                                          'last_modified': self.timestamp})
+        self.assertIsNone(thread_data.created)
+        self.assertEqual(thread_data.last_reply_time,
+                         thread_data.last_modified)
+        thread_scraper = scraper.ThreadScraper(self.board, thread_data,
+                                               validators=validators)
+        self.assertTrue(thread_scraper.is_unchanged())
+        self.assertEqual(thread_scraper.get_poll_interval(), 0)
+
+        thread_data.last_modified += datetime.timedelta(seconds=1)
+        self.assertFalse(thread_scraper.is_unchanged())
+
+    def test_archived(self):
+        """Threads which disappeared from the catalog should be downloaded
+        again only if they were archived.
+        """
+        class TestBoardScraper(scraper.BoardScraper):
+            def get_archive(self):
+                self.archive_requests += 1
+                return {2, 4}
+
+        board_scraper = TestBoardScraper(self.board)
+        board_scraper.archive_requests = 0
+        for number in [1, 2, 3]:
+            board_scraper.validators.set(number, {'ETag': 'tag'})
+        self.assertEqual(board_scraper.get_archived_threads([1, 2, 3]), [])
+        self.assertEqual(board_scraper.archive_requests, 0)
+        self.assertEqual(board_scraper.get_archived_threads([1]), [2])
+        self.assertEqual(board_scraper.archive_requests, 1)
+
+        priority, thread_data = board_scraper.get_archived_queue_item(2)
+        self.assertTrue(thread_data.archived)
+        thread = self.add_model(models.Thread, board=self.board, number=2)
+        thread_scraper = scraper.ThreadScraper(self.board, thread_data)
+        self.assertEqual(thread_scraper.get_thread_to_update().id, thread.id)
+        self.assertEqual(thread_scraper.stats.get('archived_threads'), 1)
+
+        self.app.config['SCRAPER_FETCH_ARCHIVED'] = False
+        self.assertEqual(board_scraper.get_archived_threads([1]), [])
+
+
+class RetryQueueTest(BaseTestCase):
+
+    def setup(self):
+        self.board = self.add_model(models.Board, name='g', replies_threshold=0)
+        self.thread = self.add_model(models.Thread, board=self.board, number=1)
+        self.post = self.add_model(models.Post, thread=self.thread, number=1,
+                                   time=utc_now(), name='', trip='',
+                                   email='', country='', subject='',
+                                   comment='')
+        self.add_model(models.Image, post=self.post, original_name='a.jpg',
+                       image='', thumbnail='')
+        self.task = scraper.DownloadTask(self.post.id, '123', '.jpg', None, 10)
+
+    def test_load(self):
+        """Tasks should be loaded until they expire."""
+        self.app.config['SCRAPER_RETRY_MAX_ATTEMPTS'] = 2
+        retry_queue = scraper.RetryQueue(self.board)
+        retry_queue.add_thread(1, scraper.ScrapError('Failed.'))
+        retry_queue.add_thread(2)
+        retry_queue.add_thread(2)
+        retry_queue.add_file(self.task)
+        retry_queue.add_file(self.task._replace(post_id=self.post.id + 1))
+        retry_queue.load()
+        self.assertEqual(retry_queue.get_threads(), {1})
+        self.assertEqual(retry_queue.get_files(), [self.task])
+        self.assertEqual(models.RetryTask.query.filter_by(number=1).first()
+                         .error, 'Failed.')
+
+        retry_queue.remove_thread(1)
+        retry_queue.remove_file(self.task)
+        retry_queue.load()
+        self.assertEqual(retry_queue.get_threads(), set())
+        self.assertEqual(retry_queue.get_files(), [])
+
+        self.app.config['SCRAPER_RETRY_MAX_AGE'] = 0
+        retry_queue.add_thread(3)
+        retry_queue.load()
+        self.assertEqual(models.RetryTask.query.count(), 0)
+
+    def test_thread_scraper_done(self):
+        """Failed threads should be queued unless they no longer exist."""
+        board_scraper = scraper.BoardScraper(self.board)
+        for number, error in ((1, scraper.NotFound()), (2, Exception())):
+            thread_data = scraper.ThreadData({'no': number, 'replies': 0})
+            thread_scraper = scraper.ThreadScraper(self.board, thread_data)
+            thread_scraper.error = error
+            board_scraper.on_thread_scraper_done(thread_scraper)
+        self.assertEqual(board_scraper.failed_threads, 2)
+        self.assertEqual(board_scraper.queued_threads, 1)
+
+        board_scraper.load_retry_queue()
+        self.assertEqual(board_scraper.retried_threads, {2})
+        self.assertTrue(board_scraper.has_retries())
+        thread_data = scraper.ThreadData({'no': 2, 'replies': 0})
+        thread_scraper = scraper.ThreadScraper(self.board, thread_data)
+        thread_scraper.completed = True
+        board_scraper.on_thread_scraper_done(thread_scraper)
+        self.assertEqual(models.RetryTask.query.count(), 0)
+
+    def test_failed_thread(self):
+        """Threads which failed should not be stored empty."""
+        class TestThreadScraper(scraper.ThreadScraper):
+            def get_url(self, url, headers=None):
+                if self.thread_data.number == 2:
+                    raise connection.requests.ConnectionError()
+                return capture.create_response(url, 200, {}, b'{')
+
+        board_scraper = scraper.BoardScraper(self.board)
+        for number in (2, 3):
+            thread_data = scraper.ThreadData.for_retried_thread(number)
+            thread_scraper = TestThreadScraper(self.board, thread_data)
+            try:
+                thread_scraper.handle_thread()
+            except scraper.ScrapError:
+                pass
+            board_scraper.on_thread_scraper_done(thread_scraper)
+        self.assertEqual(board_scraper.queued_threads, 2)
+        self.assertEqual(models.RetryTask.query.count(), 2)
+        self.assertEqual(models.Thread.query.count(), 1)
+
+    def test_retried_threads(self):
+        """Retried threads should be processed first."""
+        board_scraper = scraper.BoardScraper(self.board)
+        board_scraper.retried_threads = {1, 2, 3}
+        self.assertEqual(board_scraper.get_retried_threads([1, 4]), [2, 3])
+
+        priority, thread_data = board_scraper.get_queue_item(
+            board_scraper.get_catalog_item(
+                dict(self.sample_thread_json, no=1), 1))
+        self.assertTrue(thread_data.urgent)
+
+        priority, thread_data = board_scraper.get_retried_queue_item(1)
+        self.assertTrue(thread_data.retried)
+        thread_scraper = scraper.ThreadScraper(self.board, thread_data)
+        self.assertEqual(thread_scraper.get_thread_to_update().id,
+                         self.thread.id)
+        self.assertEqual(thread_scraper.stats.get('retried_threads'), 1)
+
+
+class FakeServerTest(BaseTestCase):
+
+    def setup(self):
+        self.board = self.add_model(models.Board, name='g', replies_threshold=0)
+        self.chan = fake_server.FakeChan(threads=10, replies=5,
+                                         file_ratio=0.2, file_size=1024)
+        self.fake_board = self.chan.boards['g']
+
+    def teardown(self):
+        if hasattr(self, 'media_root'):
+            shutil.rmtree(self.media_root)
+
+    def get_post_numbers(self):
+        return sorted(post['no'] for thread in self.fake_board.threads.values()
+                      for post in thread.posts)
+
+    def test_responses(self):
+        """Test if the API is served with the validators."""
+        response = self.chan.get_response('/a/g/catalog.json', {})
+        self.assertEqual(response.status, 200)
+        pages = json.loads(response.body.decode())
+        self.assertEqual(sum(len(page['threads']) for page in pages), 10)
+
+        etag = response.headers['ETag']
+        response = self.chan.get_response('/a/g/catalog.json',
+                                          {'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+
+        thread = pages[0]['threads'][0]
+        response = self.chan.get_response('/a/g/thread/%s.json'
+                                          % thread['no'], {})
+        posts = json.loads(response.body.decode())['posts']
+        self.assertEqual(len(posts), thread['replies'] + 1)
+        self.assertEqual(self.chan.get_response('/a/g/thread/1.json',
+                                                {}).status, 404)
+
+        response = self.chan.get_response('/i/g/%s.jpg' % posts[0]['tim'], {})
+        md5 = base64.b64encode(hashlib.md5(response.body).digest()).decode()
+        self.assertEqual(md5, posts[0]['md5'])
+
+        self.chan.advance(200)
+        response = self.chan.get_response('/a/g/catalog.json',
+                                          {'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertTrue(self.fake_board.archive)
+        self.assertEqual(self.chan.get_stats()['a'], 5)
+
+    def test_update(self):
+        """Scraper pointed at the fake server should store all posts."""
+        server = fake_server.create_server(self.chan)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://%s:%s' % server.server_address
+
+        self.media_root = tempfile.mkdtemp()
+        for directory in ('post_images', 'post_thumbnails'):
+            os.mkdir(os.path.join(self.media_root, directory))
+        self.app.config.update({
+            'API_URL': url + '/a',
+            'IMAGES_URL': url + '/i',
+            'THUMBNAILS_URL': url + '/t',
+            'MEDIA_ROOT': self.media_root,
+            'API_WAIT': 0,
+            'SCRAPER_THREADS_NUMBER': 1,
+            'SCRAPER_DOWNLOAD_THREADS': 1,
+            'SCRAPER_THREAD_MAX_INTERVAL': 0,
+        })
+        try:
+            for i in range(2):
+                scraper.BoardScraper(self.board).update()
+                database.db.session.commit()
+                numbers = [post.number for post in models.Post.query
+                           .join(models.Thread)
+                           .filter(models.Thread.number.in_(
+                               self.fake_board.threads))
+                           .order_by(models.Post.number)]
+                self.assertEqual(numbers, self.get_post_numbers())
+                self.chan.advance(20)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(models.Image.query.filter(models.Image.image=='')
+                         .count(), 0)
+
+
+class CaptureTest(BaseTestCase):
+
+    url = 'https://a.4cdn.org/g/catalog.json'
+
+    def setup(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.capture = capture.Capture(self.path)
+
+    def teardown(self):
+        self.capture.close()
+        os.unlink(self.path)
+
+    def test_record(self):
+        """Recorded responses should be returned unchanged."""
+        class Session(object):
+            def get(self, url, **kwargs):
+                return capture.create_response(url, 200, {
+                    'ETag': '"1"',
+                    'Set-Cookie': 'a=b',
+                }, b'body')
+
+        pool = capture.RecordingConnectionPool(self.capture)
+        pool.get_session = lambda url: Session()
+        response = pool.get(self.url, stream=True)
+        self.assertEqual(b''.join(response.iter_content(2)), b'body')
+
+        (id, status, headers), = self.capture.get_responses(self.url)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers, {'ETag': '"1"'})
+        self.assertEqual(self.capture.get_body(id), b'body')
+        self.assertEqual(self.capture.get_boards(), ['g'])
+
+    def test_replay(self):
+        """Responses should be replayed in order and match the validators
+        sent with the requests.
+        """
+        self.capture.add(self.url, 200, {'ETag': '"1"'}, b'first')
+        self.capture.add(self.url, 304, {'ETag': '"1"'}, b'')
+        self.capture.add(self.url, 200, {'ETag': '"2"'}, b'second')
+        pool = capture.ReplayConnectionPool(self.capture)
+
+        response = pool.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'first')
+        response = pool.get(self.url, headers={'If-None-Match': '"1"'})
+        self.assertEqual(response.status_code, 304)
+        response = pool.get(self.url, headers={'If-None-Match': '"1"'})
+        self.assertEqual(response.headers['etag'], '"2"')
+        self.assertEqual(b''.join(response.iter_content(4)), b'second')
+        # The last response is repeated.
+        response = pool.get(self.url, headers={'If-None-Match': '"2"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(pool.get(self.url + '?').status_code, 404)
+        self.assertEqual(pool.requests, 5)
+
+        # Recorded 304 is replaced by a full response if the request isn't
+        # conditional.
+        pool = capture.ReplayConnectionPool(self.capture)
+        pool.get(self.url)
+        self.assertEqual(pool.get(self.url).content, b'second')
+
+
+class TokenBucketTest(BaseTestCase):
+
+    def setup(self):
+        self.now = 100
+
+    def get_bucket(self, interval, burst=1):
+        return ratelimit.TokenBucket(interval, burst, clock=lambda: self.now)
+
+    def test_interval(self):
+        """Requests should be spaced by the interval, also if it is longer
+        than a second.
+        """
+        bucket = self.get_bucket(1.5)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 1.5)
+        self.assertEqual(bucket.reserve(), 3)
+        self.now += 10
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_burst(self):
+        """Unused slots should accumulate up to the size of the burst."""
+        bucket = self.get_bucket(1, burst=3)
+        for i in range(3):
+            self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 1)
+        self.now += 2
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 1)
+
+    def test_no_limit(self):
+        bucket = self.get_bucket(0)
+        for i in range(3):
+            self.assertEqual(bucket.reserve(), 0)
+
+    def test_queuer(self):
+        """Time spent waiting should be counted."""
+        self.app.config['API_WAIT'] = 0.05
+        queuer = scraper.Queuer()
+        queuer.api_wait()
+        queuer.api_wait()
+        queuer.file_wait()
+        self.assertGreaterEqual(queuer.get_total_wait_time().total_seconds(),
+                                0.04)
+        self.assertGreaterEqual(queuer.get_total_wait_time_with_lock(),
+                                queuer.get_total_wait_time())
+
+
+class ConnectionPoolTest(BaseTestCase):
+
+    def test_sessions(self):
+        """Test if a single session is used for each host."""
+        pool = connection.ConnectionPool()
+        api1 = pool.get_session('https://a.4cdn.org/g/catalog.json')
+        api2 = pool.get_session('https://a.4cdn.org/g/thread/1.json')
+        image = pool.get_session('https://i.4cdn.org/g/1.jpg')
+        self.assertIs(api1, api2)
+        self.assertIsNot(api1, image)
+
+        pool.close()
+        self.assertIsNot(api1, pool.get_session('https://a.4cdn.org/'))
+
+    def get_pool(self, responses):
+        """Returns a pool which returns the responses without performing the
+        requests and doesn't sleep between the retries.
+        """
+        class Session(object):
+            def get(self, url, **kwargs):
+                response = responses.pop(0)
+                if isinstance(response, BaseException):
+                    raise response
+                return response
+
+        class Response(object):
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+            def close(self):
+                pass
+
+        responses[:] = [r if isinstance(r, BaseException) else Response(r)
+                        for r in responses]
+        pool = connection.ConnectionPool()
+        pool.get_session = lambda url: Session()
+        pool.get_backoff = lambda attempt: 0
+        return pool
+
+    def test_retries(self):
+        """Server and connection errors should be retried."""
+        self.app.config['HTTP_RETRIES'] = 2
+        timeout = connection.requests.exceptions.Timeout()
+        responses = [503, timeout, 200]
+        pool = self.get_pool(responses)
+        self.assertEqual(pool.get('https://a.4cdn.org/').status_code, 200)
+        self.assertEqual(responses, [])
+
+        responses = [500, 502, 504, 200]
+        pool = self.get_pool(responses)
+        self.assertEqual(pool.get('https://a.4cdn.org/').status_code, 504)
+
+        responses = [404, 200]
+        pool = self.get_pool(responses)
+        self.assertEqual(pool.get('https://a.4cdn.org/').status_code, 404)
+
+        responses = [timeout, timeout, timeout]
+        pool = self.get_pool(responses)
+        with self.assertRaises(connection.requests.exceptions.Timeout):
+            pool.get('https://a.4cdn.org/')
+
+        reset = connection.requests.exceptions.ChunkedEncodingError()
+        responses = [reset, 200]
+        pool = self.get_pool(responses)
+        self.assertEqual(pool.get('https://a.4cdn.org/').status_code, 200)
+
+    def test_retry_wait(self):
+        """Each retry should take a slot from the rate limiter."""
+        self.app.config['HTTP_RETRIES'] = 3
+        waits = []
+        responses = [503, 503, 200]
+        pool = self.get_pool(responses)
+        pool.get('https://a.4cdn.org/', wait=lambda: waits.append(1))
+        self.assertEqual(len(waits), 2)
+
+    def test_backoff(self):
+        """Delays should be random and limited."""
+        self.app.config['HTTP_RETRY_BACKOFF'] = 1
+        self.app.config['HTTP_RETRY_MAX_BACKOFF'] = 5
+        pool = connection.ConnectionPool()
+        for attempt, limit in ((0, 1), (1, 2), (2, 4), (3, 5), (10, 5)):
+            for i in range(20):
+                self.assertTrue(0 <= pool.get_backoff(attempt) <= limit)
+
+    def test_breaker(self):
+        """Breaker should open after consecutive failures and let a single
+        trial request through after the timeout.
+        """
+        now = [0]
+        breaker = connection.CircuitBreaker(3, 30, clock=lambda: now[0])
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        now[0] = 30
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        now[0] = 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_breaker_pool(self):
+        """Pool should fail fast once the breaker of the host is open."""
+        self.app.config['HTTP_RETRIES'] = 0
+        self.app.config['HTTP_BREAKER_THRESHOLD'] = 2
+        error = connection.requests.exceptions.ConnectionError()
+        responses = [error, error, 200, 200]
+        pool = self.get_pool(responses)
+        for i in range(2):
+            with self.assertRaises(connection.requests.exceptions
+                                   .ConnectionError):
+                pool.get('https://a.4cdn.org/')
+        with self.assertRaises(connection.HostUnavailable):
+            pool.get('https://a.4cdn.org/')
+        # Other hosts are not affected.
+        self.assertEqual(pool.get('https://i.4cdn.org/').status_code, 200)
+
+    def test_breaker_unexpected_error(self):
+        """Unexpected errors of the trial request should not leave the
+        breaker open for good.
+        """
+        self.app.config['HTTP_RETRIES'] = 0
+        self.app.config['HTTP_BREAKER_THRESHOLD'] = 1
+        error = connection.requests.exceptions.ConnectionError()
+        responses = [error, ValueError(), 200]
+        pool = self.get_pool(responses)
+        now = [0]
+        breaker = pool.get_breaker('https://a.4cdn.org/')
+        breaker.clock = lambda: now[0]
+        with self.assertRaises(connection.requests.exceptions
+                               .ConnectionError):
+            pool.get('https://a.4cdn.org/')
+        now[0] = 100
+        with self.assertRaises(ValueError):
+            pool.get('https://a.4cdn.org/')
+        with self.assertRaises(connection.HostUnavailable):
+            pool.get('https://a.4cdn.org/')
+        now[0] = 200
+        self.assertEqual(pool.get('https://a.4cdn.org/').status_code, 200)
+
+    def test_breaker_interrupted(self):
+        """Interrupted trial requests should not open the breaker again."""
+        self.app.config['HTTP_RETRIES'] = 0
+        self.app.config['HTTP_BREAKER_THRESHOLD'] = 1
+        error = connection.requests.exceptions.ConnectionError()
+        responses = [error, KeyboardInterrupt(), 200]
+        pool = self.get_pool(responses)
+        now = [0]
+        breaker = pool.get_breaker('https://a.4cdn.org/')
+        breaker.clock = lambda: now[0]
+        with self.assertRaises(connection.requests.exceptions
+                               .ConnectionError):
+            pool.get('https://a.4cdn.org/')
+        now[0] = 100
+        with self.assertRaises(KeyboardInterrupt):
+            pool.get('https://a.4cdn.org/')
+        self.assertEqual(pool.get('https://a.4cdn.org/').status_code, 200)
+
+    @unittest.skipIf(async_scraper.aiohttp is None,
+                     'aiohttp is not installed.')
+    def test_breaker_async(self):
+        """Only the network errors of the asyncio engine should be recorded
+        by the breaker, cancelled requests give up the trial.
+        """
+        self.app.config['HTTP_RETRIES'] = 0
+        self.app.config['HTTP_BREAKER_THRESHOLD'] = 1
+        board = self.add_model(models.Board, name='g')
+        responses = [async_scraper.aiohttp.ClientError(),
+                     asyncio.CancelledError(), ValueError()]
+
+        class Session(object):
+            async def get(self, url, **kwargs):
+                raise responses.pop(0)
+
+        board_scraper = async_scraper.AsyncBoardScraper(board,
+                                                        session=Session())
+        pool = board_scraper.connection_pool
+        now = [0]
+        breaker = pool.get_breaker('https://a.4cdn.org/')
+        breaker.clock = lambda: now[0]
+        for exception in (async_scraper.aiohttp.ClientError,
+                          asyncio.CancelledError, ValueError):
+            with self.assertRaises(exception):
+                asyncio.run(board_scraper.request('https://a.4cdn.org/'))
+            self.assertIsNotNone(breaker.opened_at)
+            self.assertFalse(breaker.trial_pending)
+            now[0] += 100
+        self.assertEqual(breaker.failures, 1)
+        board_scraper.close_pools()
+
+
+class FileWriterTest(BaseTestCase):
+
+    def setup(self):
+        self.media_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.media_root, 'post_images'))
+        self.app.config['MEDIA_ROOT'] = self.media_root
+
+    def teardown(self):
+        shutil.rmtree(self.media_root)
+
+    def get_files(self):
+        return os.listdir(os.path.join(self.media_root, 'post_images'))
+
+    def test_write(self):
+        """Chunks should be written to a temporary file which is moved in place
+        once the file is verified.
+        """
+        md5 = hashlib.md5(b'chunk1chunk2').hexdigest()
+        file_writer = scraper.FileWriter('post_images', 'a.jpg', size=12,
+                                         md5=md5)
+        with file_writer:
+            file_writer.write(b'chunk1')
+            self.assertNotIn('a.jpg', self.get_files())
+            file_writer.write(b'chunk2')
+        self.assertEqual(file_writer.path, os.path.join('post_images', 'a.jpg'))
+        self.assertEqual(self.get_files(), ['a.jpg'])
+        umask = os.umask(0o022)
+        os.umask(umask)
+        mode = os.stat(os.path.join(self.media_root, file_writer.path)).st_mode
+        self.assertEqual(mode & 0o777, 0o666 & ~umask)
+
+    def test_verify(self):
+        """Files with a wrong size or MD5 should not be saved."""
+        def write(size, md5):
+            with scraper.FileWriter('post_images', 'a.jpg', size=size,
+                                    md5=md5) as file_writer:
+                file_writer.write(b'chunk')
+
+        md5 = hashlib.md5(b'chunk').hexdigest()
+        self.assertRises(scraper.ScrapError, write, 4, md5)
+        self.assertRises(scraper.ScrapError, write, 6, md5)
+        self.assertRises(scraper.ScrapError, write, 5, 'wrong')
+        self.assertEqual(self.get_files(), [])
+        write(5, md5)
+        self.assertEqual(self.get_files(), ['a.jpg'])
+
+
+class CatalogParserTest(BaseTestCase):
+
+    def setup(self):
+        self.catalog = [
+            {
+                'page': page,
+                'threads': [self.sample_thread_json for i in range(3)],
+                'other': [1, {'threads': []}],
+            }
+            for page in range(1, 4)
+        ]
+        self.data = json.dumps(self.catalog, indent=1).encode()
+
+    def test_chunks(self):
+        """All threads should be returned regardless of the chunk size."""
+        expected = [(page['page'], thread) for page in self.catalog
+                    for thread in page['threads']]
+        for chunk_size in [1, 7, 100, len(self.data)]:
+            parser = scraper.CatalogParser()
+            threads = []
+            for i in range(0, len(self.data), chunk_size):
+                threads.extend(parser.feed(self.data[i:i + chunk_size]))
+            threads.extend(parser.close())
+            self.assertEqual(threads, expected)
+
+    def test_incomplete(self):
+        """Incomplete data should be reported when the parser is closed."""
+        parser = scraper.CatalogParser()
+        threads = parser.feed(self.data[:len(self.data) // 2])
+        self.assertTrue(threads)
+        self.assertRises(ValueError, parser.close)
+
+
 class ThreadDataTest(BaseTestCase):
 
     def test_basics(self):
@@ -376,6 +1795,71 @@ class PostDataTest(BaseTestCase):
                              msg='%s: wrong default' % entry[0])
 
 
+def legacy_replace_content(text):
+    """Original implementation of PostData.replace_content."""
+    text = re.sub(r'\<a.*?class="quotelink".*?\>(.*?)\</a\>', r'\1', text)
+    text = re.sub(r'\<span.*?\>(.*?)\</span\>', r'\1', text)
+    text = re.sub(r'\<pre.*?\>(.*?)\</pre\>', r'[code]\1[/code]', text)
+    text = text.replace('<br>', '\n')
+    text = text.replace('<wbr>', '')
+    text = html.unescape(text)
+    return text
+
+
+class ReplaceContentTest(BaseTestCase):
+
+    corpus = [
+        '',
+        'Plain text.',
+        '<a href="#p43722299" class="quotelink">&gt;&gt;43722299</a><br>Nope.',
+        '<a href="/g/thread/43711727#p43711727" class="quotelink">&gt;&gt;'
+        '43711727</a><br><span class="quote">&gt;implying</span>',
+        '<span class="deadlink">&gt;&gt;43700000</span>',
+        '<a href="//boards.4chan.org/v/" class="quotelink">&gt;&gt;&gt;/v/</a>',
+        '<pre class="prettyprint">int main() {<br>    return 0;<br>}</pre>',
+        'https://example.com/very/long/<wbr>path/which/4chan/<wbr>breaks',
+        'Tom &amp; Jerry &quot;quoted&quot; &#039;single&#039; &lt;b&gt;',
+        '&lt;span&gt;escaped&lt;/span&gt; &amp',
+        '&am<wbr>p; split entity',
+        '<span class="quote">&gt;<span class="deadlink">&gt;&gt;1</span></span>',
+        '<a href="http://example.com">link</a> <a href="#p1" class="quotelink">'
+        '&gt;&gt;1</a>',
+        '<span class="quote">not closed',
+        'text</span> closed only</a></pre>',
+        '<span class="quote">multi<br>line</span>',
+        'new\nline <span>x</span>',
+        '<br/><wbr/><brx><b>bold</b><p>paragraph</p>',
+        '<s>spoiler</s> <span class="fortune" style="color:red">fortune</span>',
+        '<span>a<a href="#p1" class="quotelink">b</span>c</a>',
+        '<pre><span>x</pre></span>',
+        '<abbr class="quotelink">abbr</abbr>',
+    ]
+
+    fragments = [
+        'text ', '<br>', '<wbr>', '&gt;', '&amp;', '&', '<span class="quote">',
+        '</span>', '<a href="#p1" class="quotelink">', '</a>', '<pre>',
+        '</pre>', '<a href="x">', '\n', '<', '>', '<b>', '</b>',
+        '&lt', '&quot;', '&#039;', '&nbsp;', '&#', 'amp;', 'gt;',
+    ]
+
+    def check(self, text):
+        post_data = scraper.PostData(self.sample_post_json_minimal)
+        self.assertEqual(post_data.replace_content(text),
+                         legacy_replace_content(text), msg=repr(text))
+
+    def test_corpus(self):
+        """Output should be identical to the original implementation."""
+        for text in self.corpus:
+            self.check(text)
+
+    def test_random(self):
+        """Output should be identical to the original implementation."""
+        rand = random.Random(0)
+        for i in range(5000):
+            self.check(''.join(rand.choice(self.fragments)
+                               for j in range(rand.randint(1, 12))))
+
+
 class TriggersTest(BaseTestCase):
 
     def test_check_post_type(self):
@@ -402,6 +1886,21 @@ class TriggersTest(BaseTestCase):
         trigger = models.Trigger(post_type='master')
         self.assertFalse(triggers.check_post_type(trigger, thread, post_data))
 
+    def test_detached(self):
+        """Loaded triggers should not be expired by the commits since they are
+        used by the other threads.
+        """
+        tag = self.add_model(models.Tag, name='tag')
+        self.add_model(models.Trigger, field='comment', event='contains',
+                       phrase='a', post_type='any', tag_id=tag.id)
+        triggers = scraper.Triggers()
+        database.db.session.commit()
+        trigger, = triggers.triggers
+        state = inspect(trigger)
+        self.assertTrue(state.detached)
+        self.assertFalse(state.expired_attributes)
+        self.assertEqual(trigger.tag.name, 'tag')
+
     def test_check_event(self):
         """Test if the event is checked correctly."""
         def get_trigger(event):
@@ -439,6 +1938,24 @@ class TriggersTest(BaseTestCase):
         post_data.comment = 'ends with phrase'
         check(trigger_no, trigger)
 
+    def test_thread_tags(self):
+        """Tags should be assigned once and only if not assigned already."""
+        board = self.add_model(models.Board, name='board')
+        thread = self.add_model(models.Thread, board=board, number=1)
+        tags = [self.add_model(models.Tag, name='tag%s' % i) for i in range(3)]
+        self.add_model(models.TagToThread, thread=thread, tag=tags[0])
+
+        thread_tags = scraper.ThreadTags(thread)
+        for tag in tags + tags:
+            thread_tags.add(tag)
+        self.assertEqual(thread_tags.pending, [tags[1].id, tags[2].id])
+        thread_tags.flush()
+        database.db.session.commit()
+
+        self.assertEqual(models.TagToThread.query.count(), 3)
+        self.assertEqual(models.TagToThread.query.filter_by(
+            automatically_added=True).count(), 2)
+
     def test_handle(self):
         """Test if the trigger saves the thread and adds the tag."""
         post_data = scraper.PostData(self.sample_post_json)
@@ -462,6 +1979,61 @@ class TriggersTest(BaseTestCase):
                          msg='Tag was not marked as automatically added.')
 
 
+class TriggerMatcherTest(BaseTestCase):
+
+    def setup(self):
+        self.random = random.Random(0)
+        self.words = ['phrase', 'Phrase', 'PHRASE', 'ph', 'rase', 'other', '']
+        self.triggers = [
+            models.Trigger(field=field, event=event[0], phrase=phrase,
+                           case_sensitive=case_sensitive, post_type=post_type,
+                           save_thread=True)
+            for field in ['name', 'comment']
+            for event in models.Trigger.EVENT_CHOICES
+            for phrase in self.words
+            for case_sensitive in [True, False]
+            for post_type in ['any', 'master', 'sub']
+        ]
+
+    def get_post_data(self):
+        post_data = scraper.PostData(self.sample_post_json)
+        post_data.number = self.random.choice([1, 2])
+        post_data.name = self.random.choice(self.words + [None])
+        post_data.comment = ' '.join(self.random.choice(self.words)
+                                     for i in range(self.random.randint(0, 4)))
+        return post_data
+
+    def check_equivalence(self):
+        """Matcher should return exactly the same triggers as the checks
+        performed one by one.
+        """
+        board = self.add_model(models.Board, name='board')
+        thread = self.add_model(models.Thread, board=board, number=1)
+        triggers = scraper.Triggers()
+        matcher = scraper.TriggerMatcher(self.triggers)
+        for i in range(200):
+            post_data = self.get_post_data()
+            expected = [
+                trigger for trigger in self.triggers
+                if triggers.check_post_type(trigger, thread, post_data)
+                and triggers.check_event(trigger, post_data)
+            ]
+            matched = matcher.match(post_data, post_data.number == 1)
+            self.assertEqual(set(map(id, matched)), set(map(id, expected)))
+            self.assertEqual(len(matched), len(expected))
+
+    def test_equivalence(self):
+        self.check_equivalence()
+
+    def test_equivalence_without_automaton(self):
+        ahocorasick = scraper.ahocorasick
+        scraper.ahocorasick = None
+        try:
+            self.check_equivalence()
+        finally:
+            scraper.ahocorasick = ahocorasick
+
+
 class CacheTestMixin(object):
     """Contains general tests for all cache systems."""
 